@@ -96,7 +96,7 @@ logging.basicConfig(
 
 
 #from models.BIF import BIF
-from utilities import utils, logs
+from utilities import utils, logs, timing
 
 # some basic utilities for use with s3 storage and interaction with lambdas.
 
@@ -182,6 +182,7 @@ def get_aws_s3_cmd(
     return cmd + " --recursive" if recursive else cmd
    
    
+@timing.timed('s3_get')
 def get_s3_core(bucket, key):
     s3 = boto3.client('s3')
     data = s3.get_object(Bucket=bucket, Key=key)
@@ -189,6 +190,7 @@ def get_s3_core(bucket, key):
     return body
  
    
+@timing.timed('s3_put')
 def put_s3_core(bucket, key, strobj):  
     s3 = boto3.resource('s3')
     request_obj = s3.Object(bucket, key)
@@ -212,6 +214,16 @@ def read_buff_from_s3path(s3path):
     return buff
     
 
+@timing.timed('s3_get')
+def read_range_from_s3path(s3path, offset, length):
+    """ return length bytes of the object at s3path starting at offset, using one ranged get.
+    """
+    s3dict = parse_s3path(s3path)
+    s3 = boto3.client('s3')
+    data = s3.get_object(Bucket=s3dict['bucket'], Key=s3dict['key'], Range=f"bytes={offset}-{offset + length - 1}")
+    return data['Body'].read()
+
+
 def read_csv_from_s3path(s3path, user_format=False, dtype=None):
     buff = read_buff_from_s3path(s3path)
     # s3dict = parse_s3path(s3path)
@@ -316,6 +328,21 @@ def does_s3path_exist(s3path) -> bool:
         return False
 
 
+
+def get_s3path_etag(s3path):
+    """ return the ETag of the object at s3path, or None if it does not exist.
+        The ETag changes whenever the object is rewritten, so it can be used 
+        to validate cached data derived from the object.
+    """
+    s3_dict = parse_s3path(s3path)
+    
+    s3_client = boto3.client('s3')
+    try:
+        head = s3_client.head_object(Bucket=s3_dict['bucket'], Key=s3_dict['key'])
+    except ClientError:
+        return None
+    return head['ETag'].strip('"')
+
     
 
 class S3File(io.RawIOBase):
@@ -494,6 +521,7 @@ MAX_THREADS = 10
 CUSTOM_CONFIG = TransferConfig(max_concurrency=MAX_THREADS, use_threads=True)
 
 
+@timing.timed('s3_get')
 def fetch_s3key_to_dirpath(s3key: str, local_dirpath: str, bucket_obj, silent=True):
     """ download object with key s3key from bucket_obj
         extract basename from key
@@ -509,6 +537,7 @@ def fetch_s3key_to_dirpath(s3key: str, local_dirpath: str, bucket_obj, silent=Tr
     bucket_obj.download_file(s3key, local_path, Config=CUSTOM_CONFIG)
     
 
+@timing.timed('s3_put')
 def upload_filepath_to_s3path(filepath, s3filepath):
     s3dict = parse_s3path(s3filepath)
     upload_file(file_path=filepath, s3_object_name=s3dict['key'], bucket=s3dict['bucket'])
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3.7
 import re
 import os
+import sys
 import json
 import string
 import argparse
@@ -10,6 +11,10 @@ import collections
 import openpyxl
 import pandas as pd
 
+# the style to contests matrix is shared with the audit engine in utilities/cvr_utils.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utilities.cvr_utils import get_style_to_contests_matrix, style_to_contests_dol_from_matrix
+
 
 STYLE_DICT = f'resources/style_dict/'
 
@@ -46,22 +51,8 @@ def get_contests_per_style(contests: list, dataframe, ballot_styles) -> dict:
     :param dataframe: a pandas data frame with CVR
     :param ballot_styles: a pandas object with all ballot styles
     """
-    contests_per_style = collections.OrderedDict()
-    for ballot_style in ballot_styles:
-        df = dataframe[dataframe['Ballot Style'] == ballot_style]
-        contests_per_style[ballot_style] = get_value_only_contests(contests, df)
-    return contests_per_style
-
-
-def get_value_only_contests(contests: list, ballot_style_df) -> list:
-    """
-    Builds a list of contests with at least a value (option)
-    :param contests: all columns with contest names
-    :param ballot_style_df: filtered CVR dataframe that returns
-    contests only for a given ballot style
-    """
-    return [contest for contest in contests
-            if len(set(ballot_style_df[contest].dropna())) != 0]
+    style_matrix = get_style_to_contests_matrix(dataframe, contests)
+    return style_to_contests_dol_from_matrix(style_matrix, ballot_styles)
 
 
 def get_cvr_names(contest_name: str, df) -> list:
@@ -19,7 +19,8 @@ additional QR code.
 
 import binascii
 import json
-import bitarray 
+import os
+import zipfile
 
 
 """
@@ -29,62 +30,229 @@ Parse manifest files to use
     => Contest_Manifest :           { ContestID : [ContestDescription, VoteFor] }
     => CandidateManifest :          { ContestId : [ candiate, .. ]}
 
+The manifests are found either in a directory or in the CVR zip file, as exported by Dominion.
+They are loaded once by DominionQRDecoder, which precomputes the layout of the vote bits
+of each ballot type.
 """
-with open("CVR_Export_20200326124513/BallotTypeManifest.json", 'r') as read_file:
-    BallotTypeManifest_data = json.load(read_file)
-BallotTypeManifest = {} # dictinary to store ballot type id
-for i in BallotTypeManifest_data['List']:
-    BallotTypeManifest[i['Id']] = i['Description']
-
-with open("CVR_Export_20200326124513/BallotTypeContestManifest.json", 'r') as read_file:
-    BallotTypeContestManifest_data = json.load(read_file)
-BallotTypeContestManifest = {} # dictionary of list, to store each contest in a each ballot type id
-for type in BallotTypeManifest:
-    BallotTypeContestManifest[type]=[]
-for b in BallotTypeContestManifest_data['List']:
-    BallotTypeContestManifest[b['BallotTypeId']].append(b['ContestId'])
-
-with open("CVR_Export_20200326124513/ContestManifest.json", 'r') as read_file:
-    Contest_Manifest_data = json.load(read_file)
-Contest_Manifest = {} # dictionary of list to store contests info
-for i in Contest_Manifest_data['List']:
-    Contest_Manifest[i['Id']] = [i['Description'] , i['VoteFor']]
-
-with open("CVR_Export_20200326124513/CandidateManifest.json", 'r') as read_file:
-    CandidateManifest_data = json.load(read_file)
-CandidateManifest = {} # dictionary of list, to store each candidate in each contest.
-for contest in Contest_Manifest:
-    CandidateManifest[contest] = []
-for candidate in CandidateManifest_data['List']:  
-    if(candidate['Type'] in ['Regular', 'WriteIn'] ): # only take 'Regular' and 'WriteIn' contests
-        CandidateManifest[candidate['ContestId']].append(candidate['Description']) 
+DEFAULT_MANIFEST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'CVR_Export_20200326124513')
+
+MANIFEST_NAMES = ['BallotTypeManifest', 'BallotTypeContestManifest', 'ContestManifest', 'CandidateManifest']
+
+# contests whose vote bits are in the first block of the qr code. All others are in the second block.
+FIRST_BLOCK_CONTEST_IDS = [7, 8, 9, 10, 11, 12, 23, 22, 24]
+
+
+def load_manifests(manifest_path):
+    """
+    Function to load the four manifest files.
+
+    Parameters
+    ----------
+        manifest_path : string
+            directory holding the manifest json files, or the CVR zip file that includes them.
+    Returns
+    -------
+        dictionary :
+            { manifest_name : parsed json, ... }
+    """
+    manifests = {}
+    if zipfile.is_zipfile(manifest_path):
+        with zipfile.ZipFile(manifest_path) as archive:
+            members = {os.path.basename(name): name for name in archive.namelist()}
+            for manifest_name in MANIFEST_NAMES:
+                manifests[manifest_name] = json.loads(archive.read(members[f"{manifest_name}.json"]))
+    else:
+        for manifest_name in MANIFEST_NAMES:
+            with open(os.path.join(manifest_path, f"{manifest_name}.json"), 'r', encoding='utf-8') as read_file:
+                manifests[manifest_name] = json.load(read_file)
+    return manifests
+
+
+class DominionQRDecoder:
+    """
+    Decoder for the qr codes of one election, built from its manifest files.
+
+    For each ballot type id, the contests are laid out once as
+    (contest description, block, bit offset, bit width, vote for, candidates),
+    so decoding a ballot is only integer bit operations on the raw bytes of the blocks.
+    """
+    def __init__(self, manifest_path=DEFAULT_MANIFEST_PATH):
+        manifests = load_manifests(manifest_path)
+
+        self.BallotTypeManifest = {} # dictinary to store ballot type id
+        for i in manifests['BallotTypeManifest']['List']:
+            self.BallotTypeManifest[i['Id']] = i['Description']
+
+        self.BallotTypeContestManifest = {} # dictionary of list, to store each contest in a each ballot type id
+        for type in self.BallotTypeManifest:
+            self.BallotTypeContestManifest[type]=[]
+        for b in manifests['BallotTypeContestManifest']['List']:
+            self.BallotTypeContestManifest[b['BallotTypeId']].append(b['ContestId'])
+
+        self.Contest_Manifest = {} # dictionary of list to store contests info
+        for i in manifests['ContestManifest']['List']:
+            self.Contest_Manifest[i['Id']] = [i['Description'] , i['VoteFor']]
+
+        self.CandidateManifest = {} # dictionary of list, to store each candidate in each contest.
+        for contest in self.Contest_Manifest:
+            self.CandidateManifest[contest] = []
+        for candidate in manifests['CandidateManifest']['List']:
+            if(candidate['Type'] in ['Regular', 'WriteIn'] ): # only take 'Regular' and 'WriteIn' contests
+                self.CandidateManifest[candidate['ContestId']].append(candidate['Description'])
+
+        self.layouts = {ballot_type_id: self.build_layout(all_contests)
+                        for ballot_type_id, all_contests in self.BallotTypeContestManifest.items()}
+
+    def build_layout(self, all_contests):
+        """
+        Lay out the vote bits of the contests of one ballot type.
+        Each contest takes one bit per candidate, in succession in its block.
+
+        Returns
+        -------
+            list of tuple :
+                (contest description, block, bit offset, bit width, vote for, candidates)
+        """
+        layout = []
+        start = 0
+        check = 1
+        for contest in all_contests:
+            if contest in FIRST_BLOCK_CONTEST_IDS:
+                block = 0
+            else:
+                block = 1
+                if check: # changing to the second block
+                    start = 0
+                check = 0
+            width = len(self.CandidateManifest[contest])
+            description, vote_for = self.Contest_Manifest[contest]
+            layout.append((description, block, start, width, vote_for, self.CandidateManifest[contest]))
+            start += width
+        return layout
+
+    def decode_vote(self, blocks, ballot_typ_id, end_blocks):
+        """
+        Function to decode vote bits.
+        The bits of each contest are extracted from the integer value of its block,
+        and each bit '1' selects the candidate at that position.
+
+        Parameters
+        ----------
+            blocks : List of bytes
+                bytes of the two blocks holding the vote bits
+            ballot_typ_id : int
+                ballot type id, which gives the contests of the ballot
+            end_blocks : List of bytes
+                bytes of the write in votes
+        Returns
+        -------
+            dictionary of list :
+                verbose ballots vote
+        """
+        layout = self.layouts[ballot_typ_id]
+        VoteResult = {}
+        for contest_layout in layout:
+            VoteResult[contest_layout[0]] = []
+
+        writein_vote_lists = get_writein(end_blocks) # get the writein votes
+        writein_counts = [0, 0]
+        block_values = [int.from_bytes(block, byteorder='big') for block in blocks]
+        block_bit_lengths = [len(block) * 8 for block in blocks]
+
+        for description, block, start, width, vote_for, candidates in layout:
+            # bits beyond the end of the block are not set.
+            shift = block_bit_lengths[block] - start - width
+            if shift >= 0:
+                contest_bits = (block_values[block] >> shift) & ((1 << width) - 1)
+            elif start < block_bit_lengths[block]:
+                contest_bits = (block_values[block] << -shift) & ((1 << width) - 1)
+            else:
+                contest_bits = 0
+
+            pos = []
+            while contest_bits: # positions of the bits '1', from the most significant bit
+                top_bit = contest_bits.bit_length()
+                pos.append(width - top_bit)
+                contest_bits ^= 1 << (top_bit - 1)
+
+            if len(pos)<1: # if no vote
+                VoteResult[description].append('BLANK CONTEST')
+                continue
+            if len(pos) < vote_for : # check undervotes
+                VoteResult[description].append('UNDER_VOTE_BY '+ str(vote_for - len(pos)))
+            for p in pos:
+                vote = candidates[p]
+                if(vote == 'Write-in'): # write in votes
+                    vote = vote + ' '+ writein_vote_lists[block][writein_counts[block]]
+                    writein_counts[block] += 1
+                VoteResult[description].append(vote)
+
+        return VoteResult
+
+    def decode_qr_bytes(self, byte_value, ballot_typ_id):
+        """
+        Function to decode QR bytes.
+        This function reads qr bytes and gets values like number of qr codes, 
+        precinct, sheet number, card codes, block lengths, blocks, ... 
+        We use block lenghts in order to identify blocks of bytes that belong to
+        a certain contest.
+
+        Parameters
+        ----------
+            byte_value : string or bytes
+                qr code bytes, as a hex string or raw bytes
+            ballot_typ_id : int
+                ballot type id, between 1 & 180 in this election
+
+        Returns
+        -------
+            dictionary of list
+                verbose ballots vote
+        """
+        bytestr = binascii.unhexlify(byte_value) if isinstance(byte_value, str) else bytes(byte_value)
+
+        # number_of_qrs = bytestr[0:2] # number of qr codes 
+        # un_const_1 = bytestr[2:6] # unknown constant '000102000000'
+        # un_const_2 = bytestr[8:16] # unknown constant '00000000000000000'
+        # un_const_3 = bytestr[19:21] # unknown constant '0000' 
+        # un_const_4 = bytestr[22] # unknown constant '00' 
+        # # .....
+        # precinct = int.from_bytes(bytestr[6:8], byteorder='little')  # precinct value
+        sheet_num = bytestr[16] # number of sheets 1 2 ..   
+
+        if(sheet_num == 1):  # identify sheet number.
+            blklen_1 = 0
+            blklen_1_1 = 0
+            blklen_2 = bytestr[21]    # length for the second block
+            blklen_2_1 = bytestr[21+blklen_1+1]
+            chunk_1 = bytestr[17:17+blklen_1]
+            chunk_2 = bytestr[21+blklen_1+4:21+blklen_1+blklen_2+1]
+        else:
+            blklen_1 = bytestr[21]  # length for block 1
+            blklen_1_1 = bytestr[23] # lenght for sub block 1
+            blklen_2 = bytestr[25+blklen_1]    # length for the second block
+            blklen_2_1 = bytestr[25+blklen_1+1]
+            chunk_1 = bytestr[25:25+blklen_1]
+            chunk_2 = bytestr[25+blklen_1+4:25+blklen_1+blklen_2+1]
 
+        end_block_1 = chunk_1[blklen_1_1:] # sub block of block 1
+        end_block_2 = chunk_2[blklen_2_1 + 4:] # sub block of block 2
 
+        end_blocks = [end_block_1, end_block_2[1:]]
 
+        return self.decode_vote([chunk_1, chunk_2], ballot_typ_id, end_blocks) # decode the votes
 
-"""
-Function to return all occurences of a sub string
-We use this function to find all occurence of bit '1'(vote bit) in the bitfield
 
-Parameters
-----------
-    str : string  
-        string to perform the search on
-    sub : string
-        sub string to search
-Returns
--------
-    list of int : 
-        index where the subsring is found
- 
-"""
-def find_all(str, sub): 
-    start = 0
-    while True:
-        start = str.find(sub, start)
-        if start == -1: return
-        yield start
-        start += len(sub) # use start += 1 to find overlapping matches
+decoders = {}
+
+def get_decoder(manifest_path=DEFAULT_MANIFEST_PATH):
+    """
+    Function to return the decoder of the manifests at manifest_path,
+    so the manifests are loaded only once per process.
+    """
+    if manifest_path not in decoders:
+        decoders[manifest_path] = DominionQRDecoder(manifest_path)
+    return decoders[manifest_path]
 
 
 
@@ -123,152 +291,24 @@ def get_writein(block):
 
 
 """
-Function to decode vote bits.
-The vote decoding process mainly includes taking on succesive bits in the provided bitfiled 
-and matching the votes to the repective contests.
-
-Parameters
-----------
-    vote_bits_list : List of bitstring
-        bitstring list holding the vote bits
-    all_contest : List
-        list of all contests 
-    end_blocks : List of bytes
-        bytes of the write in votes        
-Returns
--------
-    dictionary of list :
-        verbose ballots vote
- 
-""" 
-def decode_vote(vote_bits_list, all_contest, end_blocks): 
-    VoteResult = {}
-    for cont in all_contest:
-        VoteResult[Contest_Manifest[cont][0]]=[]
-    start = 0
-    end = 0
-    length = 0
-    check = 1
-    writein = 0
-   
-    writein_vote_lists = get_writein(end_blocks) # get the writein votes
-   
-    for contest in all_contest:
-        if contest in [7, 8, 9, 10, 11, 12, 23, 22, 24]:
-            vote_bits = vote_bits_list[0] # bits from the first block
-            writein_vote = writein_vote_lists[0]
-        else:
-            vote_bits = vote_bits_list[1]
-            writein_vote = writein_vote_lists[1]
-            if check: # changing to the second block
-                start = 0
-                end = 0
-                length = 0
-                writein = 0
-            check = 0
-
-        # print(Contest_Manifest[contest][0]) # print the contest
-
-        length = len(CandidateManifest[contest])
-        end += length
-        contest_bits = vote_bits[start:end]
-        pos = list(find_all(contest_bits, '1'))
-        
-        if len(pos)<1: # if no vote
-            vote = 'BLANK CONTEST'
-            # print('\t'+ vote)
-            VoteResult[Contest_Manifest[contest][0]].append(vote)
-        else:
-            if len(pos) < Contest_Manifest[contest][1] : # check undervotes
-                vote = 'UNDER_VOTE_BY '+ str(Contest_Manifest[contest][1] - len(pos))
-                VoteResult[Contest_Manifest[contest][0]].append(vote)
-                # print('\t' + vote)
-            for p in pos:
-                vote = CandidateManifest[contest][p]
-                if(vote == 'Write-in'): # write in votes
-                    vote = vote + ' '+ writein_vote[writein]
-                    # print('\t'+ vote)
-                    writein += 1
-                    VoteResult[Contest_Manifest[contest][0]].append(vote)
-                else:
-                    # print('\t'+ vote)
-                    VoteResult[Contest_Manifest[contest][0]].append(vote) 
-        
-        start = end 
-
-    return VoteResult
-
-"""
-Function to decode QR bytes.
-This function reads qr bytes and gets values like number of qr codes, 
-precinct, sheet number, card codes, block lengths, blocks, ... 
-We use block lenghts in order to identify blocks of bytes that belong to
-a certain contest.
+Function to decode QR bytes with the decoder of the manifests at manifest_path.
 
 Parameters
 ----------
-    vote_bits_list : List of bitsting
-        bitstring list holding the votes
-    all_contest : List
-        list of all contests
-    end_blocks : List of bytes
-        bytes of the write in votes from all the blocks       
+    byte_value : string
+        qr code bytes as a hex string
+    ballot_typ_id : int
+        ballot type id
+    manifest_path : string
+        directory or CVR zip file holding the manifests
 
 Returns
 -------
     dictionary of list
         verbose ballots vote
 """ 
-def decode_qr_bytes(byte_value, ballot_typ_id): 
-    bytestr =  binascii.unhexlify(byte_value)
-    
-    # number_of_qrs = bytestr[0:2] # number of qr codes 
-    # un_const_1 = bytestr[2:6] # unknown constant '000102000000'
-    # un_const_2 = bytestr[8:16] # unknown constant '00000000000000000'
-    # un_const_3 = bytestr[19:21] # unknown constant '0000' 
-    # un_const_4 = bytestr[22] # unknown constant '00' 
-    # # .....
-    # precinct = int.from_bytes(bytestr[6:8], byteorder='little')  # precinct value
-    sheet_num = bytestr[16] # number of sheets 1 2 ..   
-
-    if(sheet_num == 1):  # identify sheet number.
-        blklen_1 = 0
-        blklen_1_1 = 0
-        blklen_2 = bytestr[21]    # length for the second block
-        blklen_2_1 = bytestr[21+blklen_1+1]
-        card_id_paper_index_0 = int.from_bytes(bytestr[17:19], byteorder='little') #card id of paper index 1
-        card_id_paper_index_1 = 0
-        chunk_1 = bytestr[17:17+blklen_1]
-        chunk_2 = bytestr[21+blklen_1+4:21+blklen_1+blklen_2+1]
-    else:
-        blklen_1 = bytestr[21]  # length for block 1
-        blklen_1_1 = bytestr[23] # lenght for sub block 1
-        blklen_2 = bytestr[25+blklen_1]    # length for the second block
-        blklen_2_1 = bytestr[25+blklen_1+1]
-        card_id_paper_index_0 = int.from_bytes(bytestr[17:19], byteorder='little') #card id of paper index 0
-        card_id_paper_index_1 = int.from_bytes(bytestr[25+blklen_1-4:25+blklen_1-2], byteorder='little') #card id of paper index 1
-        chunk_1 = bytestr[25:25+blklen_1]
-        chunk_2 = bytestr[25+blklen_1+4:25+blklen_1+blklen_2+1]
-            
-    all_contests = BallotTypeContestManifest[ballot_typ_id]
-
-    end_block_1 = chunk_1[blklen_1_1:] # sub block of block 1
-    end_block_2 = chunk_2[blklen_2_1 + 4:] # sub block of block 2
-
-    chunk_1_bin = bitarray.bitarray( endian='big')
-    chunk_1_bin.frombytes(chunk_1)
-    chunk_1_bin_str = chunk_1_bin.to01() # change to a string containing 0's and 1's for easy manipulation
-
-    chunk_2_bin = bitarray.bitarray( endian='big')
-    chunk_2_bin.frombytes(chunk_2)
-    chunk_2_bin_str = chunk_2_bin.to01()
-    
-    vote_bits_list = [chunk_1_bin_str, chunk_2_bin_str] # list containing the two blocks
-    end_blocks = [end_block_1, end_block_2[1:]]
-
-    Result = decode_vote(vote_bits_list, all_contests, end_blocks) # decode the votes
-
-    return Result
+def decode_qr_bytes(byte_value, ballot_typ_id, manifest_path=DEFAULT_MANIFEST_PATH): 
+    return get_decoder(manifest_path).decode_qr_bytes(byte_value, ballot_typ_id)
         
 
     
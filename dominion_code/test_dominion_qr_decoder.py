@@ -8,6 +8,9 @@ This test is don against "TestData.json" that has 91 test cases of qr code bytes
 import unittest
 import dominion_qr_decoder as Decoder
 import json
+import os
+import tempfile
+import zipfile
 import qr_bytes as QR
 
 
@@ -18,6 +21,17 @@ class testdecode_qr_bytes(unittest.TestCase):
         for ballot_id in QR.hex_values: # Test all of the test ballots against "TestData.json"
             output = Decoder.decode_qr_bytes(QR.hex_values[ballot_id], QR.ballot_type_ids[ballot_id])
             self.assertEqual(output, TestData[ballot_id])
+
+    def test_manifests_from_cvr_zip(self): # the manifests are read the same from the CVR zip file
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cvr_path = os.path.join(tmpdir, 'CVR_Export.zip')
+            with zipfile.ZipFile(cvr_path, 'w') as archive:
+                for manifest_name in Decoder.MANIFEST_NAMES:
+                    archive.write(os.path.join(Decoder.DEFAULT_MANIFEST_PATH, f"{manifest_name}.json"), f"{manifest_name}.json")
+            decoder = Decoder.DominionQRDecoder(cvr_path)
+        ballot_id = '00003_00825_000012'
+        output = decoder.decode_qr_bytes(QR.hex_values[ballot_id], QR.ballot_type_ids[ballot_id])
+        self.assertEqual(output, Decoder.decode_qr_bytes(QR.hex_values[ballot_id], QR.ballot_type_ids[ballot_id]))
         
 if __name__ == '__main__':
     unittest.main()
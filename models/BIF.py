@@ -29,10 +29,16 @@ BIF_COLUMNS = [
     ('chunk_idx', str),             # optional, used when a single file provides multiple chunks.
 ]
 
+# columns with few distinct values are categorical, and flags are int8, to reduce memory and speed filtering.
+BIF_CATEGORY_COLUMNS = ['style_num', 'precinct']
+BIF_FLAG_COLUMNS = ['is_bmd', 'style_roi_corrupted']
+
 
 class BIF:
     name = ''
     df = pd.DataFrame()
+    ballot_index = {}           # {ballot_id: index of row in df}, see get_ballot_index()
+    ballot_index_df = None      # the df for which ballot_index was built.
     # Bool indicating if the BIF operation are done on Lambda or locally.
     # If set to True, it will try to do BIFInstructions instead of
     # saving changes to local file.
@@ -68,16 +74,43 @@ class BIF:
         except AttributeError:
             raise AttributeError("Tried to access 'is_bmd' columns in BIF but it doesn't exist")
 
+    @staticmethod
+    def ballot_id_key(ballot_id):
+        """ ballot_ids are compared as int, as read from the bif csv, if possible. """
+        try:
+            return int(ballot_id)
+        except (TypeError, ValueError):
+            return str(ballot_id)
+
+    @classmethod
+    def build_ballot_index(cls):
+        """ build dict of ballot_id to the index of its row in df, for lookups without scanning df.
+            If a ballot_id is repeated, the first row is used.
+        """
+        if cls.df.index.name == 'ballot_id':
+            ballot_ids = cls.df.index
+        elif 'ballot_id' in cls.df.columns:
+            ballot_ids = cls.df['ballot_id']
+        else:
+            ballot_ids = []
+        cls.ballot_index = {}
+        for ballot_id, index in zip(ballot_ids, cls.df.index):
+            cls.ballot_index.setdefault(cls.ballot_id_key(ballot_id), index)
+        cls.ballot_index_df = cls.df
+
     @classmethod
     def get_ballot_index(cls, ballot_id: str) -> int:
-        try:
-            return cls.df.loc[cls.df['ballot_id'] == int(ballot_id)].index[0]
-        except IndexError:
-            return None
+        """ return index of the row of ballot_id in df, or None if not found.
+            The ballot_index is rebuilt if df has been replaced or its index changed.
+        """
+        if cls.ballot_index_df is not cls.df:
+            cls.build_ballot_index()
+        return cls.ballot_index.get(cls.ballot_id_key(ballot_id))
 
     @classmethod
     def set_ballot_id_as_index(cls):
         cls.df.set_index('ballot_id', inplace=True)
+        cls.ballot_index_df = None
 
     @classmethod
     def set_cell_value_by_ballot_id(cls, ballot_id: str, column: str, value: [int, str],
@@ -93,7 +126,8 @@ class BIF:
 
     @classmethod
     def is_bmd(cls, ballot_id):
-        return bool(int(cls.get_cell_value_by_ballot_id(ballot_id, column='is_bmd')) == 1)
+        is_bmd = cls.get_cell_value_by_ballot_id(ballot_id, column='is_bmd')
+        return is_bmd is not None and int(is_bmd or 0) == 1
 
     @classmethod
     def set_cell_value(cls, index: str, column: str, value: [int, str],
@@ -119,6 +153,10 @@ class BIF:
             #                column=column, value=value)
         else:
             try:
+                if column in BIF_FLAG_COLUMNS:
+                    value = int(value or 0)
+                elif isinstance(cls.df[column].dtype, pd.CategoricalDtype) and value not in cls.df[column].cat.categories:
+                    cls.df[column] = cls.df[column].cat.add_categories([value])
                 cls.df.at[index, column] = value
             except KeyError as err:
                 raise KeyError(f'Key {err} not found in BIF table')
@@ -148,7 +186,7 @@ class BIF:
         rootname = os.path.splitext(name)[0]    # use root without extension.    
         cls.name = rootname
 
-        cls.df = DB.load_data(dirname='bif', name=name, format='.csv')
+        cls.df = set_bif_column_types(DB.load_data(dirname='bif', name=name, format='.csv'))
             
         utils.sts(f"BIF {name} loaded. {len(cls.df.index)} records.", 3)
 
@@ -164,6 +202,7 @@ class BIF:
         
         if cls.df.index.name == 'ballot_id':
             cls.df.reset_index('ballot_id', inplace=True)
+            cls.ballot_index_df = None
 
         DB.save_data(data_item=bif_df, dirname='bif', name=bif_name, format='.csv')
         # if argsdict['use_s3_results']:
@@ -209,3 +248,14 @@ class BIF:
             return os.path.isfile(bif_path)
 
 
+def set_bif_column_types(bif_df: pd.DataFrame) -> pd.DataFrame:
+    """ convert BIF_CATEGORY_COLUMNS to categorical and BIF_FLAG_COLUMNS to int8, where they exist.
+        Flags which are blank or not numeric are 0.
+    """
+    for column in BIF_FLAG_COLUMNS:
+        if column in bif_df.columns:
+            bif_df[column] = pd.to_numeric(bif_df[column], errors='coerce').fillna(0).astype('int8')
+    for column in BIF_CATEGORY_COLUMNS:
+        if column in bif_df.columns:
+            bif_df[column] = bif_df[column].astype('category')
+    return bif_df
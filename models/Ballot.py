@@ -6,7 +6,7 @@ import itertools
 #from models.Contest import Contest
 from models.DB import DB
 from models.BIF import BIF
-from utilities import barcode_parser, utils, args, alignment_utils, logs
+from utilities import barcode_parser, utils, args, alignment_utils, logs, timing
 from utilities.config_d import config_dict
 from utilities.images_utils import get_images_from_pdf, get_images_from_pbm, get_images_from_tif, get_images_from_png, read_raw_ess_barcode
 from utilities.zip_utils import get_archived_file, get_ballotid, get_precinct, get_party, get_group
@@ -195,6 +195,7 @@ class Ballot:
         else:
             return False
     '''
+    @timing.timed('decode')
     def get_ballot_images(self):
         """
         Processes files already read as dict of name, bytes_array
@@ -203,7 +204,8 @@ class Ballot:
 
         self.ballotimgdict['images'] = []
         extension = self.ballotdict['extension']
-        utils.sts(f"Converting images from {extension} data...", 3, end='')
+        if utils.is_logged(3):
+            utils.sts(f"Converting images from {extension} data...", 3, end='')
 
         for filedict in self.ballotimgdict['source_files']:
             if extension == '.pdf':
@@ -218,9 +220,11 @@ class Ballot:
                 utils.exception_report(f"get_ballot_images(): 'extension':{extension} not recognized.")
                 sys.exit(1)
             self.ballotimgdict['images'].extend(images)
-        utils.sts(f"{len(self.ballotimgdict['images'])} image(s) converted.", 3)
+        if utils.is_logged(3):
+            utils.sts(f"{len(self.ballotimgdict['images'])} image(s) converted.", 3)
             
 
+    @timing.timed('align')
     def align_images(self):
         """ Aligns and crops ballot images.
             Also updates determinants.
@@ -233,7 +237,8 @@ class Ballot:
         extension = self.ballotdict['extension']
         ballot_id = self.ballotdict['ballot_id']
         
-        utils.sts(f"Aligning {vendor} ballots, ballot_id:{ballot_id}...", 3, end='')
+        if utils.is_logged(3):
+            utils.sts(f"Aligning {vendor} ballots, ballot_id:{ballot_id}...", 3, end='')
         
         if vendor == 'ES&S':
             """ ES&S has two image formats:
@@ -286,14 +291,17 @@ class Ballot:
         if error:
             utils.exception_report(f"Ballot.align_images {vendor} not supported with file extension {extension}")
 
-    def get_timing_marks(self):
+    @timing.timed('timing_marks')
+    def get_timing_marks(self, style_timing_marks=None):
         """ get timing marks and update ballot instance.
             updates timing_marks to None if there is a show-stopper error in getting the timing marks.
             for gentemplate() phase of operation, skip this ballot and withhold from template.
             In genrois() maybe fixed timing marks can be used.
+            style_timing_marks, if provided, are the timing marks of the style, used to narrow the search.
         """
     
-        self.ballotdict['timing_marks'] = alignment_utils.generic_get_timing_marks(self.ballotimgdict['images'], self.ballotdict['ballot_id'])
+        self.ballotdict['timing_marks'] = alignment_utils.generic_get_timing_marks(
+            self.ballotimgdict['images'], self.ballotdict['ballot_id'], style_timing_marks)
         if not self.ballotdict['timing_marks'][1]:
             # second page is apparently blank.
             self.ballotdict['p1_blank'] = True
@@ -508,16 +516,9 @@ class Ballot:
         '''
 
     def is_BMD_per_bif(self, argsdict):
+        return BIF.is_bmd(self.ballotdict['ballot_id'])
 
-        if not 'ballot_id' in BIF.df.columns.tolist():
-            BIF.df = BIF.df.reset_index()
-        try:
-            is_bmd = BIF.df.loc[BIF.df['ballot_id']==self.ballotdict['ballot_id']]['is_bmd'].any()
-        except KeyError:
-            import pdb; pdb.set_trace()
-
-        return is_bmd
-
+    @timing.timed('barcode')
     def read_style_num_from_barcode(self, argsdict):
         """
         if ballot.style_num is defined, then use it, otherwise:
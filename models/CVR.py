@@ -2,6 +2,8 @@ import re
 import os
 import sys
 import json
+import bisect
+import hashlib
 import datetime
 import collections
 from zipfile import ZipFile
@@ -10,9 +12,10 @@ import xml.dom.minidom
 import numpy as np
 import pandas as pd
 
-from utilities import utils, logs
+from utilities import utils, logs, args
 from utilities.config_d import config_dict
 from utilities import style_utils
+from utilities.cvr_utils import get_style_to_contests_matrix, style_to_contests_dol_from_matrix
 
 from models.DB import DB
 
@@ -27,6 +30,9 @@ class CVR:
     data_frame = pd.DataFrame()
     master_styles_dict = {}
     cvr_ballotid_to_styles_dict = {}
+    loaded_shard_names = set()      # shards currently in data_frame, if loaded by shards.
+    loaded_job_name = ''            # job of data_frame, as a warm lambda container may process more than one job.
+    loaded_shard_index_hash = None  # hash of cvr_shard_index.json when the shards were loaded.
 
     @staticmethod
     def load_excel_to_df(argsdict: dict, filename_list: list, column_names_list: list):
@@ -35,16 +41,27 @@ class CVR:
         Combines multiple CVR files and assumes columns are identical.
         Renames unnamed columns by duplicating last column name.
         This is specific to ES&S cvr files.
+        
+        Parsing the excel files is slow, so the combined table, after header replacement
+        and write-in conversion, is cached in cmpcvr/cvr_cache/ keyed by the hashes of the
+        source files. Later loads by cmpcvr chunks or other phases read the cache instead.
         """
-        for idx, file_name in enumerate(filename_list):
+        use_cvr_cache = argsdict.get('use_cvr_cache', True)
+        if use_cvr_cache:
+            cache_name = CVR.get_cvr_cache_name(argsdict, filename_list, column_names_list)
+            cached_df = DB.load_data(dirname='cmpcvr', subdir='cvr_cache', name=cache_name, silent_error=True)
+            if cached_df is not None:
+                utils.sts(f"Using cached CVR {cache_name}, {len(cached_df.index)} records.", 3)
+                CVR.data_frame = cached_df
+                CVR.loaded_job_name = argsdict.get('job_name', '')
+                return
+
+        dfs = []
+        for file_name in filename_list:
             utils.sts(f"Reading cvr file {file_name}...")
-            if not idx:
-                #CVR.data_frame = pd.read_excel(file, engine='xlrd')
-                CVR.data_frame = DB.load_data(dirname='archives', name=file_name, user_format=True)
-            else:
-                # df = pd.read_excel(file, engine='xlrd')
-                df = DB.load_data(dirname='archives', name=file_name, user_format=True)
-                CVR.data_frame = CVR.data_frame.append(df, ignore_index=True)
+            #df = pd.read_excel(file, engine='xlrd')
+            dfs.append(DB.load_data(dirname='archives', name=file_name, user_format=True))
+        CVR.data_frame = pd.concat(dfs, ignore_index=True) if len(dfs) > 1 else dfs[0]
 
         if argsdict.get('convert_cvr_image_cells_to_writein', False):
             CVR.set_cells_with_images_to_writeins(argsdict['cvr'])
@@ -73,6 +90,24 @@ class CVR:
         utils.sts("Replacing columns with 'Unnamed' with prior named column name.")
         CVR.data_frame.columns = CVR.rename_unnamed(list(CVR.data_frame.columns))
 
+        CVR.loaded_job_name = argsdict.get('job_name', '')
+        if use_cvr_cache:
+            DB.save_data(data_item=CVR.data_frame, dirname='cmpcvr', subdir='cvr_cache', name=cache_name)
+
+    @staticmethod
+    def get_cvr_cache_name(argsdict: dict, filename_list: list, column_names_list: list) -> str:
+        """
+        Name of the cached CVR table, derived from the hashes of the source files
+        and the settings that modify the table as it is loaded.
+        """
+        cache_key = {
+            'file_hashes':      [DB.get_file_hash(dirname='archives', name=file_name) for file_name in filename_list],
+            'column_names':     list(column_names_list or []),
+            'image_writeins':   bool(argsdict.get('convert_cvr_image_cells_to_writein', False)),
+            }
+        digest = hashlib.sha1(json.dumps(cache_key).encode('utf8')).hexdigest()
+        return f"cvr_{digest[:20]}.pkl"
+
     @staticmethod
     def set_cells_with_images_to_writeins(file_paths):
         """Reads CVR spreadsheet as a ZIP and extracts information from
@@ -114,6 +149,97 @@ class CVR:
             cvr_replacement_header_list = style_utils.get_replacement_cvr_header(argsdict)
         CVR.load_excel_to_df(argsdict, argsdict['cvr'], cvr_replacement_header_list)
 
+    @staticmethod
+    def build_cvr_shards(argsdict: dict, ballots_per_shard: int = 5000) -> list:
+        """
+        Split the combined CVR into shards of contiguous ballot_id ranges so that
+        each cmpcvr chunk can load only the part of the CVR it needs.
+        This is run once by the main process prior to delegating cmpcvr chunks.
+
+            cmpcvr/cvr_shards/cvr_shard_{shard_idx}.csv
+            cmpcvr/cvr_shards/cvr_shard_index.json
+
+        The index provides the CVR column names, which may be duplicated and
+        would otherwise be mangled by read_csv, and for each shard:
+            {'shard_name', 'ballot_id_low', 'ballot_id_high', 'num_ballots'}
+        returns the list of shard dicts.
+        """
+        if CVR.data_frame.empty:
+            CVR.load_cvrs_to_df(argsdict)
+
+        sorted_df = CVR.data_frame.sort_values(by='Cast Vote Record', kind='mergesort')
+        chunks_lodf = utils.split_df_into_chunks_lodf(df=sorted_df, max_chunk_size=ballots_per_shard, max_concurrency=1)
+
+        DB.delete_dirname_files_filtered(dirname='cmpcvr', subdir='cvr_shards')
+
+        shards = []
+        for shard_idx, shard_df in enumerate(chunks_lodf):
+            shard_name = f"cvr_shard_{'%4.4u' % (shard_idx)}"
+            ballot_ids = shard_df['Cast Vote Record']
+            DB.save_data(data_item=shard_df, dirname='cmpcvr', subdir='cvr_shards', name=f"{shard_name}.csv")
+            shards.append({
+                'shard_name':       shard_name,
+                'ballot_id_low':    int(ballot_ids.iloc[0]),
+                'ballot_id_high':   int(ballot_ids.iloc[-1]),
+                'num_ballots':      len(shard_df.index),
+                })
+
+        shard_index = {'columns': list(CVR.data_frame.columns), 'shards': shards}
+        DB.save_data(data_item=shard_index, dirname='cmpcvr', subdir='cvr_shards', name='cvr_shard_index.json')
+        utils.sts(f"CVR split into {len(shards)} shards of no more than {ballots_per_shard} ballots each.", 3)
+        return shards
+
+    @staticmethod
+    def select_cvr_shards(shards: list, ballot_ids) -> list:
+        """
+        Return the names of the shards which include any of ballot_ids.
+        shards are as listed in cvr_shard_index.json, sorted by ballot_id
+        and with no overlapping ranges.
+        """
+        lows = [shard['ballot_id_low'] for shard in shards]
+        shard_names = []
+        for ballot_id in sorted(set(int(b) for b in ballot_ids)):
+            idx = bisect.bisect_right(lows, ballot_id) - 1
+            if idx < 0 or ballot_id > shards[idx]['ballot_id_high']:
+                continue
+            shard_name = shards[idx]['shard_name']
+            if not shard_name in shard_names:
+                shard_names.append(shard_name)
+        return shard_names
+
+    @staticmethod
+    def load_cvr_shards_for_ballot_ids(ballot_ids):
+        """
+        Load to CVR.data_frame only those CVR shards that include ballot_ids.
+        If the shards are already loaded, as may happen in a warm lambda, they are not read again
+        unless the job or the shards, as given by the hash of the index, have changed.
+        Shards must have been created by build_cvr_shards().
+        """
+        job_name = args.argsdict.get('job_name', '')
+        shard_index_hash = DB.get_file_hash(dirname='cmpcvr', subdir='cvr_shards', name='cvr_shard_index.json')
+        shard_index = DB.load_data_cached(dirname='cmpcvr', subdir='cvr_shards', name='cvr_shard_index.json')
+        shard_names = CVR.select_cvr_shards(shard_index['shards'], ballot_ids)
+
+        if (not CVR.data_frame.empty and set(shard_names) <= CVR.loaded_shard_names
+                and CVR.loaded_job_name == job_name and CVR.loaded_shard_index_hash == shard_index_hash):
+            return
+
+        shard_dfs = []
+        for shard_name in shard_names:
+            shard_df = DB.load_data(dirname='cmpcvr', subdir='cvr_shards', name=f"{shard_name}.csv")
+            shard_df.columns = shard_index['columns']
+            shard_dfs.append(shard_df)
+
+        if shard_dfs:
+            CVR.data_frame = pd.concat(shard_dfs, ignore_index=True)
+        else:
+            CVR.data_frame = pd.DataFrame(columns=shard_index['columns'])
+        CVR.loaded_shard_names = set(shard_names)
+        CVR.loaded_job_name = job_name
+        CVR.loaded_shard_index_hash = shard_index_hash
+        utils.sts(f"Loaded {len(shard_names)} of {len(shard_index['shards'])} CVR shards, "
+                  f"{len(CVR.data_frame.index)} records.", 3)
+
     @staticmethod
     def drop_unused_columns(dataframe):
         return dataframe.drop(['Cast Vote Record', 'Precinct'], axis=1)
@@ -135,21 +261,8 @@ class CVR:
         :param ballot_styles: a pandas object with all ballot styles
 
         """
-        contests_per_style = collections.OrderedDict()
-        for ballot_style in ballot_styles:
-            df = dataframe[dataframe['Ballot Style'] == ballot_style]
-            contests_per_style[ballot_style] = CVR.get_value_only_contests(contests, df)
-        return contests_per_style
-
-    @staticmethod
-    def get_value_only_contests(contests: list, ballot_style_df) -> list:
-        """
-        Builds a list of contests with at least a value (option)
-        :param contests: all columns with contest names
-        :param ballot_style_df: filtered CVR dataframe that returns contests
-        only for a given ballot style
-        """
-        return [contest for contest in contests if len(set(ballot_style_df[contest].dropna())) != 0]
+        matrix_df = get_style_to_contests_matrix(dataframe, contests)
+        return style_to_contests_dol_from_matrix(matrix_df, ballot_styles)
 
     @staticmethod
     def get_cvr_names(contest_name, df):
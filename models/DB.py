@@ -8,6 +8,8 @@ import json
 import shutil
 import traceback
 import glob
+import pickle
+import hashlib
 #from datetime import datetime, timezone
 
 import boto3
@@ -15,9 +17,9 @@ import numpy as np          # only to get np.nan
 import pandas as pd
 from botocore.exceptions import ClientError
 #from cv2 import imwrite, imread, imencode, imdecode, IMREAD_GRAYSCALE
-import cv2
+# cv2 is imported only where images are loaded or saved, to keep it out of the lambda entry point.
 
-from utilities import utils, args, logs
+from utilities import utils, args, logs, timing
 from aws_lambda import s3utils
 #from utilities import config_d
 #from models.Job import Job
@@ -35,6 +37,7 @@ class DB:
     """
     MODE = 'local'
     BALLOT_MARKS_DF = pd.DataFrame()
+    JOB_DATA_CACHE = {}     # {(job_name, file_path, kwargs): (file_hash, data)}, see load_data_cached()
     
     @classmethod
     def set_DB_mode(cls):
@@ -87,6 +90,8 @@ class DB:
            /{archive_root}_bif.csv                                  # resulting combined bif files, one per archive. 
                                                                     #   NOTE: only available if bif was generated by reading ballots
            /bif.csv                                                 # combined bif file
+           /{cvr_rootname}_cvr_table.csv                            # Dominion only: parsed CVR table cached for genbif_from_cvr
+           /{cvr_rootname}_cvr_table.json                           #       signature of CVR file used to validate the cached table.
            /log_bif.txt                                             # combined logs for all archives.
            /exc_bif.txt                                             # combined exception report for all archives.
            /chunks/{archive_root}_bif_chunk_{chunk_idx}.csv         # individual bif chunks with {200} ballots per chunk or so.
@@ -101,6 +106,7 @@ class DB:
         styles/CONV_card_code_TO_ballot_type_id_DICT.json           # This may be generated from CVR if available (Dominion only)
         styles/BUILT_BALLOTID_TO_STYLE_DICT.json                    # DEPRECATED - use BIF table instead.
         styles/sheetstyle_map_dict.json                             # maps similar styles
+        styles/ocr_cache.json                                       # ocr results keyed by hash of roi image and ocr config, if use_ocr_cache.
         styles/template_tasklists_dolod.json                        # single template tasklists file
         styles/tasks/{style_num}.csv                                # otherwise, a separate file is generated for each task here.
         styles/{style_num}/{style_num}-template{page1}.png          # up to two template files. A combination of {threshold} ballots. usually 50 right now. This is the result of gentemplate step.
@@ -170,6 +176,9 @@ class DB:
         cmpcvr/chunks/overvotes_{archive_root}_chunk_{chunk_idx}.csv    # individual cmpcvr overvote chunks
         cmpcvr/chunks/log_{archive_root}_chunk_{chunk_idx}.txt      # log of individual cmpcvr chunks.
         cmpcvr/chunks/exc_{archive_root}_chunk_{chunk_idx}.txt      # exceptions of individual cmpcvr chunks.
+        cmpcvr/cvr_cache/cvr_{hash}.pkl                             # combined ES&S CVR table, keyed by hashes of the CVR files.
+        cmpcvr/cvr_shards/cvr_shard_{shard_idx}.csv                 # CVR split by ballot_id range, if use_cvr_shards.
+        cmpcvr/cvr_shards/cvr_shard_index.json                      # column names and ballot_id range of each shard.
         cmpcvr/log_cmpcvr.txt                                       # combined log of vote extraction process
         cmpcvr/exc_cmpcvr.txt                                       # combined exceptions of vote extraction process
                                                                     #   chunk_name = f"{archive_root}_chunk_{chunk_idx}"
@@ -324,6 +333,8 @@ class DB:
                                 This is used vs. .json for all tabular data
                                 so that they can be easily concatenated.
                 .png            Image data sourced by the application.
+                .pkl            python object, typically df, pickled. Used for
+                                binary caches that are not meant for review.
             ----------------    ---------------------------------------
 
         parameters:
@@ -356,10 +367,10 @@ class DB:
         
         extension = os.path.splitext(name)[1]
         
-        if extension in ['.json', '.csv', '.png', '.txt', '.xlsx']:
+        if extension in ['.json', '.csv', '.png', '.txt', '.xlsx', '.pkl']:
             format = extension
             
-        if format in ['.json', '.csv', '.png', '.txt', '.xlsx']:
+        if format in ['.json', '.csv', '.png', '.txt', '.xlsx', '.pkl']:
             if not file_path.endswith(format):
                 file_path += format
         else:
@@ -371,6 +382,7 @@ class DB:
         if format in ['.json']: type = 'obj'
         if format in ['.txt']:  type = 'txt'
         if format in ['.png']:  type = 'image'
+        if format in ['.pkl']:  type = 'pickle'
 
         if not type or not format:
             print(f"Logic error: DB.save_data, type={type}, format={format}")
@@ -396,7 +408,11 @@ class DB:
                 elif format == '.png':
                     buff = s3utils.read_buff_from_s3path(file_path)
                     img_array = np.asarray(bytearray(buff), dtype=np.uint8)
+                    import cv2
                     return cv2.imdecode(img_array, 0)
+                elif format == '.pkl':
+                    buff = s3utils.read_buff_from_s3path(file_path)
+                    return pickle.loads(buff)
                 else:
                     print(f"Logic error, {format} not supported: DB.load_data")
                     sys.exit(1)
@@ -423,7 +439,11 @@ class DB:
                         with open(file_path, 'r') as file:
                             return file.read()
                     elif format == '.png':
+                        import cv2
                         return cv2.imread(file_path, 0)
+                    elif format == '.pkl':
+                        with open(file_path, 'rb') as file:
+                            return pickle.load(file)
                     else:
                         print(f"Logic error: format {format} not supported in DB.load_data")
                         sys.exit(1)
@@ -463,6 +483,49 @@ class DB:
                 sys.exit(1)
 
 
+    @staticmethod
+    def load_data_cached(dirname, name, subdir=None, s3flag=None, **kwargs):
+        """ load_data() for job files that are read by every chunk, such as styles/roismap.csv.
+            The data is kept in JOB_DATA_CACHE so a warm lambda container, which runs
+            many chunks of the same job, reads and parses the file only once.
+            The cached data is used only while the hash of the file (the ETag on s3) is unchanged,
+            and the job_name is part of the key because a container may process more than one job.
+            name must include the extension. The data returned is shared and must not be modified.
+        """
+        dirpath = DB.dirpath_from_dirname(dirname, subdir=subdir, s3flag=s3flag)
+        key = (args.argsdict.get('job_name', ''), f"{dirpath}{name}", repr(sorted(kwargs.items())))
+
+        file_hash = DB.get_file_hash(dirname, name, subdir=subdir, s3flag=s3flag)
+        cached = DB.JOB_DATA_CACHE.get(key)
+        if file_hash is not None and cached is not None and cached[0] == file_hash:
+            return cached[1]
+
+        data = DB.load_data(dirname, name, subdir=subdir, s3flag=s3flag, **kwargs)
+        if file_hash is not None and data is not None:
+            DB.JOB_DATA_CACHE[key] = (file_hash, data)
+        return data
+
+
+    @staticmethod
+    def load_data_range(dirname, name, offset, length, subdir=None, s3flag=None) -> bytes:
+        """ read length bytes starting at offset of the file, such as one chunk of a packed file.
+            On s3, this is a single ranged read so the rest of the object is not transferred.
+        """
+        from aws_lambda import s3utils
+
+        dirpath = DB.dirpath_from_dirname(dirname, subdir=subdir, s3flag=s3flag)
+        file_path = f"{dirpath}{name}"
+        print(f"Reading {length} bytes at {offset} of {file_path}")       # this cannot use utils.sts
+
+        if file_path.startswith('s3'):
+            return s3utils.read_range_from_s3path(file_path, offset, length)
+
+        file_path = utils.path_sep_per_os(file_path)
+        with open(file_path, 'rb') as fh:
+            fh.seek(offset)
+            return fh.read(length)
+
+
     @staticmethod
     def save_data(data_item, dirname, name, format='.json', type=None, subdir=None, s3flag=None) -> str:
         """ save data_item at dirname, subdir, name with format, type specified.
@@ -477,10 +540,10 @@ class DB:
             
         extension = os.path.splitext(name)[1]
         
-        if extension in ['.json', '.csv', '.png', '.pdf', '.txt']:
+        if extension in ['.json', '.csv', '.png', '.pdf', '.txt', '.pkl', '.bin']:
             format = extension
             
-        if format in ['.json', '.csv', '.png', '.pdf', '.txt']:
+        if format in ['.json', '.csv', '.png', '.pdf', '.txt', '.pkl', '.bin']:
             if not extension:
                 file_path += format
         else:
@@ -491,9 +554,12 @@ class DB:
         if format == '.png':
             type = 'image'
             
-        if format == '.pdf':
+        if format in ['.pdf', '.bin']:
             type = 'binary'
             
+        if format == '.pkl':
+            type = 'pickle'
+            
         if type is None and format in ['.csv']:
             type = 'df'
             
@@ -508,45 +574,50 @@ class DB:
             traceback.print_stack()
             sys.exit(1)
             
-        #--- convert data item to buffer
-        if format == '.csv' and type == 'lod':
-            df_item = pd.DataFrame(data_item, index=None)
-            buff = df_item.to_csv(None, index=False)
-
-        elif type == 'df':
-            if format == '.json':
-                buff = data_item.to_json(None, index=False)
-            elif format == '.csv':
-                buff = data_item.to_csv(None, index=False)
-            # elif format == '.xlsx':
-                # buff = pd.to_xlsx(data_item, index=False)
-            else:
-                print(f"Logic error: format {format} not supported with type df")
-                traceback.print_stack()
-                sys.exit(1)
+        with timing.span('csv_save' if format == '.csv' else 'save'):
+            #--- convert data item to buffer
+            if format == '.csv' and type == 'lod':
+                df_item = pd.DataFrame(data_item, index=None)
+                buff = df_item.to_csv(None, index=False)
+
+            elif type == 'df':
+                if format == '.json':
+                    buff = data_item.to_json(None, index=False)
+                elif format == '.csv':
+                    buff = data_item.to_csv(None, index=False)
+                # elif format == '.xlsx':
+                    # buff = pd.to_xlsx(data_item, index=False)
+                else:
+                    print(f"Logic error: format {format} not supported with type df")
+                    traceback.print_stack()
+                    sys.exit(1)
                 
-        elif type == 'obj' or type is None:
-            if format == '.json':
-                buff = json.dumps(data_item)
-            else:
-                print(f"Logic error: format {format} not supported with type obj")
-                traceback.print_stack()
-                sys.exit(1)
+            elif type == 'obj' or type is None:
+                if format == '.json':
+                    buff = json.dumps(data_item)
+                else:
+                    print(f"Logic error: format {format} not supported with type obj")
+                    traceback.print_stack()
+                    sys.exit(1)
                 
-        elif type == 'image':
-            buff = cv2.imencode(format, data_item)[1].tostring()
+            elif type == 'image':
+                import cv2
+                buff = cv2.imencode(format, data_item)[1].tostring()
+            
+            elif type == 'pickle':
+                buff = pickle.dumps(data_item, protocol=pickle.HIGHEST_PROTOCOL)
             
-        elif type in ['binary', 'txt']:
-            buff = data_item
+            elif type in ['binary', 'txt']:
+                buff = data_item
 
-        #--- write buffer based on path
-        if dirpath.startswith('s3'):
-            s3utils.write_buff_to_s3path(file_path, buff)
-        else:
-            file_path = utils.path_sep_per_os(file_path)
-            mode = 'wb' if type in ['binary','image'] else 'w'
-            with open(file_path, mode) as file:
-                file.write(buff)
+            #--- write buffer based on path
+            if dirpath.startswith('s3'):
+                s3utils.write_buff_to_s3path(file_path, buff)
+            else:
+                file_path = utils.path_sep_per_os(file_path)
+                mode = 'wb' if type in ['binary', 'image', 'pickle'] else 'w'
+                with open(file_path, mode) as file:
+                    file.write(buff)
         return file_path
         
 
@@ -704,6 +775,36 @@ class DB:
             return bool(os.path.isfile(file_path))
         
 
+    @staticmethod
+    def get_file_hash(dirname, name, subdir=None, s3flag=None):
+        """ return a string that changes when the content of the file changes.
+            For local files, this is the sha1 of the content. On s3, the ETag is used
+            so the object need not be downloaded.
+            returns None if the file does not exist.
+        """
+        dirpath = DB.dirpath_from_dirname(dirname, subdir=subdir, s3flag=s3flag)
+        file_path = f"{dirpath}{name}"
+
+        if file_path.startswith('s3'):
+            return s3utils.get_s3path_etag(file_path)
+
+        return DB.get_local_file_hash(utils.path_sep_per_os(file_path))
+
+
+    @staticmethod
+    def get_local_file_hash(file_path):
+        """ return the sha1 of the content of a local file, or None if it does not exist. 
+            Unlike the modification time, this does not change when the file is copied or downloaded again.
+        """
+        if not os.path.isfile(file_path):
+            return None
+        sha1 = hashlib.sha1()
+        with open(file_path, 'rb') as fh:
+            for block in iter(lambda: fh.read(1 << 20), b''):
+                sha1.update(block)
+        return sha1.hexdigest()
+
+
     @staticmethod
     def update_dict(dirname, name, field, value, subdir=None):
         d_dict = DB.load_data(dirname=dirname, name=name, subdir=subdir)
@@ -747,7 +848,7 @@ class DB:
         
         if not args.argsdict['use_s3_results']:
             # merge locally
-            utils.merge_csv_dirname_local(dirname=dirname, dest_name=dest_name, file_pat=file_pat)
+            utils.merge_csv_dirname_local(dirname=dirname, subdir=subdir, dest_name=dest_name, file_pat=file_pat)
         else:   
             # download all the CSV files
             # make sure tmp is empty.
@@ -953,7 +1054,7 @@ class DB:
                     
         else:   
             try:
-                df = pd.read_csv(file_path, na_filter=False, index_col=False).replace(np.nan, '', regex=True)
+                df = pd.read_csv(file_path, na_filter=False, index_col=False, dtype=dtype).replace(np.nan, '', regex=True)
             except FileNotFoundError:
                 if silent_error: 
                     return None
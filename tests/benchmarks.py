@@ -0,0 +1,490 @@
+""" benchmarks.py -- offline benchmarks of the extraction and comparison hot paths.
+
+    python tests/benchmarks.py [--ballots N] [--contests N] [--options N] [--chunks N]
+                               [--stages extract,compare] [--output results.json]
+                               [--compare prior_results.json] [--align-samples DIR] [--verbose]
+
+    All inputs are synthetic and generated from a fixed seed: ballot images with filled
+    targets, the rois map of one style, and the corresponding marks and CVR tables.
+    No election data, network or AWS access is needed.
+
+    Each stage is run in a separate process so that the peak RSS reported applies only
+    to that stage. Only the call of interest is timed, not generation of the inputs.
+    Save results with --output and compare a later commit against them with --compare.
+
+    Stages:
+        extract         analyze_images_by_style_rois_map_df, the mark extraction core of
+                        extract_vote_from_ballot after alignment and barcode reading.
+        thresholds      evaluate_thresholds on the marks of each ballot.
+        compare         compare_chunk_with_cvr of one marks chunk against the CVR.
+        genreport       genreport on the combined marks.csv.
+        combine         DB.combine_dirname_chunks of marks chunks.
+        align           ess_find_corner_points, full resolution search of the ES&S frame corners.
+        align_pyramid   ess_find_corner_points_pyramid, the coarse-to-fine search. Fails if any
+                        corner differs from the full resolution search by more than
+                        ALIGN_TOLERANCE_PX. Use --align-samples DIR to run both align stages on
+                        sample ballot page images instead of synthetic pages.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import traceback
+import subprocess
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+try:
+    import resource
+except ImportError:
+    resource = None     # not available on windows; peak rss is not reported.
+
+STAGE_NAMES = ['extract', 'thresholds', 'compare', 'genreport', 'combine', 'align', 'align_pyramid']
+
+PAGE_W = 1700           # 8.5 x 11 at 200 dpi
+PAGE_H = 2200
+TARGET_W = 20           # filled area of a marked target
+TARGET_H = 14
+FIRST_TARGET_Y = 300
+TARGET_PITCH_Y = 55     # nominal ES&S timing mark period
+COLUMN_XS = [150, 700, 1250]
+ESS_SCAN_W = 1760       # unaligned ES&S scan, slightly larger than the aligned resolution.
+ESS_SCAN_H = 2880
+ALIGN_TOLERANCE_PX = 1
+
+
+#--- synthetic data ------------------------------------------------------
+
+def contest_names(params):
+    return [f"Contest {'%3.3u' % idx}" for idx in range(params['contests'])]
+
+
+def option_names(params):
+    return [f"Candidate {idx}" for idx in range(params['options'])]
+
+
+def build_contests_dod(params):
+    return {contest: {'official_options_list': option_names(params), 'vote_for': 1}
+            for contest in contest_names(params)}
+
+
+def build_votes(params):
+    """ returns lod, one dict per ballot:
+            {'ballot_id': int, 'precinct': str, 'selections': {contest: option_idx}}
+        option_idx is None for undervote, -1 for overvote.
+        Also 'cvr_disagrees' marks ballots where the CVR will differ from the marks.
+    """
+    rng = random.Random(params['seed'])
+    votes_lod = []
+    for ballot_idx in range(params['ballots']):
+        selections = {}
+        for contest in contest_names(params):
+            roll = rng.random()
+            if roll < 0.10:
+                selections[contest] = None
+            elif roll < 0.12:
+                selections[contest] = -1
+            else:
+                selections[contest] = rng.randrange(params['options'])
+        votes_lod.append({
+            'ballot_id':        100000 + ballot_idx,
+            'precinct':         f"P-{'%3.3u' % (ballot_idx % 50)}",
+            'selections':       selections,
+            'cvr_disagrees':    rng.random() < 0.02,
+            })
+    return votes_lod
+
+
+def target_location(params, contest_idx, option_idx):
+    """ returns page, target_x, target_y of the option, or of the contest header if option_idx is None """
+    rows_per_contest = params['options'] + 1
+    rows_per_column = (PAGE_H - FIRST_TARGET_Y - 100) // TARGET_PITCH_Y
+    contests_per_column = max(1, rows_per_column // rows_per_contest)
+    contests_per_page = contests_per_column * len(COLUMN_XS)
+
+    page = (contest_idx // contests_per_page) % 2
+    slot = contest_idx % contests_per_page
+    column = slot // contests_per_column
+    row = (slot % contests_per_column) * rows_per_contest + (0 if option_idx is None else option_idx + 1)
+    return page, COLUMN_XS[column], FIRST_TARGET_Y + row * TARGET_PITCH_Y
+
+
+def build_rois_map_df(params):
+    import pandas as pd
+    rois_map_lod = []
+    for contest_idx, contest in enumerate(contest_names(params)):
+        page, target_x, target_y = target_location(params, contest_idx, None)
+        rois_map_lod.append({'style_num': 1, 'contest': contest, 'option': '#contest vote_for=1',
+            'roi_coord_csv': '', 'target_x': target_x, 'target_y': target_y, 'ev_coord_str': '', 'p': page})
+        for option_idx, option in enumerate(option_names(params)):
+            page, target_x, target_y = target_location(params, contest_idx, option_idx)
+            rois_map_lod.append({'style_num': 1, 'contest': contest, 'option': option,
+                'roi_coord_csv': '', 'target_x': target_x, 'target_y': target_y, 'ev_coord_str': '', 'p': page})
+    return pd.DataFrame(rois_map_lod)
+
+
+def build_ballot_images(params, ballot_votes):
+    import numpy as np
+    images = [np.full((PAGE_H, PAGE_W), 255, dtype=np.uint8) for _ in range(2)]
+    for contest_idx, contest in enumerate(contest_names(params)):
+        selection = ballot_votes['selections'][contest]
+        if selection is None:
+            continue
+        marked = [0, 1] if selection == -1 else [selection]
+        for option_idx in marked:
+            page, target_x, target_y = target_location(params, contest_idx, option_idx)
+            images[page][target_y - TARGET_H // 2 : target_y + TARGET_H // 2,
+                         target_x - TARGET_W // 2 : target_x + TARGET_W // 2] = 0
+    return images
+
+
+def build_ess_scan_pages(params):
+    """ unaligned ES&S pages with frame marks at the corners, timing marks, text and scanner noise,
+        slightly rotated and shifted. If params['align_samples'] is a folder, its images are used instead.
+    """
+    import numpy as np
+    import cv2
+
+    if params.get('align_samples'):
+        sample_dir = params['align_samples']
+        pages = [cv2.imread(os.path.join(sample_dir, name), cv2.IMREAD_GRAYSCALE) for name in sorted(os.listdir(sample_dir))]
+        return [page for page in pages if page is not None]
+
+    rng = random.Random(params['seed'])
+    noise_rng = np.random.default_rng(params['seed'])
+    pages = []
+    for _ in range(params['ballots']):
+        page = np.full((ESS_SCAN_H, ESS_SCAN_W), 255, dtype=np.uint8)
+        for x, y in [(20, 30), (1700, 30), (20, 2800), (1700, 2800)]:
+            page[y:y + 24, x:x + 30] = 0
+        for y in range(100, 2750, TARGET_PITCH_Y):
+            page[y:y + 10, 20:50] = 0
+            page[y:y + 10, 1700:1730] = 0
+        for _ in range(400):
+            x, y = rng.randrange(100, 1600), rng.randrange(100, 2750)
+            page[y:y + rng.randrange(2, 14), x:x + rng.randrange(2, 40)] = rng.randrange(0, 200)
+        matrix = cv2.getRotationMatrix2D((ESS_SCAN_W / 2, ESS_SCAN_H / 2), rng.uniform(-1, 1), 1.0)
+        matrix[:, 2] += [rng.uniform(-10, 10), rng.uniform(-10, 10)]
+        page = cv2.warpAffine(page, matrix, (ESS_SCAN_W, ESS_SCAN_H), borderValue=255)
+        pages.append(cv2.subtract(page, noise_rng.integers(0, 4, page.shape, dtype=np.uint8)))
+    return pages
+
+
+def build_marks_lod(params, votes_lod):
+    """ marks records as produced by extraction for the ballots in votes_lod """
+    options = option_names(params)
+    marks_lod = []
+    for ballot_votes in votes_lod:
+        for contest in contest_names(params):
+            selection = ballot_votes['selections'][contest]
+            common = {'ballot_id': ballot_votes['ballot_id'], 'style_num': '1', 'style': '1',
+                      'precinct': ballot_votes['precinct'], 'contest': contest, 'writein_name': '',
+                      'ssidx': 0, 'delta_y': 0, 'ev_coord_str': '', 'ev_precinct_id': 0}
+            marks_lod.append({**common, 'option': '#contest vote_for=1', 'has_indication': '',
+                'num_marks': 0, 'num_votes': 0, 'pixel_metric_value': 0,
+                'overvotes': int(selection == -1), 'undervotes': int(selection is None)})
+            for option_idx, option in enumerate(options):
+                is_marked = selection == option_idx or (selection == -1 and option_idx < 2)
+                marks_lod.append({**common, 'option': option,
+                    'has_indication': 'DefiniteMark' if is_marked else 'NoMark',
+                    'num_marks': int(is_marked), 'num_votes': int(is_marked and selection != -1),
+                    'pixel_metric_value': 280 if is_marked else 12, 'overvotes': 0, 'undervotes': 0})
+    return marks_lod
+
+
+def build_cvr_df(params, votes_lod):
+    import pandas as pd
+    options = option_names(params)
+    cvr_lod = []
+    for ballot_votes in votes_lod:
+        cvr_dict = {'Cast Vote Record': ballot_votes['ballot_id'], 'Precinct': ballot_votes['precinct'], 'Style': '1'}
+        for contest in contest_names(params):
+            selection = ballot_votes['selections'][contest]
+            if ballot_votes['cvr_disagrees'] and selection is not None and selection >= 0:
+                selection = (selection + 1) % params['options']
+            if selection is None:
+                cvr_dict[contest] = 'undervote'
+            elif selection == -1:
+                cvr_dict[contest] = 'overvote'
+            else:
+                cvr_dict[contest] = options[selection]
+        cvr_lod.append(cvr_dict)
+    return pd.DataFrame(cvr_lod)
+
+
+#--- stages --------------------------------------------------------------
+# each stage prepares its inputs and returns (num_ballots, num_rows, seconds)
+
+def stage_extract(argsdict, params):
+    from utilities.analysis_utils import analyze_images_by_style_rois_map_df
+    from models.Ballot import Ballot
+
+    rois_map_df = build_rois_map_df(params)
+    ballots = []
+    for ballot_votes in build_votes(params):
+        ballot = Ballot(argsdict, file_paths=[f"{ballot_votes['ballot_id']}i.png"],
+            ballot_id=str(ballot_votes['ballot_id']), vendor='ES&S', precinct=ballot_votes['precinct'],
+            party='none', group='none', extension='.png')
+        ballot.ballotdict['style_num'] = '1'
+        ballot.ballotimgdict['images'] = build_ballot_images(params, ballot_votes)
+        ballots.append(ballot)
+
+    start = time.perf_counter()
+    num_rows = 0
+    for ballot in ballots:
+        ballot_marks_df = analyze_images_by_style_rois_map_df(argsdict, ballot, rois_map_df)
+        num_rows += len(ballot_marks_df.index)
+    return len(ballots), num_rows, time.perf_counter() - start
+
+
+def stage_thresholds(argsdict, params):
+    from utilities.analysis_utils import evaluate_thresholds
+    from models.Ballot import Ballot
+
+    votes_lod = build_votes(params)
+    marks_lod = build_marks_lod(params, votes_lod)
+    ballot_marks_lolod = [[] for _ in votes_lod]
+    for marks_dict in marks_lod:
+        ballot_marks_lolod[marks_dict['ballot_id'] - 100000].append(marks_dict)
+    ballot = Ballot(argsdict, file_paths=['0i.png'], ballot_id='0', vendor='ES&S',
+        precinct='none', party='none', group='none', extension='.png')
+
+    start = time.perf_counter()
+    for ballot_marks_lod in ballot_marks_lolod:
+        evaluate_thresholds(ballot, ballot_marks_lod)
+    return len(votes_lod), len(marks_lod), time.perf_counter() - start
+
+
+def stage_compare(argsdict, params):
+    import pandas as pd
+    from utilities.cvr_comparator import compare_chunk_with_cvr
+
+    votes_lod = build_votes(params)
+    audit_df = pd.DataFrame(build_marks_lod(params, votes_lod))
+    cvr_df = build_cvr_df(params, votes_lod)
+    contests_dod = build_contests_dod(params)
+
+    start = time.perf_counter()
+    compare_chunk_with_cvr(argsdict, contests_dod, cvr_df, audit_df, chunk_name='benchmark_chunk_0000')
+    return len(votes_lod), len(audit_df.index), time.perf_counter() - start
+
+
+def stage_genreport(argsdict, params):
+    import pandas as pd
+    from models.DB import DB
+    from utilities.extract_utils import genreport
+
+    votes_lod = build_votes(params)
+    marks_df = pd.DataFrame(build_marks_lod(params, votes_lod)).drop(columns=['style'])
+    DB.save_data(data_item=marks_df, dirname='marks', name='marks.csv')
+    DB.save_data(data_item=build_contests_dod(params), dirname='styles', name='contests_dod.json')
+
+    start = time.perf_counter()
+    genreport(argsdict)
+    return len(votes_lod), len(marks_df.index), time.perf_counter() - start
+
+
+def stage_combine(argsdict, params):
+    import pandas as pd
+    from models.DB import DB
+
+    votes_lod = build_votes(params)
+    marks_df = pd.DataFrame(build_marks_lod(params, votes_lod)).drop(columns=['style'])
+    rows_per_chunk = -(-len(marks_df.index) // params['chunks'])
+    for chunk_idx in range(params['chunks']):
+        chunk_df = marks_df.iloc[chunk_idx * rows_per_chunk : (chunk_idx + 1) * rows_per_chunk]
+        DB.save_data(data_item=chunk_df, dirname='marks', name=f"marks_benchmark_chunk_{'%4.4u' % chunk_idx}.csv")
+
+    start = time.perf_counter()
+    DB.combine_dirname_chunks(dirname='marks', dest_name='marks.csv')
+    seconds = time.perf_counter() - start
+
+    combined_df = DB.load_data(dirname='marks', name='marks.csv', silent_error=True)
+    if combined_df is None or len(combined_df.index) != len(marks_df.index):
+        raise RuntimeError("combined marks.csv does not include all rows of the chunks.")
+    return len(votes_lod), len(marks_df.index), seconds
+
+
+def stage_align(argsdict, params):
+    from utilities.alignment_utils import ess_find_corner_points
+
+    pages = build_ess_scan_pages(params)
+    start = time.perf_counter()
+    for page in pages:
+        ess_find_corner_points(page)
+    return len(pages), len(pages) * 4, time.perf_counter() - start
+
+
+def stage_align_pyramid(argsdict, params):
+    import numpy as np
+    from utilities.alignment_utils import ess_find_corner_points, ess_find_corner_points_pyramid
+
+    pages = build_ess_scan_pages(params)
+    start = time.perf_counter()
+    pyramid_points = [ess_find_corner_points_pyramid(page) for page in pages]
+    seconds = time.perf_counter() - start
+
+    for page_idx, page in enumerate(pages):
+        if pyramid_points[page_idx] is None:
+            continue    # ess_align_images falls back to the full page.
+        deviation = np.abs(np.float32(ess_find_corner_points(page)) - np.float32(pyramid_points[page_idx])).max()
+        if deviation > ALIGN_TOLERANCE_PX:
+            raise RuntimeError(f"page {page_idx}: pyramid corner points deviate by {deviation} pixels.")
+    return len(pages), len(pages) * 4, seconds
+
+
+STAGE_FUNCTIONS = {
+    'extract':      stage_extract,
+    'thresholds':   stage_thresholds,
+    'compare':      stage_compare,
+    'genreport':    stage_genreport,
+    'combine':      stage_combine,
+    'align':        stage_align,
+    'align_pyramid': stage_align_pyramid,
+    }
+
+
+#--- stage process -------------------------------------------------------
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macos reports bytes.
+    return round(maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def setup_job(job_folder_path):
+    """ initialize argsdict with defaults from arg_specs.csv and a local job folder """
+    from utilities import args
+    from models.DB import DB
+
+    # arg_specs is read by absolute path so the working directory, and the repo, are not written.
+    argsdict = {'source': [], 'eif': 'benchmark_eif.csv', 'election_name': 'BENCHMARK', 'vendor': 'ES&S'}
+    args.check_args(argsdict, args.read_argspecs_dod(os.path.join(REPO_ROOT, args.ARG_SPECS_PATH)))
+    argsdict['job_folder_path'] = os.path.join(job_folder_path, '')
+    argsdict['use_s3_results'] = False
+    argsdict['use_s3_archives'] = False
+    argsdict['use_lambdas'] = False
+    argsdict['initial_cvr_cols'] = ['Cast Vote Record', 'Precinct', 'Style']
+    args.argsdict = argsdict
+    DB.MODE = 'local'
+    return argsdict
+
+
+def run_stage(stage_name, params, result_path):
+    """ run in the stage process. Writes result dict as json to result_path """
+    result = {'stage': stage_name}
+    try:
+        with tempfile.TemporaryDirectory() as job_folder_path:
+            argsdict = setup_job(job_folder_path)
+            num_ballots, num_rows, seconds = STAGE_FUNCTIONS[stage_name](argsdict, params)
+        result.update({
+            'ballots':          num_ballots,
+            'rows':             num_rows,
+            'seconds':          round(seconds, 4),
+            'ballots_per_sec':  round(num_ballots / seconds, 2) if seconds else None,
+            'rows_per_sec':     round(num_rows / seconds, 1) if seconds else None,
+            })
+    except Exception:
+        result['error'] = traceback.format_exc()
+    result['peak_rss_mb'] = peak_rss_mb()
+    with open(result_path, 'w') as fh:
+        json.dump(result, fh)
+
+
+def run_stage_process(stage_name, params, verbose=False):
+    """ run one stage in a fresh python process and return its result dict """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        result_path = os.path.join(tmpdir, 'result.json')
+        cmd = [sys.executable, os.path.abspath(__file__), '--run-stage', stage_name, '--result-path', result_path,
+               '--params', json.dumps(params)]
+        output = None if verbose else subprocess.DEVNULL
+        subprocess.run(cmd, stdout=output, stderr=output)
+        try:
+            with open(result_path) as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return {'stage': stage_name, 'error': 'stage process did not produce a result.'}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT,
+                              capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ''
+
+
+#--- reporting -----------------------------------------------------------
+
+def print_results(results, prior_results=None):
+    prior_stages = {r['stage']: r for r in prior_results['stages']} if prior_results else {}
+    print(f"\ncommit {results['commit']}  params {json.dumps(results['params'])}")
+    print("%-12s %10s %10s %12s %10s %12s" % ('stage', 'seconds', 'ballots/s', 'rows/s', 'peak MB', 'vs prior'))
+    for result in results['stages']:
+        if 'error' in result:
+            print("%-12s ERROR: %s" % (result['stage'], result['error'].strip().splitlines()[-1]))
+            continue
+        ratio_str = ''
+        prior = prior_stages.get(result['stage'])
+        if prior and prior.get('rows_per_sec') and result.get('rows_per_sec'):
+            ratio_str = "%.2fx" % (result['rows_per_sec'] / prior['rows_per_sec'])
+        print("%-12s %10.3f %10.1f %12.1f %10s %12s" % (result['stage'], result['seconds'],
+            result['ballots_per_sec'] or 0, result['rows_per_sec'] or 0, result['peak_rss_mb'], ratio_str))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='offline benchmarks of extraction and comparison hot paths')
+    parser.add_argument('--ballots', type=int, default=200, help='number of synthetic ballots')
+    parser.add_argument('--contests', type=int, default=20, help='number of contests per ballot')
+    parser.add_argument('--options', type=int, default=4, help='number of options per contest')
+    parser.add_argument('--chunks', type=int, default=10, help='number of chunks for the combine stage')
+    parser.add_argument('--seed', type=int, default=1, help='seed for synthetic data')
+    parser.add_argument('--stages', default=','.join(STAGE_NAMES), help='comma separated list of stages to run')
+    parser.add_argument('--output', help='save results to this json file')
+    parser.add_argument('--compare', help='json file of prior results to compare against')
+    parser.add_argument('--align-samples', help='folder of sample ballot page images for the align stages')
+    parser.add_argument('--verbose', action='store_true', help='show output of the stages')
+    parser.add_argument('--run-stage', help=argparse.SUPPRESS)
+    parser.add_argument('--result-path', help=argparse.SUPPRESS)
+    parser.add_argument('--params', help=argparse.SUPPRESS)
+    cli_args = parser.parse_args()
+
+    if cli_args.run_stage:
+        run_stage(cli_args.run_stage, json.loads(cli_args.params), cli_args.result_path)
+        return
+
+    params = {'ballots': cli_args.ballots, 'contests': cli_args.contests, 'options': cli_args.options,
+              'chunks': cli_args.chunks, 'seed': cli_args.seed, 'align_samples': cli_args.align_samples}
+    stage_names = [s.strip() for s in cli_args.stages.split(',') if s.strip()]
+    unknown_stages = [s for s in stage_names if s not in STAGE_FUNCTIONS]
+    if unknown_stages:
+        parser.error(f"unknown stages {unknown_stages}, choose from {STAGE_NAMES}")
+
+    results = {'commit': git_commit(), 'params': params, 'stages': []}
+    for stage_name in stage_names:
+        print(f"running {stage_name}...")
+        results['stages'].append(run_stage_process(stage_name, params, verbose=cli_args.verbose))
+
+    prior_results = None
+    if cli_args.compare:
+        with open(cli_args.compare) as fh:
+            prior_results = json.load(fh)
+        if prior_results.get('params') != params:
+            print(f"WARNING: prior results used different params {prior_results.get('params')}")
+
+    print_results(results, prior_results)
+
+    if cli_args.output:
+        with open(cli_args.output, 'w') as fh:
+            json.dump(results, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,17 @@
+import os
+import sys
+import json
+import subprocess
+
 import pytest
+import numpy as np
+import pandas as pd
 
-from utilities import style_utils, barcode_parser
+from utilities import style_utils, barcode_parser, alignment_utils, images_utils
+from models.CVR import CVR
+from utilities import literal_fuzzy_matching_utils as lfm
+from utilities import analysis_utils
+from utilities import timing
 
 
 class TestSanitizeString:
@@ -34,3 +45,328 @@ class TestHexCodeParser:
             parsed_hex_code = barcode_parser.get_parsed_barcode(hex_code)
             assert parsed_hex_code == style_number,\
                 f'parsed code {parsed_hex_code} is not equal style number {style_number}'
+
+
+class TestSelectCvrShards:
+    SHARDS = [
+        {'shard_name': 'cvr_shard_0000', 'ballot_id_low': 100, 'ballot_id_high': 199, 'num_ballots': 100},
+        {'shard_name': 'cvr_shard_0001', 'ballot_id_low': 200, 'ballot_id_high': 299, 'num_ballots': 100},
+        {'shard_name': 'cvr_shard_0002', 'ballot_id_low': 300, 'ballot_id_high': 399, 'num_ballots': 100},
+    ]
+
+    def test_only_touched_shards_selected(self):
+        assert CVR.select_cvr_shards(self.SHARDS, ['250', 201, 299]) == ['cvr_shard_0001']
+        assert CVR.select_cvr_shards(self.SHARDS, [399, 100]) == ['cvr_shard_0000', 'cvr_shard_0002']
+
+    def test_ballot_ids_outside_all_ranges(self):
+        assert CVR.select_cvr_shards(self.SHARDS, [5, 400]) == []
+
+
+class TestContestsPerStyle:
+    CVR_DF = pd.DataFrame({
+        'Ballot Style': ['1', '2', '1', '3'],
+        'Mayor':        ['Smith', None, None, 'Jones'],
+        'Sheriff':      [None, 'Brown', None, None],
+        'Measure A':    [None, None, 'Yes', 'No'],
+    })
+
+    def test_contests_with_any_value_per_style(self):
+        contests = ['Mayor', 'Sheriff', 'Measure A']
+        assert dict(CVR.get_contests_per_style(contests, self.CVR_DF, ['1', '2', '3'])) == {
+            '1': ['Mayor', 'Measure A'],
+            '2': ['Sheriff'],
+            '3': ['Mayor', 'Measure A'],
+        }
+
+    def test_missing_style_has_no_contests(self):
+        cvr_df = self.CVR_DF.copy()
+        cvr_df.loc[3, 'Ballot Style'] = np.nan
+        styles = list(cvr_df['Ballot Style'].unique()) + ['4']
+        contests_per_style = CVR.get_contests_per_style(['Mayor', 'Sheriff', 'Measure A'], cvr_df, styles)
+        assert [contests_per_style[style] for style in styles] == [['Mayor', 'Measure A'], ['Sheriff'], [], []]
+
+
+class TestFuzzyMetrics:
+    CORRECT = ['Bill', 'John', 'Gary', 'Mary', 'William']
+
+    def test_matrix_matches_pairwise_comparison(self):
+        ocr_strlist = ['Wiliam Smith', 'J0hn', '', 'Mary']
+        matrix = lfm.fuzzy_metrics_matrix(self.CORRECT, ocr_strlist, 'best_of_all')
+        for row, ocr_str in enumerate(ocr_strlist):
+            for col, correct_str in enumerate(self.CORRECT):
+                expected = 0 if not ocr_str else max(
+                    lfm.fuzzy_compare_str(correct_str, ocr_str, 0, justify=justify)[1] for justify in ('full', 'left', 'right'))
+                assert matrix[row][col] == pytest.approx(expected)
+
+    def test_permuted_strsets(self):
+        assert lfm.fuzzy_compare_permuted_strsets(
+            self.CORRECT, ['William', 'John', 'Bill', 'Mary', 'Gary'], 0.9) == (True, 1.0, [4, 1, 0, 3, 2])
+
+    def test_permuted_strsets_resolves_conflicting_best_matches(self):
+        # the first ocr string is the best match of both options, so only the total metric resolves the mapping.
+        assert lfm.fuzzy_compare_permuted_strsets(
+            ['Jon Smith', 'John Smithe'], ['John Smith', 'Jon Smit'], 0.7)[2] == [1, 0]
+
+
+class TestImageAccumulator:
+    LAYERS = [np.full((4, 4), value, dtype=np.uint8) for value in (10, 20, 30, 240)]
+
+    def test_mean_divides_once(self):
+        accumulator = style_utils.new_image_accumulator('mean')
+        for layer in self.LAYERS:
+            style_utils.add_image_to_accumulator(accumulator, layer)
+        assert accumulator['sum'].dtype == np.float32
+        assert (accumulator['sum'] / accumulator['count'] == 75).all()
+
+    def test_median_discards_outlier_layer(self):
+        layers = [layer.copy() for layer in self.LAYERS]
+        layers[3][0, 0] = 0
+        accumulator = style_utils.new_image_accumulator('median')
+        for layer in layers:
+            style_utils.add_image_to_accumulator(accumulator, layer)
+        combined = style_utils.get_accumulated_image(accumulator)
+        assert combined[0, 0] == combined.min() and combined[1, 1] == 255
+
+
+class TestPyramidAlignment:
+    @staticmethod
+    def ess_page():
+        page = np.full((2880, 1760), 255, dtype=np.uint8)
+        for x, y in [(20, 30), (1700, 30), (20, 2800), (1700, 2800)]:
+            page[y:y + 24, x:x + 30] = 0
+        page[1000:1012, 300:900] = 0
+        return page
+
+    def test_pyramid_matches_full_resolution(self):
+        page = self.ess_page()
+        full_points = np.float32(alignment_utils.ess_find_corner_points(page))
+        pyramid_points = np.float32(alignment_utils.ess_find_corner_points_pyramid(page))
+        assert np.abs(full_points - pyramid_points).max() <= 1
+        assert full_points.tolist()[0] == [21, 30]
+
+    def test_pyramid_reports_missing_corner(self):
+        page = self.ess_page()
+        page[2800:2824, 1700:1730] = 255
+        assert alignment_utils.ess_find_corner_points_pyramid(page) is None
+
+    def test_dominion_bands_are_exact(self):
+        page = np.full((2600, 1700), 255, dtype=np.uint8)
+        page[60:120, 40:150] = 0
+        page[380:470, 600:640] = 0
+        page[2450:2510, 40:150] = 0
+        full = alignment_utils.dominion_erode_dilate_contours(page.copy(), 2600, 1700, restrict_to_bands=False)
+        bands = alignment_utils.dominion_erode_dilate_contours(page.copy(), 2600, 1700)
+        assert np.array_equal(full, bands)
+
+
+class TestTimingMarkPrior:
+    @staticmethod
+    def ess_page():
+        page = np.full((2832, 1728), 255, dtype=np.uint8)
+        for y in range(60, 2780, 55):
+            page[y:y + 28, 3:30] = 0
+            page[y:y + 28, 1700:1726] = 0
+        for x in range(60, 1680, 55):
+            page[2800:2828, x:x + 25] = 0
+        page[1000:1010, 200:1500] = 0
+        return page
+
+    def test_prior_gives_same_marks(self):
+        page = self.ess_page()
+        full = images_utils.ess_gen_timing_marks(page)
+        assert [len(full[key]) for key in ['left_vertical_marks', 'right_vertical_marks', 'top_marks']] == [50, 50, 30]
+        assert images_utils.ess_gen_timing_marks(page, full) == full
+
+    def test_wrong_prior_falls_back_to_full_page(self):
+        page = self.ess_page()
+        full = images_utils.ess_gen_timing_marks(page)
+        prior = {key: marks[:-1] for key, marks in full.items()}
+        prior['top_marks'] = [dict(mark, y=1000) for mark in prior['top_marks']]
+        assert images_utils.ess_gen_timing_marks(page, prior) == full
+
+
+class TestExpressVoteProfiles:
+    def test_noise_bottom_after_buffer_of_white_lines(self):
+        image = np.full((800, 1000), 255, dtype=np.uint8)
+        image[20:60, 400:600] = 0
+        assert images_utils.expressvote_noise_bottom(image) == 80
+        assert images_utils.expressvote_noise_bottom(np.full((800, 1000), 255, dtype=np.uint8)) == 0
+
+    def test_bottom_border_is_first_white_window(self):
+        image = np.full((1000, 1000), 255, dtype=np.uint8)
+        image[300:650, 250:750] = 0
+        image[700:720, 250:750] = 0
+        assert images_utils.expressvote_bottom_border(image) == 720
+        image[650:, 500] = 0
+        assert images_utils.expressvote_bottom_border(image) == 999
+
+
+class TestEvCoordMap:
+    STYLE_ROIS_MAP_DF = pd.DataFrame({
+        'contest':      ['Mayor', 'Mayor', 'Mayor', 'Mayor'],
+        'option':       ['#contest vote_for=1', 'Smith', 'Jones', 'writein_0'],
+        'ev_coord_str': ['', "'012301'", 12302, '012303'],
+    })
+
+    def test_map_of_normalized_barcodes(self):
+        style_index = analysis_utils.build_style_ev_coord_index(self.STYLE_ROIS_MAP_DF)
+        assert {ev_coord_str: entry[1] for ev_coord_str, entry in style_index['ev_coord_map'].items()} == {
+            '012301': 'Smith', '012302': 'Jones', '012303': 'writein_0'}
+
+    def test_incomplete_map_requires_ocr(self):
+        style_rois_map_df = self.STYLE_ROIS_MAP_DF.copy()
+        style_rois_map_df.loc[2, 'ev_coord_str'] = np.nan
+        assert not analysis_utils.build_style_ev_coord_index(style_rois_map_df)['complete']
+
+    def test_index_resolves_barcodes_to_rows(self):
+        style_index = analysis_utils.build_style_ev_coord_index(self.STYLE_ROIS_MAP_DF)
+        assert style_index['complete']
+        assert style_index['header_rows'] == [0]
+        assert style_index['ev_coord_map']['012302'] == ('Mayor', 'Jones', 2)
+
+    @pytest.mark.parametrize("ev_header_code", ['', '0123', 'QR' + '0' * 30, '0' * 25 + 'X'])
+    def test_invalid_header_code_is_rejected(self, ev_header_code):
+        class BallotStub:
+            ballotdict = {}
+        assert not analysis_utils.parse_ev_header_code(BallotStub, ev_header_code, [])
+        assert BallotStub.ballotdict == {}
+
+
+class TestTimingSpans:
+    def test_nested_span_of_same_name_counted_once(self):
+        timing.reset_spans()
+        with timing.span('chunk'):
+            with timing.span('ocr'):
+                with timing.span('ocr'):
+                    pass
+        spans = timing.get_spans_summary()
+        assert spans['ocr']['count'] == 1
+        assert spans['chunk']['total_secs'] >= spans['ocr']['total_secs']
+
+    def test_spans_in_other_threads_are_counted(self):
+        import threading
+        timing.reset_spans()
+        barrier = threading.Barrier(2)
+
+        def ocr_thread():
+            with timing.span('ocr'):
+                barrier.wait()
+
+        threads = [threading.Thread(target=ocr_thread) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert timing.get_spans_summary()['ocr']['count'] == 2
+
+    def test_combine_chunks(self):
+        phase_timing = timing.combine_timing_dicts([
+            {'chunk_name': 'a_chunk_0', 'spans': {'chunk': {'count': 1, 'total_secs': 2.0, 'max_secs': 2.0},
+                                                  'ocr': {'count': 3, 'total_secs': 1.5, 'max_secs': 1.0}}},
+            {'chunk_name': 'a_chunk_1', 'spans': {'chunk': {'count': 1, 'total_secs': 4.0, 'max_secs': 4.0}}},
+            ])
+        assert phase_timing['spans']['chunk'] == {'count': 2, 'total_secs': 6.0, 'max_secs': 4.0}
+        assert phase_timing['chunk_secs'] == {'a_chunk_0': 2.0, 'a_chunk_1': 4.0}
+
+
+class TestLambdaImports:
+    """ each lambda task imports only what it needs: modules that are slow to import
+        are imported on use, and the import of the task module stays within budget.
+    """
+    IMPORT_TIME_BUDGET_SECS = 2.0
+    SLOW_MODULES = ['fitz', 'scipy.optimize', 'dominate', 'pytesseract']
+    TASK_SLOW_MODULES_ALLOWED = {
+        'utilities.bif_utils':          [],
+        'utilities.votes_extractor':    [],
+        'utilities.cmpcvr':             [],
+        'utilities.gentemplates':       ['pytesseract'],
+    }
+    SCRIPT = (
+        "import sys, time, json\n"
+        "import lambda_main\n"
+        "start = time.perf_counter()\n"
+        "import {module_name}\n"
+        "print(json.dumps({{'secs': time.perf_counter() - start, 'modules': list(sys.modules)}}))\n"
+    )
+
+    @pytest.mark.parametrize("module_name", sorted(TASK_SLOW_MODULES_ALLOWED))
+    def test_task_imports(self, module_name):
+        repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.run(
+            [sys.executable, '-c', self.SCRIPT.format(module_name=module_name)],
+            cwd=repo_path, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        slow_modules = [name for name in self.SLOW_MODULES if name in result['modules']]
+        assert slow_modules == self.TASK_SLOW_MODULES_ALLOWED[module_name]
+        assert result['secs'] < self.IMPORT_TIME_BUDGET_SECS
+
+
+class TestJobDataCache:
+    def test_reload_only_when_file_changes(self, tmp_path, monkeypatch):
+        from utilities import args
+        from models.DB import DB
+        monkeypatch.setattr(args, 'argsdict', {'job_folder_path': f"{tmp_path}/", 'job_name': 'job', 'use_s3_results': False})
+        monkeypatch.setattr(DB, 'JOB_DATA_CACHE', {})
+        DB.save_data(data_item={'contest': 1}, dirname='styles', name='contests_dod.json')
+        first = DB.load_data_cached('styles', 'contests_dod.json')
+        assert DB.load_data_cached('styles', 'contests_dod.json') is first
+
+        DB.save_data(data_item={'contest': 2}, dirname='styles', name='contests_dod.json')
+        assert DB.load_data_cached('styles', 'contests_dod.json') == {'contest': 2}
+
+
+class TestPackedTasklists:
+    def test_tasklists_from_payload_or_ranged_read(self, tmp_path, monkeypatch):
+        from utilities import args, bif_utils
+        monkeypatch.setattr(args, 'argsdict', {'job_folder_path': f"{tmp_path}/", 'job_name': 'job', 'use_s3_results': False})
+        tasklists_dodf = {
+            f"archive_chunk_{'%4.4u' % idx}.csv": pd.DataFrame({'ballot_id': [idx * 10 + i for i in range(3 + idx)], 'style_num': ['1', '2', '3'] + ['4'] * idx})
+            for idx in range(3)}
+        bif_utils.save_packed_tasklists(tasklists_dodf, dirname='marks', subdir='tasks')
+        assert bif_utils.get_tasklist_names('marks', subdir='tasks') == list(tasklists_dodf)
+
+        for payload_max_bytes in [0, 1 << 16]:
+            tasklists = bif_utils.get_tasklists({'tasklist_payload_max_bytes': payload_max_bytes}, 'marks', subdir='tasks')
+            for tasklist_name, tasklist_spec in tasklists:
+                assert ('csv' in tasklist_spec) == bool(payload_max_bytes)
+                tasklist_df = bif_utils.load_tasklist_df('marks', tasklist_name, tasklist_spec, subdir='tasks')
+                assert tasklist_df['ballot_id'].tolist() == tasklists_dodf[tasklist_name]['ballot_id'].tolist()
+
+
+class TestBIFBallotIndex:
+    def test_lookup_and_update_by_ballot_id(self, monkeypatch):
+        from utilities import args
+        from models.BIF import BIF, set_bif_column_types
+        monkeypatch.setattr(args, 'argsdict', {})
+        monkeypatch.setattr(BIF, 'df', set_bif_column_types(pd.DataFrame({
+            'ballot_id': [101, 102, 103], 'style_num': ['1', '2', '1'], 'precinct': ['a', 'a', 'b'], 'is_bmd': ['0', '1', '']})))
+        assert str(BIF.df['is_bmd'].dtype) == 'int8' and str(BIF.df['style_num'].dtype) == 'category'
+        assert BIF.get_ballot_index('102') == 1 and BIF.get_ballot_index(104) is None
+        assert [BIF.is_bmd(ballot_id) for ballot_id in (101, 102, 103, 104)] == [False, True, False, False]
+
+        BIF.set_cell_value_by_ballot_id(103, column='is_bmd', value='1')
+        BIF.set_cell_value_by_ballot_id(103, column='style_num', value='3')
+        assert BIF.is_bmd(103) and BIF.get_cell_value_by_ballot_id(103, column='style_num') == '3'
+
+        monkeypatch.setattr(BIF, 'df', BIF.df.iloc[::-1].reset_index(drop=True))
+        assert BIF.get_ballot_index(101) == 2
+
+
+class TestOcrCacheDeltas:
+    def test_lambda_deltas_merged_into_persisted_cache(self, tmp_path, monkeypatch):
+        from utilities import args, ocr
+        monkeypatch.setattr(args, 'argsdict', {'job_folder_path': f"{tmp_path}/", 'job_name': 'job', 'use_s3_results': False})
+        ocr.configure_ocr_cache({})
+        ocr.ocr_cache.clear()
+        ocr.pop_new_ocr_cache_entries()
+        for style_num, value in [('1', 10), ('2', 20)]:
+            img = np.full((4, 4), value, dtype=np.uint8)
+            assert ocr.cached_ocr(img, 'config', lambda img: f"text {img[0, 0]}") == f"text {value}"
+            ocr.save_ocr_cache_delta(delta_name=style_num)
+
+        ocr.ocr_cache.clear()
+        assert ocr.merge_ocr_cache_deltas() == 2
+        ocr.ocr_cache.clear()
+        ocr.load_ocr_cache()
+        assert sorted(ocr.ocr_cache.values()) == ['text 10', 'text 20']
+        assert ocr.merge_ocr_cache_deltas() == 0
@@ -8,7 +8,6 @@ from pyzbar.pyzbar import decode as barcode_decode
 
 from utilities.config_d import config_dict
 from utilities.images_utils import ess_gen_timing_marks
-from utilities import ocr
 from utilities import utils, logs
 from models.DB import DB
 from utilities import args
@@ -29,8 +28,166 @@ recent_cut_points_0 = []
 recent_cut_points_1 = []
 num_recent_cut_points = 256
 
+PYRAMID_SCALE = 4           # downsampling factor of the coarse pass of pyramid alignment.
+PYRAMID_WINDOW_PAD = 16     # full resolution margin around each coarse candidate, in pixels.
+
+
+def ess_frame_contours(image, offset=(0, 0)):
+    """ threshold the image (or a window of it), remove lines overlying the edge bars
+        and return the contours. offset is the x,y location of the window in the page
+        so the contours are returned in page coordinates.
+    """
+    # defining threshold and reading contours
+    _, thresh = cv2.threshold(
+        image, config_dict['THRESHOLD']['frame-contours'], 255, 1)
+
+    # preventive deletion of the lines overlying the edge bars
+    kernel_line = np.ones((1, 6), np.uint8)
+    thresh = cv2.erode(thresh, kernel_line, iterations=1)
+    thresh = cv2.dilate(thresh, kernel_line, iterations=1)
+
+    contours, _ = cv2.findContours(thresh, 1, cv2.CHAIN_APPROX_SIMPLE, offset=offset)
+    return contours
+
+
+def is_in_ess_corner_region(x, y):
+    """ True if x, y is within one of the four corner regions where ES&S frame marks are found """
+    return (x > config_dict['EDGES_ROI']['right-border'] or x < config_dict['EDGES_ROI']['left-border']) \
+        and (y > config_dict['EDGES_ROI']['bottom-border'] or y < config_dict['EDGES_ROI']['top-border'])
+
+
 # pylint: disable=too-many-locals
 # Twenty six is reasonable in this case.
+def ess_search_corner_points(image, contours):
+    """ search the frame mark contours for the points nearest to the corners of the page.
+        returns list of points [left_top, right_top, left_bottom, right_bottom]
+        and True if each corner was found in its own corner region.
+    """
+    # setting up points and lengths for further search
+    left_top_point = (0, 0)
+    right_top_point = (0, 0)
+    left_bottom_point = (0, 0)
+    right_bottom_point = (0, 0)
+    left_top_length = config_dict['INITIAL_SEARCH_VALUES']
+    right_top_length = config_dict['INITIAL_SEARCH_VALUES']
+    left_bottom_length = config_dict['INITIAL_SEARCH_VALUES']
+    right_bottom_length = config_dict['INITIAL_SEARCH_VALUES']
+    # pylint: disable=too-many-nested-blocks
+    # Seven is reasonable in this case.
+    # iterating through contours
+    for cnt in contours:
+
+        # approximating shape of contour, its area and its mean
+        approx = cv2.approxPolyDP(cnt, config_dict['SHAPE_APPROX_VALUE']['code']
+                                  * cv2.arcLength(cnt, True), True)
+        area = cv2.contourArea(cnt)
+        x, y, w, h = cv2.boundingRect(cnt)
+        mean = sum(cv2.mean(image[y:y + h, x: x + w]))
+
+        # checking if contour is rectangle over 300 pix
+        # and less than 1000 pix and if mean intensity is less than 50
+        if len(approx) == 4 and config_dict['CODE_ROI']['max-size'] > area \
+                >= config_dict['CODE_ROI']['min-size'] \
+                and mean < config_dict['CODE_ROI']['mean']:
+
+            # checking if contour is within horizontal and vertical edges
+            if is_in_ess_corner_region(cnt[0][0][0], cnt[0][0][1]):
+
+                # iterating every n'th point of contour (for now n = 1)
+                for cnt_point in itertools.islice(cnt, None, None, 1):
+                    # searching for left top point
+                    if math.sqrt(
+                            pow(cnt_point[0][0] - 0, 2)
+                            + pow(cnt_point[0][1] - 0, 2)) \
+                            < left_top_length:
+                        left_top_length = math.sqrt(
+                            pow(cnt_point[0][0] - 0, 2)
+                            + pow(cnt_point[0][1] - 0, 2))
+                        left_top_point = cnt_point[0]
+
+                    # searching for right top point
+                    if math.sqrt(
+                            pow(cnt_point[0][0] - config_dict['ALIGNED_RESOLUTION']['x'], 2)
+                            + pow(cnt_point[0][1] - 0, 2)) \
+                            < right_top_length:
+                        right_top_length = math.sqrt(
+                            pow(cnt_point[0][0]
+                                - config_dict['ALIGNED_RESOLUTION']['x'], 2)
+                            + pow(cnt_point[0][1] - 0, 2))
+                        right_top_point = cnt_point[0]
+
+                    # searching for left bottom point
+                    if math.sqrt(
+                            pow(cnt_point[0][0] - 0, 2) + pow(cnt_point[0][1] -
+                                                              config_dict['ALIGNED_RESOLUTION']['y'], 2)) \
+                            < left_bottom_length:
+                        left_bottom_length = math.sqrt(
+                            pow(cnt_point[0][0] - 0, 2)
+                            + pow(cnt_point[0][1] - config_dict['ALIGNED_RESOLUTION']['y'], 2))
+                        left_bottom_point = cnt_point[0]
+
+                    # searching for right bottom point
+                    if math.sqrt(pow(cnt_point[0][0] - config_dict['ALIGNED_RESOLUTION']['x'], 2) + pow(
+                            cnt_point[0][1] - config_dict['ALIGNED_RESOLUTION']['y'], 2)) < right_bottom_length:
+                        right_bottom_length = math.sqrt(
+                            pow(cnt_point[0][0]
+                                - config_dict['ALIGNED_RESOLUTION']['x'], 2)
+                            + pow(cnt_point[0][1]
+                                  - config_dict['ALIGNED_RESOLUTION']['y'], 2))
+                        right_bottom_point = cnt_point[0]
+
+    # each corner is found if its point lies in its own corner region.
+    edges = config_dict['EDGES_ROI']
+    all_found = all(
+        (point[0] < edges['left-border'] if is_left else point[0] > edges['right-border'])
+        and (point[1] < edges['top-border'] if is_top else point[1] > edges['bottom-border'])
+        for point, is_left, is_top in [(left_top_point, True, True), (right_top_point, False, True),
+                                       (left_bottom_point, True, False), (right_bottom_point, False, False)])
+    return [left_top_point, right_top_point, left_bottom_point, right_bottom_point], all_found
+
+
+def ess_find_corner_points(image):
+    """ find the corner points of the ES&S frame by full resolution analysis of the entire page.
+        returns list of points [left_top, right_top, left_bottom, right_bottom]
+    """
+    corner_points, _ = ess_search_corner_points(image, ess_frame_contours(image))
+    return corner_points
+
+
+def ess_find_corner_points_pyramid(image):
+    """ find the corner points of the ES&S frame coarse-to-fine.
+        Candidate frame marks are located on a page downsampled by PYRAMID_SCALE, and
+        only small windows around candidates in the corner regions are analyzed at
+        full resolution. Returns list of points as ess_find_corner_points, or None if
+        any corner is not found, so the caller can fall back to the full page.
+    """
+    height, width = image.shape[:2]
+    _, thresh = cv2.threshold(image, config_dict['THRESHOLD']['frame-contours'], 255, 1)
+
+    # dilating before subsampling keeps every dark pixel in the coarse image, so no mark is lost.
+    coarse_kernel = np.ones((PYRAMID_SCALE, PYRAMID_SCALE), np.uint8)
+    coarse_thresh = cv2.dilate(thresh, coarse_kernel)[::PYRAMID_SCALE, ::PYRAMID_SCALE].copy()
+    coarse_contours, _ = cv2.findContours(coarse_thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    contours = []
+    for coarse_cnt in coarse_contours:
+        cx, cy, cw, ch = cv2.boundingRect(coarse_cnt)
+        x1 = max(cx * PYRAMID_SCALE - PYRAMID_WINDOW_PAD, 0)
+        y1 = max(cy * PYRAMID_SCALE - PYRAMID_WINDOW_PAD, 0)
+        x2 = min((cx + cw) * PYRAMID_SCALE + PYRAMID_WINDOW_PAD, width)
+        y2 = min((cy + ch) * PYRAMID_SCALE + PYRAMID_WINDOW_PAD, height)
+        if (x2 - x1) * (y2 - y1) < config_dict['CODE_ROI']['min-size']:
+            continue
+        # the window must reach into one of the corner regions.
+        if not (x1 < config_dict['EDGES_ROI']['left-border'] or x2 > config_dict['EDGES_ROI']['right-border']) \
+                or not (y1 < config_dict['EDGES_ROI']['top-border'] or y2 > config_dict['EDGES_ROI']['bottom-border']):
+            continue
+        contours.extend(ess_frame_contours(image[y1:y2, x1:x2], offset=(x1, y1)))
+
+    corner_points, all_found = ess_search_corner_points(image, contours)
+    return corner_points if all_found else None
+
+
 def ess_align_images(images) -> tuple:
     """
     This is specific to ES&S and should be renamed
@@ -39,94 +196,12 @@ def ess_align_images(images) -> tuple:
     """
     result_images = []
     determinants = []
-    # pylint: disable=too-many-nested-blocks
-    # Seven is reasonable in this case.
+    use_pyramid_alignment = args.argsdict.get('use_pyramid_alignment', False)
     for image in images:
-        # defining threshold and reading contours
-        _, thresh = cv2.threshold(
-            image, config_dict['THRESHOLD']['frame-contours'], 255, 1)
-
-        # preventive deletion of the lines overlying the edge bars
-        kernel_line = np.ones((1, 6), np.uint8)
-        thresh = cv2.erode(thresh, kernel_line, iterations=1)
-        thresh = cv2.dilate(thresh, kernel_line, iterations=1)
-
-        contours, _ = cv2.findContours(thresh, 1, cv2.CHAIN_APPROX_SIMPLE)
-
-        # setting up points and lengths for further search
-        left_top_point = (0, 0)
-        right_top_point = (0, 0)
-        left_bottom_point = (0, 0)
-        right_bottom_point = (0, 0)
-        left_top_length = config_dict['INITIAL_SEARCH_VALUES']
-        right_top_length = config_dict['INITIAL_SEARCH_VALUES']
-        left_bottom_length = config_dict['INITIAL_SEARCH_VALUES']
-        # pylint: disable=too-many-locals
-        right_bottom_length = config_dict['INITIAL_SEARCH_VALUES']
-        # iterating through contours
-        for cnt in contours:
-
-            # approximating shape of contour, its area and its mean
-            approx = cv2.approxPolyDP(cnt, config_dict['SHAPE_APPROX_VALUE']['code']
-                                      * cv2.arcLength(cnt, True), True)
-            area = cv2.contourArea(cnt)
-            x, y, w, h = cv2.boundingRect(cnt)
-            mean = sum(cv2.mean(image[y:y + h, x: x + w]))
-
-            # checking if contour is rectangle over 300 pix
-            # and less than 1000 pix and if mean intensity is less than 50
-            if len(approx) == 4 and config_dict['CODE_ROI']['max-size'] > area \
-                    >= config_dict['CODE_ROI']['min-size'] \
-                    and mean < config_dict['CODE_ROI']['mean']:
-
-                # checking if contour is within horizontal and vertical edges
-                if cnt[0][0][0] > config_dict['EDGES_ROI']['right-border'] \
-                        or cnt[0][0][0] < config_dict['EDGES_ROI']['left-border']:
-                    if cnt[0][0][1] > config_dict['EDGES_ROI']['bottom-border'] \
-                            or cnt[0][0][1] < config_dict['EDGES_ROI']['top-border']:
-
-                        # iterating every n'th point of contour (for now n = 1)
-                        for cnt_point in itertools.islice(cnt, None, None, 1):
-                            # searching for left top point
-                            if math.sqrt(
-                                    pow(cnt_point[0][0] - 0, 2)
-                                    + pow(cnt_point[0][1] - 0, 2)) \
-                                    < left_top_length:
-                                left_top_length = math.sqrt(
-                                    pow(cnt_point[0][0] - 0, 2)
-                                    + pow(cnt_point[0][1] - 0, 2))
-                                left_top_point = cnt_point[0]
-
-                            # searching for right top point
-                            if math.sqrt(
-                                    pow(cnt_point[0][0] - config_dict['ALIGNED_RESOLUTION']['x'], 2)
-                                    + pow(cnt_point[0][1] - 0, 2)) \
-                                    < right_top_length:
-                                right_top_length = math.sqrt(
-                                    pow(cnt_point[0][0]
-                                        - config_dict['ALIGNED_RESOLUTION']['x'], 2)
-                                    + pow(cnt_point[0][1] - 0, 2))
-                                right_top_point = cnt_point[0]
-
-                            # searching for left bottom point
-                            if math.sqrt(
-                                    pow(cnt_point[0][0] - 0, 2) + pow(cnt_point[0][1] -
-                                                                      config_dict['ALIGNED_RESOLUTION']['y'], 2)) \
-                                    < left_bottom_length:
-                                left_bottom_length = math.sqrt(
-                                    pow(cnt_point[0][0] - 0, 2)
-                                    + pow(cnt_point[0][1] - config_dict['ALIGNED_RESOLUTION']['y'], 2))
-                                left_bottom_point = cnt_point[0]
-
-                            # searching for right bottom point
-                            if math.sqrt(pow(cnt_point[0][0] - config_dict['ALIGNED_RESOLUTION']['x'], 2) + pow(
-                                    cnt_point[0][1] - config_dict['ALIGNED_RESOLUTION']['y'], 2)) < right_bottom_length:
-                                right_bottom_length = math.sqrt(
-                                    pow(cnt_point[0][0]
-                                        - config_dict['ALIGNED_RESOLUTION']['x'], 2)
-                                    + pow(cnt_point[0][1]
-                                          - config_dict['ALIGNED_RESOLUTION']['y'], 2))
-                                right_bottom_point = cnt_point[0]
+        corner_points = ess_find_corner_points_pyramid(image) if use_pyramid_alignment else None
+        if corner_points is None:
+            corner_points = ess_find_corner_points(image)
+        left_top_point, right_top_point, left_bottom_point, right_bottom_point = corner_points
 
         # defining variables for current and desired points
         pts1 = np.float32([
@@ -152,6 +227,7 @@ def ess_align_images(images) -> tuple:
             ))
 
         # removing possible vertical lines on the timemarks
+        kernel_line = np.ones((1, 6), np.uint8)
         image[:, :35] = cv2.dilate(image[:, :35], kernel_line, iterations=1)
         image[:, :35] = cv2.erode(image[:, :35], kernel_line, iterations=1)
         image[:, -35:] = cv2.dilate(image[:, -35:], kernel_line, iterations=1)
@@ -192,12 +268,17 @@ def get_determinant_from_figure(figure: np.float32) -> float:
     return determinant
 
 
-def dominion_erode_dilate_contours(page, page_height, page_width):
+DOMINION_EDGE_BAND_H = 400         # rows at top and bottom of the page where alignment blocks are found.
+DOMINION_EDGE_BAND_MARGIN = 80     # exceeds the combined vertical reach of the kernels in dominion_basic_shapes.
+
+
+def dominion_erode_dilate_contours(page, page_height, page_width, restrict_to_bands=True):
     """
     Remove imperfections.
     :param page: (np.array) array of an image of the page
     :param page_height: (int) height of the page in pix
     :param page_width: (int) width of the page in pix
+    :param restrict_to_bands: (bool) process only the top and bottom bands of the page. The result is the same.
     :return: (np.array) array of an image of the page with minor shapes removed
     """
 
@@ -229,6 +310,32 @@ def dominion_erode_dilate_contours(page, page_height, page_width):
     bottom_basic_shapes = cv2.dilate(bottom_basic_shapes, kernel_line, iterations=1)
     bottom_basic_shapes = cv2.erode(bottom_basic_shapes, kernel_line, iterations=1)
 
+    # only the top and bottom DOMINION_EDGE_BAND_H rows of basic shapes are used, and the middle is cleared.
+    # The morphology is local, so processing each band with a margin gives the same result as the full page.
+    band_h = DOMINION_EDGE_BAND_H + DOMINION_EDGE_BAND_MARGIN
+    if restrict_to_bands and page_height > 2 * band_h:
+        basic_shapes = np.full_like(page, 255)
+        basic_shapes[:DOMINION_EDGE_BAND_H, :] = \
+            dominion_basic_shapes(page[:band_h, :])[:DOMINION_EDGE_BAND_H, :]
+        basic_shapes[page_height - DOMINION_EDGE_BAND_H:, :] = \
+            dominion_basic_shapes(page[page_height - band_h:, :])[-DOMINION_EDGE_BAND_H:, :]
+    else:
+        basic_shapes = dominion_basic_shapes(page)
+
+        # clearing middle part of the image
+        basic_shapes[DOMINION_EDGE_BAND_H:page_height - DOMINION_EDGE_BAND_H, :] = 255
+
+    basic_shapes[page_height-200:, :] = bottom_basic_shapes
+
+    return basic_shapes
+
+
+def dominion_basic_shapes(page):
+    """
+    Erode and dilate the page (or a band of it) so only major marks remain.
+    :param page: (np.array) array of an image of the page
+    :return: (np.array) array of the same size with minor shapes removed
+    """
     # horizontal and vertical eroding end dilating for final distortion removal
     kernel_line = np.ones((5, 5), np.uint8)
     basic_shapes = cv2.erode(page, kernel_line, iterations=1)
@@ -244,10 +351,6 @@ def dominion_erode_dilate_contours(page, page_height, page_width):
     basic_shapes = cv2.dilate(basic_shapes, kernel_line, iterations=1)
     basic_shapes = cv2.erode(basic_shapes, kernel_line, iterations=1)
 
-    # clearing middle part of the image
-    basic_shapes[400:page_height - 400, :] = 255
-    basic_shapes[page_height-200:, :] = bottom_basic_shapes
-
     return basic_shapes
 
 
@@ -777,15 +880,18 @@ def vertical_mark_stats_str(marks, location:str) -> str:
             f"wavg:{wstats[0]} wmin:{wstats[1]} wmax:{wstats[2]} wmed:{hstats[3]}\n" \
             f"Tavg:{Tstats[0]} Tmin:{Tstats[1]} Tmax:{Tstats[2]} Tmed:{Tstats[3]}\n"
 
-def generic_get_timing_marks(images, ballot_id):
+def generic_get_timing_marks(images, ballot_id, style_timing_marks=None):
     """ Given set of images for ballot ballot_id, return timing marks structure for given vendor.
         returns None if timing marks encountered an exception, reporting done when the error is encountered.
+        style_timing_marks, if provided, are the timing marks of the style in the same structure,
+        used as a prior for the location of the marks on each page.
     """
 
     timing_marks = [{},{}]
 
     for page_idx, image in enumerate(images):
-        timing_marks[page_idx] = generic_get_timing_marks_one_p(image, ballot_id, page_idx)
+        page_prior = style_timing_marks[page_idx] if style_timing_marks and page_idx < len(style_timing_marks) else None
+        timing_marks[page_idx] = generic_get_timing_marks_one_p(image, ballot_id, page_idx, page_prior)
 
         # note that some pages may not provide any timing marks. Okay to return only those
         # that were detected.
@@ -794,11 +900,13 @@ def generic_get_timing_marks(images, ballot_id):
 
     return timing_marks
 
-def generic_get_timing_marks_one_p(image, ballot_id, page):
+def generic_get_timing_marks_one_p(image, ballot_id, page, page_prior=None):
     """ return timing marks for one image for given vendor.
         uses args.argsdict to discover the vendor
         image, one side of a ballot
         ballot_id, page provided for status messages.
+        page_prior, optional timing marks of this page of the style. ES&S searches only narrow bands
+            around these. Dominion regions are already fixed narrow bands, so the prior is not needed.
         If there is any error, return None.
     """
 
@@ -813,7 +921,7 @@ def generic_get_timing_marks_one_p(image, ballot_id, page):
             dominion_get_timing_marks(image, ballot_id, page)
 
     elif vendor == 'ES&S':
-        timing_marks_one_p = ess_gen_timing_marks(image)
+        timing_marks_one_p = ess_gen_timing_marks(image, page_prior)
 
     else:
         utils.exception_report(f"Vendor {vendor} not supported")
@@ -895,7 +1003,14 @@ def extract_contours_from_region(image, region, kernels={'blk':(3,3),'wht':(3,3)
         Returns list of boxes of first white rectangle round black regions.
     """
 
-    working_image = utils.extract_region(image, region, mode='clear')
+    # Everything outside the region is cleared, so only a window of the region plus a white margin
+    # wider than the kernels needs to be processed. The result is the same as processing the full page.
+    height, width = image.shape[:2]
+    pad = max(kernels['wht'] + kernels['blk']) + 1
+    win_x1, win_y1 = max(region['x'] - pad, 0), max(region['y'] - pad, 0)
+    win_x2, win_y2 = min(region['x'] + region['w'] + pad, width), min(region['y'] + region['h'] + pad, height)
+    window_region = {'x': region['x'] - win_x1, 'y': region['y'] - win_y1, 'w': region['w'], 'h': region['h']}
+    working_image = utils.extract_region(image[win_y1:win_y2, win_x1:win_x2], window_region, mode='clear')
 
     # declaring kernel for erosion and dilation
     # dilation followed by erosion removes black spots from white areas.
@@ -920,11 +1035,18 @@ def extract_contours_from_region(image, region, kernels={'blk':(3,3),'wht':(3,3)
 
     # finding marks contours in the thresh images
     if find_contours:
-        contours, _ = cv2.findContours(working_image, 1, cv2.CHAIN_APPROX_NONE)
+        contours, _ = cv2.findContours(working_image, 1, cv2.CHAIN_APPROX_NONE, offset=(win_x1, win_y1))
+        # drop the contour around the cleared window itself, which is never a feature.
+        window_rect = (win_x1, win_y1, win_x2 - win_x1, win_y2 - win_y1)
+        contours = [cnt for cnt in contours if cv2.boundingRect(cnt) != window_rect]
     else:
         contours = None
 
-    return contours, working_image
+    # the working image is returned at full page size, for diagnostic images and template matching.
+    page_image = np.full(image.shape[:2], 255, dtype=working_image.dtype)
+    page_image[win_y1:win_y2, win_x1:win_x2] = working_image
+
+    return contours, page_image
 
 def find_boxes(contours, addl_attr={}):
     all_boxes = []
@@ -1602,33 +1724,16 @@ def dominion_get_timing_marks(image, ballot_id, page):
     return left_vertical_marks, right_vertical_marks, top_marks
 """
 
-def stretch_fix_ballots(argsdict, ballots, std_ballot_num):
+def stretch_fix_ballot(argsdict, ballot, std_timing_marks):
     """
-    Normalize ballots to std_timing marks.
-    ballots: list of ballot instances, each with images loaded, split, aligned, and std_timing_marks generated.
-    std_timing_marks: list of dict for each page providing timing information in same shape as ballot.ballotdict['timing_marks'].
-    Modifies images within the ballot instance.
-
-    Algorithm
-    1. iterate through ballots
-    2. check if ballot deviates from timing_marks of std_ballot sufficiently to warrant fixing.
-    3. call appropriate generic stretch fix function
+    Normalize all pages of one ballot to std_timing_marks. Modifies images within the ballot instance.
     """
     if not argsdict.get('use_stretch_fix'):
         return
     
     vendor = argsdict.get('vendor', 'ES&S')
-    #if not vendor in ['Dominion']: return       # only Dominion supported at this time.
-
-    std_timing_marks = ballots[std_ballot_num].ballotdict['timing_marks']
-
-    for ballot_idx, ballot in enumerate(ballots):
-
-        if ballot_idx == std_ballot_num:
-            # by definition, we need not unstretch the designated standard ballot
-            continue
-        for page_idx, image in enumerate(ballot.ballotimgdict['images']):
-            dominion_stretch_fix(ballot, std_timing_marks, page_idx, vendor=vendor)
+    for page_idx in range(len(ballot.ballotimgdict['images'])):
+        dominion_stretch_fix(ballot, std_timing_marks, page_idx, vendor=vendor)
 
 
 def is_image_stretched(ballot_timing_marks, std_timing_marks, page_idx):
@@ -1745,16 +1850,16 @@ def gen_distortion_metrics(ballots, avg_marks) -> list:
 
     return distortion_metrics
 
+DISTORTION_THRESHOLD = 1000      # this is the sum of x,y distortions of vertical timing marks.
+
 def remove_distorted_ballots(ballots, distortion_metrics, max=10) -> int:
     """ review ballots and remove those that exceed a threshold
     """
 
-    distortion_threshold = 1000      # this is the sum of x,y distortions of vertical timing marks.
-
     num_removed = 0
     for i in range(len(ballots)-1, -1, -1):
         # process ballot list in reverse order so any deleted entries will not upset future iterations.
-        if distortion_metrics[i] > distortion_threshold:
+        if distortion_metrics[i] > DISTORTION_THRESHOLD:
             utils.sts(f">>> Removing ballot {ballots[i].ballotdict['ballot_id']} with distortion metric {distortion_metrics[i]} from template", 3)
             del ballots[i]
             num_removed += 1
@@ -1814,393 +1919,133 @@ def timing_mark_sts(page_timing_marks, kind_str):
 
 
 
+def get_stretch_fix_regions(page_timing_marks: dict, std_page_timing_marks: dict, vendor='Dominion') -> list:
+    """
+    Return list of regions (dest_y, dest_h, src_tri1, src_tri2) of the stretch fix of one page.
+    Each region spans the full width of the page and is split diagonally into two triangles.
+    The upper-left triangle (0,0),(width,0),(0,dest_h) is taken from src_tri1 and the lower-right 
+    triangle (width,0),(0,dest_h),(width,dest_h) from src_tri2. The points of src_tri1 and src_tri2 
+    are in the same order, but are given with x as either 'left' or 'right', to be replaced by the page width.
+    """
+    [left_vertical_marks, right_vertical_marks] = [page_timing_marks[x] for x in ['left_vertical_marks', 'right_vertical_marks']]
+    left_std_vertical_marks = std_page_timing_marks['left_vertical_marks']
+    
+    horizontal_offset = 20 if vendor == 'Dominion' else 0
+    
+    def left_x(mark):
+        # interior edge of the left mark less the offset, or the exterior edge.
+        return mark['x'] + mark['w'] - horizontal_offset if horizontal_offset else mark['x']
+        
+    def right_x(mark):
+        return mark['x'] + horizontal_offset if horizontal_offset else mark['x'] + mark['w']
+    
+    regions = []
+    for index in range(len(right_vertical_marks))[:-1]:
+        left0, right0, left1, right1 = left_vertical_marks[index], right_vertical_marks[index], left_vertical_marks[index + 1], right_vertical_marks[index + 1]
+        regions.append((
+            left_std_vertical_marks[index]['y'],
+            abs(left_std_vertical_marks[index]['y'] - left_std_vertical_marks[index + 1]['y']),
+            [(left_x(left0), left0['y']), (right_x(right0), right0['y']), (left_x(left1), left1['y'])],
+            [(right_x(right0), right0['y']), (left_x(left1), left1['y']), (right_x(right1), left1['y'])],
+            ))
+            
+    if vendor == 'Dominion':
+        # strip below the last mark, twice the height of the mark.
+        index = len(right_vertical_marks) - 1
+        left0, right0 = left_vertical_marks[index], right_vertical_marks[index]
+        bottom_y = left0['y'] + 2 * left0['h']
+        regions.append((
+            left_std_vertical_marks[index]['y'],
+            2 * left_std_vertical_marks[index]['h'],
+            [(left_x(left0), left0['y']), (right_x(right0), right0['y']), (left_x(left0), bottom_y)],
+            [(right_x(right0), right0['y']), (left_x(left0), bottom_y), (right_x(right0), bottom_y)],
+            ))
+        # strip above the first mark.
+        left0, right0 = left_vertical_marks[0], right_vertical_marks[0]
+        regions.append((
+            0,
+            left0['y'],
+            [(left_x(left0), 0), (right_x(right0), 0), (left_x(left0), left0['y'])],
+            [(right_x(right0), 0), (left_x(left0), left0['y']), (right_x(right0), left0['y'])],
+            ))
+    return regions
+    
+
+def get_stretch_fix_maps(page_timing_marks: dict, std_page_timing_marks: dict, shape: tuple, vendor='Dominion') -> dict:
+    """
+    Build the dense displacement field of the stretch fix of one page, so it can be applied with one cv2.remap.
+    The field is piecewise-linear: each region between timing marks is mapped by two affine transforms.
+    Returns dict with float32 'map_x', 'map_y' for cv2.remap, and 'white_rows', the rows which
+    are between the timing marks but not covered by any region, which are set to white.
+    """
+    height, width = shape
+    map_x = np.tile(np.arange(width, dtype=np.float32), (height, 1))
+    map_y = np.repeat(np.arange(height, dtype=np.float32)[:, np.newaxis], width, axis=1)
+    
+    left_vertical_marks, right_vertical_marks = page_timing_marks['left_vertical_marks'], page_timing_marks['right_vertical_marks']
+    left_std_vertical_marks, right_std_vertical_marks = std_page_timing_marks['left_vertical_marks'], std_page_timing_marks['right_vertical_marks']
+    white_rows = np.zeros(height, dtype=bool)
+    white_rows[min(left_vertical_marks[0]['y'], right_vertical_marks[0]['y'], left_std_vertical_marks[0]['y'], right_std_vertical_marks[0]['y']):height - 150] = True
+    
+    xs = np.arange(width, dtype=np.float32)
+    for dest_y, dest_h, src_tri1, src_tri2 in get_stretch_fix_regions(page_timing_marks, std_page_timing_marks, vendor):
+        end_y = min(dest_y + dest_h, height)
+        if end_y <= dest_y:
+            continue
+        # affine transforms from destination to source, as needed by remap.
+        inv1 = cv2.getAffineTransform(np.float32([[0, 0], [width, 0], [0, dest_h]]), np.float32(src_tri1)).astype(np.float32)
+        inv2 = cv2.getAffineTransform(np.float32([[width, 0], [0, dest_h], [width, dest_h]]), np.float32(src_tri2)).astype(np.float32)
+        
+        ys = np.arange(end_y - dest_y, dtype=np.float32)[:, np.newaxis]
+        # lower-right triangle, with the diagonal ending two rows above the bottom of the region.
+        diag_h = dest_h - 2
+        in_tri2 = (ys <= diag_h) & (xs * diag_h >= width * (diag_h - ys)) if diag_h > 0 else None
+        for map_xy, row in ((map_x, 0), (map_y, 1)):
+            region_map = map_xy[dest_y:end_y]
+            np.add(inv1[row, 0] * xs, inv1[row, 1] * ys + inv1[row, 2], out=region_map)
+            if in_tri2 is not None:
+                np.copyto(region_map, inv2[row, 0] * xs + (inv2[row, 1] * ys + inv2[row, 2]), where=in_tri2)
+        white_rows[dest_y:end_y] = False
+        
+    return {'map_x': map_x, 'map_y': map_y, 'white_rows': white_rows}
+    
+
+def dewarp_image(image: np.ndarray, stretch_fix_maps: dict) -> np.ndarray:
+    """ apply the displacement field from get_stretch_fix_maps() to image. """
+    canvas = cv2.remap(image, stretch_fix_maps['map_x'], stretch_fix_maps['map_y'], cv2.INTER_LINEAR, 
+                       borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    canvas[stretch_fix_maps['white_rows']] = 255
+    return canvas
+    
+
 def dominion_stretch_fix(ballot, std_timing_marks, page, vendor='Dominion'):
     """
-    Function which unstretches Dominion images if possible
+    Function which unstretches Dominion images if possible, using a single remap of each page.
     :param ballot: instance od a ballot
     :param std_timing_marks: (list) list of the dictionaries cotaining destination timing marks
     :param page: (int) page number
-    :param horizontal_offset: (int) value of horizontal stabilisation, based on distance from inner edges of timing marks (0 - disabled)
-        If used, this measures the edge based on interior timing mark x value toward the edge. Not applicable to ES&S because those timing marks vary.
-    :param second_layer: (bool) boolean value defining if the second layer should be applied
+    The displacement field is only used locally and is not kept in the ballot.
     """
-
     image = ballot.ballotimgdict['images'][page]
     ballot_id = ballot.ballotdict['ballot_id']
-    height, width = image.shape
-    image_copy = image.copy()
-    canvas = image.copy()
-    
-    horizontal_offset = 20 if vendor == 'Dominion' else 0
-    second_layer = False
 
     if page and not ballot.ballotdict['timing_marks'][page]:
         utils.sts(f"Aborting stretch fix for page 1, ballot_id:{ballot_id} -- no timing marks. Probably blank.")
-        return canvas
+        return image
 
     timing_mark_sts(ballot.ballotdict['timing_marks'][page], f"ballot_id:{ballot_id}")
     timing_mark_sts(std_timing_marks[page], 'std_timing_marks')
 
-    [left_vertical_marks, right_vertical_marks, top_marks] = [ballot.ballotdict['timing_marks'][page][x] for x in ['left_vertical_marks', 'right_vertical_marks', 'top_marks']]
-    [left_std_vertical_marks, right_std_vertical_marks, top_std_marks] = [std_timing_marks[page][x] for x in ['left_vertical_marks', 'right_vertical_marks', 'top_marks']]
-
-    if not (left_vertical_marks and right_vertical_marks and top_marks and
-            left_std_vertical_marks and right_std_vertical_marks and top_std_marks):
-            utils.exception_report(f"WARN: timing marks missing from ballot {ballot.ballotdict['ballot_id']}, aborting stretchfix")
-            return canvas
-
-    if not (left_vertical_marks and right_vertical_marks and top_marks and
-        left_std_vertical_marks and right_std_vertical_marks and top_std_marks):
-        utils.exception_report(f"WARN: timing marks missing from ballot {ballot.ballotdict['ballot_id']}, aborting stretchfix")
-        return canvas
-
-    canvas[
-        min(left_vertical_marks[0]['y'], right_vertical_marks[0]['y'], left_std_vertical_marks[0]['y'], right_std_vertical_marks[0]['y']):
-        height - 150,
-        :] = 255
-
-    # iterating through range of vertical marks indexes beginning on the second
-    for index in range(len(right_vertical_marks))[:-1]:
-
-        if horizontal_offset:
-            # declaring bar points of current mark strip right part
-            bar_points = np.float32([
-                [left_vertical_marks[index]['x'] + left_vertical_marks[index]['w'] - horizontal_offset, left_vertical_marks[index]['y']],
-                [right_vertical_marks[index]['x'] + horizontal_offset, right_vertical_marks[index]['y']],
-                [left_vertical_marks[index + 1]['x'] + left_vertical_marks[index + 1]['w'] - horizontal_offset, left_vertical_marks[index + 1]['y']]
-            ])
-        else:
-            # declaring bar points of current mark strip right part
-            bar_points = np.float32([
-                [left_vertical_marks[index]['x'], left_vertical_marks[index]['y']],
-                [right_vertical_marks[index]['x'] + right_vertical_marks[index]['w'], right_vertical_marks[index]['y']],
-                [left_vertical_marks[index + 1]['x'], left_vertical_marks[index+1]['y']]
-            ])
-
-        # declaring final points of current mark strip right part
-        final_points = np.float32([
-            [0, 0],
-            [width, 0],
-            [0, abs(left_std_vertical_marks[index]['y']-left_std_vertical_marks[index+1]['y'])]
-        ])
-
-        # declaring affine transformation matrix for current mark strip right part
-        matrix = cv2.getAffineTransform(bar_points, final_points)
-
-        # declaring warped current mark strip right part
-        warped_right_part = cv2.warpAffine(image_copy, matrix, (width, abs(left_std_vertical_marks[index]['y']-left_std_vertical_marks[index+1]['y']))).astype('int8')
-
-        if horizontal_offset:
-            # declaring bar points of current mark strip left part
-            # based on offset from interior edge of timing mark to edge.
-            bar_points = np.float32([
-                [right_vertical_marks[index]['x'] + horizontal_offset, right_vertical_marks[index]['y']],
-                [left_vertical_marks[index + 1]['x'] + left_vertical_marks[index + 1]['w'] - horizontal_offset, left_vertical_marks[index+1]['y']],
-                [right_vertical_marks[index + 1]['x'] + horizontal_offset, left_vertical_marks[index + 1]['y']]
-            ])
-        else:
-            # declaring bar points of current mark strip left part
-            # based on exterior edge of timing mark.
-            bar_points = np.float32([
-                [right_vertical_marks[index]['x'] + right_vertical_marks[index]['w'], right_vertical_marks[index]['y']],
-                [left_vertical_marks[index + 1]['x'], left_vertical_marks[index + 1]['y']],
-                [right_vertical_marks[index + 1]['x'] + right_vertical_marks[index + 1]['w'], left_vertical_marks[index + 1]['y']]
-            ])
-
-        # declaring final points of current mark strip left part
-        final_points = np.float32([
-            [width, 0],
-            [0, abs(left_std_vertical_marks[index]['y']-left_std_vertical_marks[index+1]['y'])],
-            [width, abs(left_std_vertical_marks[index]['y']-left_std_vertical_marks[index+1]['y'])],
-        ])
-
-        # declaring affine transformation matrix for current mark strip left part
-        matrix = cv2.getAffineTransform(bar_points, final_points)
-
-        # declaring warped current mark strip left part
-        warped_left_part = cv2.warpAffine(image_copy, matrix, (width, abs(left_std_vertical_marks[index]['y']-left_std_vertical_marks[index+1]['y']))).astype('int8')
-
-        # declaring diagonal mask to join both parts
-        mask = np.zeros((abs(left_std_vertical_marks[index]['y']-left_std_vertical_marks[index+1]['y']), width), dtype="int8")
-        mask_points = np.array([
-            [width, 0],
-            [0, abs(left_std_vertical_marks[index]['y']-left_std_vertical_marks[index+1]['y'])-2],
-            [width, abs(left_std_vertical_marks[index]['y']-left_std_vertical_marks[index+1]['y'])-2],
-        ])
-        cv2.fillPoly(mask, [mask_points], (255, 255, 255))
-
-        # masking current mark strip right part
-        warped_right_part = cv2.bitwise_or(warped_right_part, mask)
-
-        # reversing the mask
-        mask -= 255
-        mask *= -1
-
-        # masking current mark strip left part
-        warped_left_part = cv2.bitwise_or(warped_left_part, mask)
-
-        # joining current mark strip parts and aplying them to canvas
-        canvas[left_std_vertical_marks[index]['y']:left_std_vertical_marks[index+1]['y'], :] = cv2.bitwise_and(
-            cv2.bitwise_and(warped_left_part, warped_right_part).astype('int8'),
-            canvas[left_std_vertical_marks[index]['y']:left_std_vertical_marks[index + 1]['y'], :].astype('int8')
-        )
-
-    if vendor == 'Dominion':
-        index = len(right_vertical_marks) - 1
-        if horizontal_offset:
-            # declaring bar points of current mark strip right part
-            bar_points = np.float32([
-                [left_vertical_marks[index]['x'] + left_vertical_marks[index]['w'] - horizontal_offset, left_vertical_marks[index]['y']],
-                [right_vertical_marks[index]['x'] + horizontal_offset, right_vertical_marks[index]['y']],
-                [left_vertical_marks[index]['x'] + left_vertical_marks[index]['w'] - horizontal_offset, left_vertical_marks[index]['y'] + 2 * left_vertical_marks[index]['h']]
-            ])
-        else:
-            # declaring bar points of current mark strip right part
-            bar_points = np.float32([
-                [left_vertical_marks[index]['x'], left_vertical_marks[index]['y']],
-                [right_vertical_marks[index]['x'] + right_vertical_marks[index]['w'], right_vertical_marks[index]['y']],
-                [left_vertical_marks[index]['x'], left_vertical_marks[index]['y']+2*left_vertical_marks[index]['h']]
-            ])
-
-        # declaring final points of current mark strip right part
-        final_points = np.float32([
-            [0, 0],
-            [width, 0],
-            [0, 2*left_std_vertical_marks[index]['h']]
-        ])
-
-        # declaring affine transformation matrix for current mark strip right part
-        matrix = cv2.getAffineTransform(bar_points, final_points)
-
-        # declaring warped current mark strip right part
-        warped_right_part = cv2.warpAffine(image_copy, matrix, (width, 2*left_std_vertical_marks[index]['h'])).astype('int8')
-
-        if horizontal_offset:
-            # declaring bar points of current mark strip left part
-            bar_points = np.float32([
-                [right_vertical_marks[index]['x'] + horizontal_offset, right_vertical_marks[index]['y']],
-                [left_vertical_marks[index]['x'] + left_vertical_marks[index]['w'] - horizontal_offset, left_vertical_marks[index]['y'] + 2*left_vertical_marks[index]['h']],
-                [right_vertical_marks[index]['x'] + horizontal_offset, left_vertical_marks[index]['y'] + 2*left_vertical_marks[index]['h']]
-            ])
-        else:
-            # declaring bar points of current mark strip left part
-            bar_points = np.float32([
-                [right_vertical_marks[index]['x'] + right_vertical_marks[index]['w'], right_vertical_marks[index]['y']],
-                [left_vertical_marks[index]['x'], left_vertical_marks[index]['y'] + 2*left_vertical_marks[index]['h']],
-                [right_vertical_marks[index]['x'] + right_vertical_marks[index]['w'], left_vertical_marks[index]['y'] + 2*left_vertical_marks[index]['h']]
-            ])
-
-        # declaring final points of current mark strip left part
-        final_points = np.float32([
-            [width, 0],
-            [0, 2*left_std_vertical_marks[index]['h']],
-            [width, 2*left_std_vertical_marks[index]['h']],
-        ])
-
-        # declaring affine transformation matrix for current mark strip left part
-        matrix = cv2.getAffineTransform(bar_points, final_points)
-
-        # declaring warped current mark strip left part
-        warped_left_part = cv2.warpAffine(image_copy, matrix, (width, 2*left_std_vertical_marks[index]['h'])).astype('int8')
-
-        # declaring diagonal mask to join both parts
-        mask = np.zeros((2*left_std_vertical_marks[index]['h'], width), dtype="int8")
-        mask_points = np.array([
-            [width, 0],
-            [0, 2*left_std_vertical_marks[index]['h']-2],
-            [width, 2*left_std_vertical_marks[index]['h']-2],
-        ])
-        cv2.fillPoly(mask, [mask_points], (255, 255, 255))
-
-        # masking current mark strip right part
-        warped_right_part = cv2.bitwise_or(warped_right_part, mask)
-
-        # reversing the mask
-        mask -= 255
-        mask *= -1
-
-        # masking current mark strip left part
-        warped_left_part = cv2.bitwise_or(warped_left_part, mask)
-
-        # joining current mark strip parts and applying them to canvas
-        canvas[left_std_vertical_marks[index]['y']:left_std_vertical_marks[index]['y'] + 2*left_std_vertical_marks[index]['h'], :] = cv2.bitwise_and(
-            cv2.bitwise_and(warped_left_part, warped_right_part).astype('int8'),
-            canvas[left_std_vertical_marks[index]['y']:left_std_vertical_marks[index]['y'] + 2 * left_std_vertical_marks[index]['h'], :].astype('int8')
-            )
-
-        # now dealing with the top
-
-        index = 0
-        if horizontal_offset:
-            # declaring bar points of current mark strip right part
-            bar_points = np.float32([
-                [left_vertical_marks[index]['x'] + left_vertical_marks[index]['w'] - horizontal_offset, 0],
-                [right_vertical_marks[index]['x'] + horizontal_offset, 0],
-                [left_vertical_marks[index]['x'] + left_vertical_marks[index]['w'] - horizontal_offset, left_vertical_marks[index]['y']]
-            ])
-        else:
-            # declaring bar points of current mark strip right part
-            bar_points = np.float32([
-                [left_vertical_marks[index]['x'], 0],
-                [right_vertical_marks[index]['x'] + right_vertical_marks[index]['w'], 0],
-                [left_vertical_marks[index]['x'], left_vertical_marks[index]['y']]
-            ])
-
-        # declaring final points of current mark strip right part
-        final_points = np.float32([
-            [0, 0],
-            [width, 0],
-            [0, left_vertical_marks[index]['y']]
-        ])
-
-        # declaring affine transformation matrix for current mark strip right part
-        matrix = cv2.getAffineTransform(bar_points, final_points)
-
-        # declaring warped current mark strip right part
-        warped_right_part = cv2.warpAffine(image_copy, matrix, (width, left_vertical_marks[index]['y'])).astype('int8')
-
-        if horizontal_offset:
-            # declaring bar points of current mark strip left part
-            bar_points = np.float32([
-                [right_vertical_marks[index]['x'] + horizontal_offset, 0],
-                [left_vertical_marks[index]['x'] + left_vertical_marks[index]['w'] - horizontal_offset, left_vertical_marks[index]['y']],
-                [right_vertical_marks[index]['x'] + horizontal_offset, left_vertical_marks[index]['y']]
-            ])
-        else:
-            # declaring bar points of current mark strip left part
-            bar_points = np.float32([
-                [right_vertical_marks[index]['x'] + right_vertical_marks[index]['w'], 0],
-                [left_vertical_marks[index]['x'], left_vertical_marks[index]['y']],
-                [right_vertical_marks[index]['x'] + right_vertical_marks[index]['w'], left_vertical_marks[index]['y']]
-            ])
-
-        # declaring final points of current mark strip left part
-        final_points = np.float32([
-            [width, 0],
-            [0, left_vertical_marks[index]['y']],
-            [width, left_vertical_marks[index]['y']],
-        ])
-
-        # declaring affine transformation matrix for current mark strip left part
-        matrix = cv2.getAffineTransform(bar_points, final_points)
-
-        # declaring warped current mark strip left part
-        warped_left_part = cv2.warpAffine(image_copy, matrix, (width, left_vertical_marks[index]['y'])).astype('int8')
-
-        # declaring diagonal mask to join both parts
-        mask = np.zeros((left_vertical_marks[index]['y'], width), dtype="int8")
-        mask_points = np.array([
-            [width, 0],
-            [0, left_vertical_marks[index]['y'] - 2],
-            [width, left_vertical_marks[index]['y'] - 2],
-        ])
-        cv2.fillPoly(mask, [mask_points], (255, 255, 255))
-
-        # masking current mark strip right part
-        warped_right_part = cv2.bitwise_or(warped_right_part, mask)
-
-        # reversing the mask
-        mask -= 255
-        mask *= -1
-
-        # masking current mark strip left part
-        warped_left_part = cv2.bitwise_or(warped_left_part, mask)
-
-        # joining current mark strip parts and aplying them to canvas
-        canvas[0:warped_left_part.shape[0], :] = cv2.bitwise_and(
-            cv2.bitwise_and(warped_left_part, warped_right_part).astype('int8'),
-            canvas[0:warped_left_part.shape[0], :].astype('int8')
-        )
-
-    if second_layer:
-        # this is currently unused.
-
-        # iterating through range of vertical marks indexes beginning on the second
-        for index in range(len(right_vertical_marks))[1:]:
-
-            if horizontal_offset:
-                # declaring bar points of current mark strip right part
-                bar_points = np.float32([
-                    [left_vertical_marks[index - 1]['x'] + left_vertical_marks[index - 1]['w'] - horizontal_offset, left_vertical_marks[index - 1]['y'] + left_vertical_marks[index - 1]['h']],
-                    [right_vertical_marks[index - 1]['x'] + horizontal_offset, right_vertical_marks[index - 1]['y'] + right_vertical_marks[index - 1]['h']],
-                    [left_vertical_marks[index]['x'] + left_vertical_marks[index]['w'] - horizontal_offset, left_vertical_marks[index]['y'] + left_vertical_marks[index]['h']]
-                ])
-            else:
-                # declaring bar points of current mark strip right part
-                bar_points = np.float32([
-                    [left_vertical_marks[index - 1]['x'], left_vertical_marks[index - 1]['y'] + left_vertical_marks[index - 1]['h']],
-                    [right_vertical_marks[index - 1]['x'] + right_vertical_marks[index - 1]['w'], right_vertical_marks[index - 1]['y'] + right_vertical_marks[index - 1]['h']],
-                    [left_vertical_marks[index]['x'], left_vertical_marks[index]['y'] + left_vertical_marks[index]['h']]
-                ])
-
-            # declaring final points of current mark strip right part
-            final_points = np.float32([
-                [0, 0],
-                [width, 0],
-                [0, abs((left_std_vertical_marks[index-1]['y'] + left_std_vertical_marks[index-1]['h']) - (left_std_vertical_marks[index]['y'] + left_std_vertical_marks[index]['h']))]
-            ])
-
-            # declaring affine transformation matrix for current mark strip right part
-            matrix = cv2.getAffineTransform(bar_points, final_points)
-
-            # declaring warped current mark strip right part
-            warped_right_part = cv2.warpAffine(image_copy, matrix, (width, abs((left_std_vertical_marks[index-1]['y'] + left_std_vertical_marks[index-1]['h']) - (left_std_vertical_marks[index]['y'] + left_std_vertical_marks[index]['h'])))).astype('int8')
-
-            if horizontal_offset:
-                # declaring bar points of current mark strip left part
-                bar_points = np.float32([
-                    [right_vertical_marks[index - 1]['x'] + horizontal_offset, right_vertical_marks[index - 1]['y'] + right_vertical_marks[index - 1]['h']],
-                    [left_vertical_marks[index]['x'] + left_vertical_marks[index]['w'] - horizontal_offset, left_vertical_marks[index]['y'] + left_vertical_marks[index]['h']],
-                    [right_vertical_marks[index]['x'] + horizontal_offset, right_vertical_marks[index]['y'] + right_vertical_marks[index]['h']]
-                ])
-            else:
-                # declaring bar points of current mark strip left part
-                bar_points = np.float32([
-                    [right_vertical_marks[index - 1]['x'] + right_vertical_marks[index - 1]['w'], right_vertical_marks[index-1]['y'] + right_vertical_marks[index-1]['h']],
-                    [left_vertical_marks[index]['x'], left_vertical_marks[index]['y'] + left_vertical_marks[index]['h']],
-                    [right_vertical_marks[index]['x'] + right_vertical_marks[index]['w'], right_vertical_marks[index]['y'] + right_vertical_marks[index]['h']]
-                ])
-
-            # declaring final points of current mark strip left part
-            final_points = np.float32([
-                [width, 0],
-                [0, abs((left_std_vertical_marks[index-1]['y'] + left_std_vertical_marks[index-1]['h']) - (left_std_vertical_marks[index]['y'] + left_std_vertical_marks[index]['h']))],
-                [width, abs((left_std_vertical_marks[index-1]['y'] + left_std_vertical_marks[index-1]['h']) - (left_std_vertical_marks[index]['y'] + left_std_vertical_marks[index]['h']))],
-            ])
-
-            # declaring affine transformation matrix for current mark strip left part
-            matrix = cv2.getAffineTransform(bar_points, final_points)
-
-            # declaring warped current mark strip left part
-            warped_left_part = cv2.warpAffine(image_copy, matrix, (width, abs((left_std_vertical_marks[index-1]['y'] + left_std_vertical_marks[index-1]['h']) - (left_std_vertical_marks[index]['y'] + left_std_vertical_marks[index]['h'])))).astype('int8')
-
-            # declaring diagonal mask to join both parts
-            mask = np.zeros((abs((left_std_vertical_marks[index-1]['y'] + left_std_vertical_marks[index-1]['h']) - (left_std_vertical_marks[index]['y'] + left_std_vertical_marks[index]['h'])), width), dtype="int8")
-            mask_points = np.array([
-                [width, 0],
-                [0, abs((left_std_vertical_marks[index-1]['y'] + left_std_vertical_marks[index-1]['h']) - (left_std_vertical_marks[index]['y'] + left_std_vertical_marks[index]['h'])) - 2],
-                [width, abs((left_std_vertical_marks[index-1]['y'] + left_std_vertical_marks[index-1]['h']) - (left_std_vertical_marks[index]['y'] + left_std_vertical_marks[index]['h'])) - 2],
-            ])
-            cv2.fillPoly(mask, [mask_points], (255, 255, 255))
-
-            # masking current mark strip right part
-            warped_right_part = cv2.bitwise_or(warped_right_part, mask)
-
-            # reversing the mask
-            mask -= 255
-            mask *= -1
-
-            # masking current mark strip left part
-            warped_left_part = cv2.bitwise_or(warped_left_part, mask)
-
-            # joining current mark strip parts and aplying them to canvas
-            canvas[left_std_vertical_marks[index-1]['y']+left_std_vertical_marks[index-1]['h']:left_std_vertical_marks[index]['y'] + left_std_vertical_marks[index]['h'], :] = cv2.bitwise_and(
-                cv2.bitwise_and(warped_left_part, warped_right_part).astype('int8'),
-                canvas[left_std_vertical_marks[index-1]['y']+left_std_vertical_marks[index-1]['h']:left_std_vertical_marks[index]['y'] + left_std_vertical_marks[index]['h'], :].astype('int8')
-            )
+    page_timing_marks, std_page_timing_marks = ballot.ballotdict['timing_marks'][page], std_timing_marks[page]
+    if not all(page_timing_marks[x] and std_page_timing_marks[x] for x in ['left_vertical_marks', 'right_vertical_marks', 'top_marks']):
+        utils.exception_report(f"WARN: timing marks missing from ballot {ballot_id}, aborting stretchfix")
+        return image
 
+    stretch_fix_maps = get_stretch_fix_maps(page_timing_marks, std_page_timing_marks, image.shape, vendor)
+    canvas = dewarp_image(image, stretch_fix_maps)
     ballot.ballotimgdict['images'][page] = canvas
-
+    return canvas
+    
 
 def dominion_stretch_fix_old(ballot, std_timing_marks, page):
     """
@@ -2862,6 +2707,7 @@ def dominion_bmd_conversion(image):
     :return vertical_code: (str) string containing OCRed vertical code of the ballot
     :return qrcode[0]: qrcode of the ballot
     """
+    from utilities import ocr     # imported on use, so tasks that do not ocr do not import tesseract.
 
     # declaring image height and width
     height, width = image.shape
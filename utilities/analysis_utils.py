@@ -7,9 +7,9 @@ import cv2
 import numpy as np
 import pandas as pd
 
-from utilities import utils, args, logs
+from utilities import utils, args, logs, timing
 from utilities.vendor import get_layout_params
-from utilities.images_utils import expressvote_conversion
+from utilities.images_utils import expressvote_conversion, segment_expressvote, decode_ev_barcodes
 from utilities.literal_fuzzy_matching_utils import fuzzy_compare_str, fuzzy_compare_str_to_list
 from utilities.alignment_utils import dominion_bmd_conversion
 
@@ -341,9 +341,10 @@ def parse_ev_bottom_strlist(votefor_list: list, bottom_strlist: list, ballot_id:
     return ev_contests
     
     
-def analyze_bmd_ess(argsdict, ballot, rois_map_df, contests_dod) -> pd.DataFrame:
+def analyze_bmd_ess(argsdict, ballot, rois_map_df, contests_dod, ev_coord_index=None) -> pd.DataFrame:
     """
     This function extracts votes as specified in page_rois_map_df from one image.
+    ev_coord_index, if provided, is the barcode lookup tables of all styles from build_ev_coord_index().
     returns page_marks_df
     """
     ev_fuzzy_thres_contest  = 0.8       # config_dict['fuzzy_thres']['contest']
@@ -353,7 +354,15 @@ def analyze_bmd_ess(argsdict, ballot, rois_map_df, contests_dod) -> pd.DataFrame
     
     ballot_id = ballot.ballotdict['ballot_id']
     precinct = ballot.ballotdict['precinct']
-    utils.sts(f"Processing ExpressVote Ballot ID:{ballot_id} using OCR", 3)
+
+    segmented = None
+    if argsdict.get('bmd_barcode_first', False):
+        ballot_marks_df, segmented = analyze_bmd_ess_by_barcodes(argsdict, ballot, rois_map_df, ev_coord_index)
+        if ballot_marks_df is not None:
+            return ballot_marks_df
+
+    if utils.is_logged(3):
+        utils.sts(f"Processing ExpressVote Ballot ID:{ballot_id} using OCR", 3)
     
     #if int(ballot_id) == 261997:
     #    import pdb; pdb.set_trace()
@@ -362,6 +371,7 @@ def analyze_bmd_ess(argsdict, ballot, rois_map_df, contests_dod) -> pd.DataFrame
             ballot.ballotimgdict['images'][0], 
             ballot_id,
             expressvote_header=argsdict.get('expressvote_header'),
+            segmented=segmented,
             )
     """ This function performs alignment, trimming, segmentation and ocr,
         barcode decoding, and comparision with the expressvote_header
@@ -372,18 +382,13 @@ def analyze_bmd_ess(argsdict, ballot, rois_map_df, contests_dod) -> pd.DataFrame
     if ev_header_code is None:
         utils.sts(f"Initial check of expressvote ballot failed for ballot_id:{ballot_id}", 3)
         return None
-    if len(ev_header_code) < 26:
-        utils.sts(f"Header barcode is incorrect length for ballot {ballot_id}", 3)
+    if not parse_ev_header_code(ballot, ev_header_code, ev_coord_str_list):
+        utils.sts(f"Header barcode is incorrect length or not all digits for ballot {ballot_id}", 3)
         return None
         
     # Split and extract data from header barcode, including style_num
-    ballot.ballotdict['ev_precinct_id']     = ev_precinct_id    = int(ev_header_code[0:10])
-    ballot.ballotdict['ev_logical_style']   = ev_logical_style  = int(ev_header_code[10:20])
-    style_num = str(convert_ev_logical_style_to_style_num(ev_logical_style))
-    ballot.ballotdict['style_num']          = style_num
-    ballot.ballotdict['ev_num_writeins']    = int(ev_header_code[20:23])
-    ballot.ballotdict['ev_num_marks']       = int(ev_header_code[23:26])
-    ballot.ballotdict['ev_coord_str_list']  = normalize_ev_coord_str_list(ev_coord_str_list)
+    ev_precinct_id = ballot.ballotdict['ev_precinct_id']
+    style_num = ballot.ballotdict['style_num']
     
     style_rois_map_df = rois_map_df.loc[rois_map_df['style_num'] == style_num]
     
@@ -518,7 +523,7 @@ def analyze_bmd_ess(argsdict, ballot, rois_map_df, contests_dod) -> pd.DataFrame
             
         string = f"### WARNING: expressvote ballot {ballot_id} of precinct {precinct}: OCR not successful. Using Barcodes" 
         utils.exception_report(string)
-        page_marks_lod = extract_marks_from_barcodes(ballot, style_rois_map_df)
+        page_marks_lod = extract_marks_from_barcodes(ballot, style_rois_map_df, (ev_coord_index or {}).get(str(style_num)))
         # failed to parse OCR to create ballot_marks_df, but barcodes exist.
         # The rois_map has been filled in with ev_coord_str during template generation.
         # then we can use them to complete the ballot_marks_df
@@ -527,6 +532,28 @@ def analyze_bmd_ess(argsdict, ballot, rois_map_df, contests_dod) -> pd.DataFrame
         if not page_marks_lod:
             return None
    
+    return create_bmd_ballot_marks_df(ballot, page_marks_lod)
+
+
+def parse_ev_header_code(ballot, ev_header_code, ev_coord_str_list):
+    """ Split and extract data from the expressvote header barcode, including style_num,
+        and save them with the normalized option barcodes in the ballot instance.
+        Returns False, and leaves the ballot unchanged, if the header code is not 26 or more digits.
+    """
+    if len(ev_header_code or '') < 26 or not ev_header_code[:26].isdecimal():
+        return False
+    ballot.ballotdict['ev_precinct_id']     = int(ev_header_code[0:10])
+    ballot.ballotdict['ev_logical_style']   = ev_logical_style  = int(ev_header_code[10:20])
+    ballot.ballotdict['style_num']          = str(convert_ev_logical_style_to_style_num(ev_logical_style))
+    ballot.ballotdict['ev_num_writeins']    = int(ev_header_code[20:23])
+    ballot.ballotdict['ev_num_marks']       = int(ev_header_code[23:26])
+    ballot.ballotdict['ev_coord_str_list']  = normalize_ev_coord_str_list(ev_coord_str_list)
+    return True
+
+
+def create_bmd_ballot_marks_df(ballot, page_marks_lod) -> pd.DataFrame:
+    """ evaluate the votes of a bmd ballot and create ballot_marks_df from page_marks_lod.
+    """
     evaluate_votes_on_ballot(page_marks_lod)
 
     print_contest_marks_lod(page_marks_lod)
@@ -540,6 +567,81 @@ def analyze_bmd_ess(argsdict, ballot, rois_map_df, contests_dod) -> pd.DataFrame
     return ballot_marks_df
 
 
+def build_style_ev_coord_index(style_rois_map_df: pd.DataFrame) -> dict:
+    """ given style_rois_map_df, build lookup tables of the barcodes of the style:
+            'rows':         list of (contest, option) of each row, in order.
+            'header_rows':  list of row offsets of the contest headers.
+            'ev_coord_map': dict of normalized ev_coord_str to (contest, option, row).
+            'complete':     True if every option has an ev_coord_str, so the barcodes alone determine the votes.
+    """
+    style_index = {'rows': [], 'header_rows': [], 'ev_coord_map': {}, 'complete': True}
+    for row, (contest, option, ev_coord_str) in enumerate(zip(
+            style_rois_map_df['contest'], style_rois_map_df['option'], style_rois_map_df['ev_coord_str'])):
+        style_index['rows'].append((contest, option))
+        if option.startswith('#'):
+            style_index['header_rows'].append(row)
+            continue
+        if pd.isna(ev_coord_str) or not str(ev_coord_str).strip("' "):
+            style_index['complete'] = False
+            continue
+        # if two options have the same barcode, the first one is used.
+        style_index['ev_coord_map'].setdefault(normalize_ev_coord_str(ev_coord_str), (contest, option, row))
+    return style_index
+
+
+def build_ev_coord_index(rois_map_df: pd.DataFrame) -> dict:
+    """ build the barcode lookup tables of all styles in rois_map_df, indexed by style_num (str).
+        This is built once per chunk of ballots.
+    """
+    if rois_map_df is None or 'ev_coord_str' not in rois_map_df.columns:
+        return {}
+    return {str(style_num): build_style_ev_coord_index(style_rois_map_df)
+            for style_num, style_rois_map_df in rois_map_df.groupby('style_num', sort=False)}
+
+
+def analyze_bmd_ess_by_barcodes(argsdict, ballot, rois_map_df, ev_coord_index=None):
+    """ Barcode-first extraction of an ExpressVote ballot.
+        Decodes the header and option barcodes without OCR and resolves the votes through the
+        ev_coord_str values of the style in rois_map_df.
+        Returns ballot_marks_df, segmented
+            ballot_marks_df is None if OCR is needed: the barcodes can't be read, the style
+            does not have ev_coord_str for every option, a barcode is not known for the style,
+            the number of barcodes disagrees with ev_num_marks, or a writein is selected.
+            segmented is the (rotated_image, barcodes) of segment_expressvote(), to be passed
+            to expressvote_conversion() so the OCR path does not segment the image again.
+        Note that the human-readable text of the ballot is not checked in this mode.
+    """
+    ballot_id = ballot.ballotdict['ballot_id']
+    if utils.is_logged(3):
+        utils.sts(f"Processing ExpressVote Ballot ID:{ballot_id} using barcodes", 3)
+
+    segmented = segment_expressvote(ballot.ballotimgdict['images'][0])
+    rotated_image, barcodes = segmented
+    if rotated_image is None:
+        return None, segmented
+    ev_header_code, ev_coord_str_list = decode_ev_barcodes(barcodes)
+    if not parse_ev_header_code(ballot, ev_header_code, ev_coord_str_list):
+        return None, segmented
+    style_num = ballot.ballotdict['style_num']
+    style_rois_map_df = rois_map_df.loc[rois_map_df['style_num'] == style_num]
+    if not len(style_rois_map_df.index):
+        return None, segmented
+    style_ev_coord_index = (ev_coord_index or {}).get(str(style_num)) or build_style_ev_coord_index(style_rois_map_df)
+
+    ev_coord_map = style_ev_coord_index['ev_coord_map']
+    ev_coord_str_list = ballot.ballotdict['ev_coord_str_list']
+    if not style_ev_coord_index['complete'] \
+            or len(ev_coord_str_list) != ballot.ballotdict['ev_num_marks'] \
+            or not all(ev_coord_str in ev_coord_map for ev_coord_str in ev_coord_str_list) \
+            or any(ev_coord_map[ev_coord_str][1].startswith('writein') for ev_coord_str in ev_coord_str_list):
+        utils.sts(f"Barcodes alone do not determine the votes of ballot {ballot_id}, using OCR", 3)
+        return None, segmented
+
+    ballot.ballotdict['ev_contests'] = []
+    page_marks_lod = extract_marks_from_barcodes(ballot, style_rois_map_df, style_ev_coord_index)
+    return create_bmd_ballot_marks_df(ballot, page_marks_lod), segmented
+
+
 def analyze_bmd_dominion(argsdict, ballot, rois_map_df, contests_dod) -> pd.DataFrame:
     """
     This function extracts votes as specified in page_rois_map_df from one image.
@@ -743,6 +845,7 @@ def analyze_bmd_dominion(argsdict, ballot, rois_map_df, contests_dod) -> pd.Data
 def qrcode_to_style_num():
     pass
 
+@timing.timed('fuzzy_match')
 def bmd_match_options(ballot_id, contest, ocr_options, official_options_list) -> (bool, dict, dict):
     """ given list of ocr options for this contest, match with official options.
         special care is given to ballots with 'NO SELECTION MADE'
@@ -863,6 +966,7 @@ def parse_bmd_bottom_strlist_dom(votefor_list: list, bottom_strlist: list, ballo
 
 
 
+@timing.timed('fuzzy_match')
 def ev_match_options(ballot_id, contest, ocr_options, official_options_list) -> (bool, dict, dict):
     """ given list of ocr options for this contest, match with official options.
         special care is given to ballots with 'NO SELECTION MADE'
@@ -981,28 +1085,26 @@ def flatten_selected_options(ev_contests):
     return filtered_ocr_options
         
     
-def extract_marks_from_barcodes(ballot, style_rois_map_df: pd.DataFrame) -> list:
+def extract_marks_from_barcodes(ballot, style_rois_map_df: pd.DataFrame, style_ev_coord_index=None) -> list:
     """ failed to parse OCR to create page_marks_lod, but barcodes may exist.
         if the rois_map has been filled in with barcodes from earlier ballots, 
         then we can use them to complete the page_marks_lod
         
         algorithm:
         ballot contains 'ev_coord_str_list' which is the list of barcodes.
-        walk through the style_rois_map_df and build page_marks_lod
-        also have the list of ev_coord_str values.
+        style_ev_coord_index maps each barcode of the style to its (contest, option, row)
+        in style_rois_map_df. It is built here if not provided.
         
         for each contest, build a contest header no matter what.
-            for each option listed in style_rois_map:
-                if ev_coord_str is found in 'ev_coord_str_list'
-                    build a page_marks_lod record and append.
+            for each barcode found in the index, build a page_marks_lod record,
+            placed in the order of the rows of the style.
         
         if everything goes well, return the page_marks_lod, else None.        
     """
     ballot_id = ballot.ballotdict['ballot_id']
-    utils.sts(f"Processing ExpressVote Ballot ID:{ballot_id} using barcode data", 3)
-    #import pdb; pdb.set_trace()
-    page_marks_lod = []
-    ev_coord_str_list = ballot.ballotdict['ev_coord_str_list']                  # working copy of barcodes from this ballot (already normalized)
+    if utils.is_logged(3):
+        utils.sts(f"Processing ExpressVote Ballot ID:{ballot_id} using barcode data", 3)
+    ev_coord_str_list = ballot.ballotdict['ev_coord_str_list']                  # barcodes from this ballot (already normalized)
     if not ev_coord_str_list:
         if ballot.ballotdict['ev_num_marks'] > 0:
             string = "### EXCEPTION: no barcodes provided and num marks " \
@@ -1010,17 +1112,30 @@ def extract_marks_from_barcodes(ballot, style_rois_map_df: pd.DataFrame) -> list
                     + f"Some barcodes not found in rois_map:{', '.join(ev_coord_str_list)}"
             utils.exception_report(string)
             return []
-    
-    ev_coord_str_list_mutated = ev_coord_str_list.copy()                        # we remove options found from this mutated list to make sure we found them all
+
+    if style_ev_coord_index is None:
+        style_ev_coord_index = build_style_ev_coord_index(style_rois_map_df)
+    ev_coord_map = style_ev_coord_index['ev_coord_map']
     ocr_options = flatten_selected_options(ballot.ballotdict['ev_contests'])    # list of options may not be usable but we will try to use for writeins.
-    option_num = 0
 
-    for idx in range(len(style_rois_map_df.index)):
-        page_rois_dict = style_rois_map_df.iloc[idx]
+    # resolve each barcode to its row. ev_coord_idx is the first position of the barcode on the ballot,
+    # which also locates a possible writein name.
+    selected_rows = {}          # row: (ev_coord_str, ev_coord_idx)
+    barcodes_not_found = []
+    for ev_coord_idx, ev_coord_str in enumerate(ev_coord_str_list):
+        entry = ev_coord_map.get(ev_coord_str)
+        if entry is None or entry[2] in selected_rows:
+            barcodes_not_found.append(ev_coord_str)
+            continue
+        selected_rows[entry[2]] = (ev_coord_str, ev_coord_idx)
+    option_num = len(selected_rows)
+    if utils.is_logged(3):
+        utils.sts(f"Found {option_num} of {len(ev_coord_str_list)} barcodes {ev_coord_str_list}", 3)
+
+    page_marks_lod = []
+    for row in sorted(style_ev_coord_index['header_rows'] + list(selected_rows)):
+        contest, option = style_ev_coord_index['rows'][row]
 
-        contest = page_rois_dict['contest']
-        option = page_rois_dict['option']
-        
         marks_dict = create_empty_marks_dict()
 
         marks_dict['ballot_id']         = ballot_id
@@ -1030,55 +1145,28 @@ def extract_marks_from_barcodes(ballot, style_rois_map_df: pd.DataFrame) -> list
         marks_dict['option']            = option
         marks_dict['ev_precinct_id']    = ballot.ballotdict['ev_precinct_id']
 
-        if option.startswith(r'#'):
-            # contest header uses option starting with #, initialize parsing the next contest.
-            page_marks_lod.append(marks_dict)   # this appends the contest header
-            continue
-
-        if not ev_coord_str_list_mutated:
-            # already found all options as indicted by barcodes
-            continue    # we can't break here because we need to fill in all the contest headers.
-
-        this_option_ev_coord_str = normalize_ev_coord_str(page_rois_dict['ev_coord_str'])
-        # the barcode value for this option determined during template generation,
-        # normalization deals with possible leading zero that might be missing if encoded as integer.
-        # and removal of extra quotes to try to keep those zeros.
-        
-        utils.sts(f"Looking for option [{this_option_ev_coord_str}] in {ev_coord_str_list}", 3)
-        
-        try:
-            ev_coord_idx = ev_coord_str_list.index(this_option_ev_coord_str)
-            # important, cannot use the mutated list above so we can access a possible writein name.
-        except ValueError:
-            # this rois_map entry not selected in this ballot.
-            # this case is not unusual
-            utils.sts("Not found", 3)
-            continue
-            
-        # we found barcode value for this option.
-        utils.sts(f"Found at index {ev_coord_idx}", 3)
-        marks_dict['has_indication'] = 'DefiniteMark'
-        marks_dict['num_marks'] = 1
-        marks_dict['pixel_metric_value'] = 100
-        marks_dict['ev_coord_str'] = this_option_ev_coord_str
-        if option.startswith('writein'):
-            try:
-                writein_name = ocr_options[ev_coord_idx]
-                marks_dict['writein_name'] = writein_name 
-            except:
-                pass
-        ev_coord_str_list_mutated.remove(this_option_ev_coord_str)
+        if row in selected_rows:
+            this_option_ev_coord_str, ev_coord_idx = selected_rows[row]
+            marks_dict['has_indication'] = 'DefiniteMark'
+            marks_dict['num_marks'] = 1
+            marks_dict['pixel_metric_value'] = 100
+            marks_dict['ev_coord_str'] = this_option_ev_coord_str
+            if option.startswith('writein'):
+                try:
+                    writein_name = ocr_options[ev_coord_idx]
+                    marks_dict['writein_name'] = writein_name 
+                except:
+                    pass
         page_marks_lod.append(marks_dict)
-        option_num += 1
     
-    if len(ev_coord_str_list_mutated) or not option_num == ballot.ballotdict['ev_num_marks']:
+    if len(barcodes_not_found) or not option_num == ballot.ballotdict['ev_num_marks']:
         # this exception will be hit if the style_rois_map does not exist.
         # That can happen if no hand-marked ballots exist in the precinct, i.e. if they are all
         # ev ballots. We can't extract the barcodes if we don't know the ev_coord_str values for each option.
         
         string = f"### EXCEPTION: number of options found:{option_num} " \
                 + f"does not match value:{ballot.ballotdict['ev_num_marks']} in ev header for ballot_id:{ballot_id}\n" \
-                + f"Some barcodes not found in rois_map:{', '.join(ev_coord_str_list_mutated)}\n" \
+                + f"Some barcodes not found in rois_map:{', '.join(barcodes_not_found)}\n" \
                 + "Possibly [Known_Limitation_001]: BMD ballots cannot be converted with no nonBMD ballots"
         utils.exception_report(string)
     return page_marks_lod
@@ -1127,6 +1215,8 @@ def print_marks_dict_contest(marks_dict):
     utils.sts(string, 3)
 
 def print_contest_marks_lod(contest_marks_lod):
+    if not utils.is_logged(3):
+        return
     for marks_dict in contest_marks_lod:
         print_marks_dict_contest(marks_dict)
 
@@ -1239,6 +1329,7 @@ def det_adaptive_thresholds(pmv_list):
             
 
 
+@timing.timed('thresholding')
 def evaluate_thresholds(ballot, page_marks_lod):
     """
     This function evaluates the marks on a ballot and classifies them as
@@ -1274,7 +1365,8 @@ def evaluate_thresholds(ballot, page_marks_lod):
             marks_dict['has_indication'] = 'DefiniteMark'
             marks_dict['num_marks'] = 1
 
-    utils.sts(f"Thresholds set to {marginal_thres} and {definite_thres}", 3)
+    if utils.is_logged(3):
+        utils.sts(f"Thresholds set to {marginal_thres} and {definite_thres}", 3)
 
     ballot.ballotdict['marginal_thres'] = marginal_thres
     ballot.ballotdict['definite_thres'] = definite_thres
@@ -1504,6 +1596,7 @@ def create_midmarks_list(page_timing_marks: dict, h_or_v = 'v') -> list:
         midmarks = [(h_marks[i]['x'] + round(h_marks[i]['w']/2)) for i in range(len(h_marks))]
     return midmarks
     
+@timing.timed('pixel_metrics')
 def analyze_one_image_by_page_rois_map_df(argsdict, ballot, page, page_rois_map_df, page_marks_lod, layout_params):
     """
     extract votes as specified in page_rois_map_df from one image.
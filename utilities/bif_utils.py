@@ -9,20 +9,24 @@ import re
 import sys
 #import traceback
 import json
+import concurrent.futures
 from pyzbar.pyzbar import decode as barcode_decode
 import pprint
+try:
+    import orjson as fast_json
+except ImportError:
+    fast_json = None
 
 import pandas as pd
 
 #from models.Job import Job
-from utilities import utils, args, logs
+from utilities import utils, args, logs, timing
 from utilities.zip_utils import open_archive, get_image_file_paths_from_archive,\
     get_next_ballot_paths, analyze_ballot_filepath, get_precinct, get_party, \
     is_archived_file_BMD_type_ess, open_zip_archive, extract_file, get_file_paths
 from utilities.styles_from_cvr_converter import convert_cvr_to_styles_ess
 from utilities.vendor import dominion_build_effective_style_num, update_CONV_card_code_TO_ballot_type_id_DICT
 from utilities import config_d
-from utilities.ocr import ocr_text
 #from aws_lambda.core import invoke_lambda
 from utilities.barcode_parser import get_parsed_barcode
 from utilities import launcher
@@ -85,27 +89,36 @@ def filter_extraction_ballots(argsdict, reduced_df):
     all_mapped_styles = DB.get_style_nums_with_templates(argsdict)
     utils.sts(f"There are a total of {len(all_mapped_styles)} styles mapped.", 3)
     
-    included_styles = argsdict.get('include_style_num')
+    filtered_styles = set(all_mapped_styles)
+    included_styles = set(argsdict.get('include_style_num') or [])
     if included_styles:
-        filtered_styles = [i for i in all_mapped_styles if i in included_styles]
+        filtered_styles &= included_styles
         utils.sts(f"The settings file includes list of styles to include. Filtered to {len(filtered_styles)} styles.", 3)
-    else:
-        filtered_styles = all_mapped_styles
 
-    excluded_styles = argsdict.get('exclude_style_num')
+    excluded_styles = set(argsdict.get('exclude_style_num') or [])
     if excluded_styles:
-        filtered_styles = [i for i in filtered_styles if not i in excluded_styles]
+        filtered_styles -= excluded_styles
         utils.sts(f"The settings file includes list of styles to exclude. Filtered to {len(filtered_styles)} styles.", 3)
 
+    # build a single mask so the BIF is copied only once.
+    keep = pd.Series(True, index=reduced_df.index)
     if excluded_styles or included_styles:
-        reduced_df = reduced_df[reduced_df['style_num'].isin(filtered_styles)]
+        # style_num is categorical in the BIF, so match against its categories
+        # and let the categorical isin test codes rather than each ballot's string.
+        style_col = reduced_df['style_num']
+        if hasattr(style_col, 'cat'):
+            filtered_styles = [style for style in style_col.cat.categories if style in filtered_styles]
+        keep &= style_col.isin(filtered_styles)
 
     if not argsdict['include_bmd_ballot_type']:
-        reduced_df = reduced_df.loc[reduced_df['is_bmd'] != 1]
-        utils.sts(f"The settings file excludes BMD ballots. Filtered to {len(reduced_df.index)} styles.", 3)
+        keep &= reduced_df['is_bmd'] != 1
+        utils.sts("The settings file excludes BMD ballots.", 3)
     if not argsdict['include_nonbmd_ballot_type']:
-        reduced_df = reduced_df.loc[reduced_df['is_bmd'] == 1]
-        utils.sts(f"The settings file excludes nonBMD ballots. Filtered to {len(reduced_df.index)} styles.", 3)
+        keep &= reduced_df['is_bmd'] == 1
+        utils.sts("The settings file excludes nonBMD ballots.", 3)
+
+    if not keep.all():
+        reduced_df = reduced_df.loc[keep]
 
     logs.sts(f"Total number of ballots after filters applied for extraction: {len(reduced_df.index)}", 3)
 
@@ -303,6 +316,7 @@ def read_pstyle_from_image(image, pstyle_region_dict, pstyle_pattern):
     if pstyle_region_dict:
         # use this field in ES&S case for printed style number for now.
         # card_code not fully decoded and not sure if it creates this value. 
+        from utilities.ocr import ocr_text     # imported on use, so bif chunks without pstyle do not import tesseract.
         working_image = utils.extract_region(image, pstyle_region_dict)
         pstyle_num = ocr_text(working_image)
         if pstyle_pattern:
@@ -340,7 +354,8 @@ def create_bif_dict_by_reading_ballot(argsdict, ballot_id, index, archive_basena
     pstyle_num = read_pstyle_from_image(ballot.ballotimgdict['images'][0], pstyle_region_dict, pstyle_pattern)
     if pstyle_num:
         row['style_num'] = pstyle_num
-    utils.sts(f"bif record:{pprint.pformat(row)}", 3)
+    if utils.is_logged(3):
+        utils.sts(f"bif record:{pprint.pformat(row)}", 3)
     return row
     
 
@@ -429,6 +444,8 @@ def genbif_from_ballots(argsdict: dict):
         logs.get_and_merge_s3_logs(dirname='bif', rootname='log', chunk_pat=fr'{archive_rootname}_{dirname}_chunk_\d+', subdir='chunks')
         logs.get_and_merge_s3_logs(dirname='bif', rootname='exc', chunk_pat=fr'{archive_rootname}_{dirname}_chunk_\d+', subdir='chunks')
 
+    timing.report_phase_timing(dirname='bif')
+
 
 
 def build_one_chunk(argsdict, dirname, subdir=None, chunk_idx=None, filelist=None, group_name='', task_name='', incremental=False):
@@ -552,40 +569,27 @@ def delegated_build_bif_chunk(dirname, task_args, s3flag=None):
 
 
 
-def parse_dominion_cvr_chunks_to_dict(argsdict: dict, cvr_path: str) -> dict:
-    """
-        Using Lambdas for this operation was found not to be necessary once
-        we optimized the operation of creating the pandas tables.
+DOMINION_CVR_TABLE_COLUMNS = ['ballot_id', 'is_bmd', 'card_code', 'ballot_type_id', 'sheet0', 'style_num', 'cvr_name']
 
-        read json CVR file in Dominion format.
-        create dict keyed by ballot_id with dict of attributes.
-        'ballot_type_id'    - 1-180 code BallotTypeId from CVR
-        'is_bmd'               - 1 if ballot is bmd
-        'card_code'         - style code found on the ballot
-        'cvr_name'          - name of the cvr chunk (filename without path)
-        'style_num'         - style indicator (str)
-        'sheet0'            - sheet value decoded from card_code
-        
-        This is not currently extracting the list of contests included in the CVR.
-        
 
+def parse_dominion_cvr_members(argsdict: dict, cvr_path: str, names: list) -> list:
     """
-    cvr_dict = {}
-    cvr_reg = r'CvrExport_\d+\.json'
+        Parse the listed CvrExport_NNN.json members of the Dominion CVR zip archive at cvr_path
+        and return list of records in the order of DOMINION_CVR_TABLE_COLUMNS, one per session.
+        This is a module-level function so it can be executed in a process pool; each call
+        opens the archive separately.
+    """
+    loads = fast_json.loads if fast_json else json.loads
+    records = []
     archive = open_zip_archive(cvr_path)
-    cvrlist = [n for n in archive.namelist() if re.match(cvr_reg, n)]
-    total_num = len(cvrlist)
-    for index, name in enumerate(cvrlist):
+    for name in names:
         cvr_name = os.path.basename(name)
-        if (index+1) % 100 == 0:
-            utils.sts(f"Parsing CVR JSON file {cvr_name} #{index}: of {total_num} ({round(100 * (index+1) / total_num, 2)}%)")
-
-        data = json.loads(archive.read(name))
+        data = loads(archive.read(name))
         for session in data['Sessions']:
             tabulator_id = session.get('TabulatorId')
             batch_id = session.get('BatchId')
             record_id = session.get('RecordId')
-            is_bmd = True if session.get('SessionType') == 'QRVote' else False
+            is_bmd = 1 if session.get('SessionType') == 'QRVote' else 0
             try:
                 card_code = session['Original']['Cards'][0]['Id']
             except KeyError:
@@ -598,16 +602,119 @@ def parse_dominion_cvr_chunks_to_dict(argsdict: dict, cvr_path: str) -> dict:
             style_num, sheet0 = dominion_build_effective_style_num(argsdict, card_code, ballot_type_id)
 
             ballot_id = f'{tabulator_id:05d}_{batch_id:05d}_{record_id:06d}'
-            cvr_dict[ballot_id] = {
-                'is_bmd': is_bmd,
-                'cvr_name': cvr_name,
-                'style_num': style_num,             # internal style number LPSETTT Lang, Party, Sheet, ETTT ExternalId , ballot_type_id
-                'card_code': str(card_code),
-                'ballot_type_id': int(ballot_type_id),
-                'sheet0': sheet0,
-            }
+            style_num = '' if style_num is None else str(style_num)
+            # sheet0 is kept as str so a None does not turn the column to float.
+            sheet0 = '' if sheet0 is None else str(int(sheet0))
+            records.append((ballot_id, is_bmd, str(card_code), int(ballot_type_id), sheet0, style_num, cvr_name))
+    archive.close()
+    return records
+
+
+def get_dominion_cvr_table_signature(argsdict: dict, cvr_path: str) -> dict:
+    """ identify the CVR file and the settings that affect the parsed table, so a cached table can be validated.
+        The CVR file is identified by the hash of its content, as the modification time is not preserved
+        when the file is copied or downloaded again.
+        The settings are all those read by dominion_build_effective_style_num(), which sets style_num and sheet0,
+        including the card_code conversion file that is used when the CVR does not provide BallotTypeId.
+    """
+    return {
+        'table_version':                3,      # tables cached before this are parsed again.
+        'cvr_basename':                 os.path.basename(cvr_path),
+        'cvr_hash':                     DB.get_local_file_hash(cvr_path),
+        'election_name':                argsdict.get('election_name', ''),
+        'conv_card_code_to_style_num':  bool(argsdict.get('conv_card_code_to_style_num')),
+        'non_partisan_sheet0s':         sorted(str(sheet0) for sheet0 in argsdict.get('non_partisan_sheet0s') or []),
+        'card_code_conv_hash':          DB.get_file_hash(dirname='styles', name='CONV_card_code_TO_ballot_type_id_DICT.json'),
+        }
+
 
-    return cvr_dict
+def parse_dominion_cvr_to_df(argsdict: dict, cvr_path: str) -> pd.DataFrame:
+    """
+        read json CVR zip file in Dominion format and return compact table with columns
+        DOMINION_CVR_TABLE_COLUMNS, one record per ballot.
+
+        For SF-sized elections, there are tens of thousands of CvrExport_NNN.json members,
+        so the members are split into batches which are parsed in a process pool of 
+        'dominion_cvr_parse_workers' processes. orjson is used if installed.
+        
+        The resulting table is cached at bif/{cvr_rootname}_cvr_table.csv with a signature
+        of the CVR file in bif/{cvr_rootname}_cvr_table.json so later runs of genbif_from_cvr
+        do not parse the CVR again.
+    """
+    cvr_rootname = os.path.splitext(os.path.basename(cvr_path))[0]
+    table_name = f"{cvr_rootname}_cvr_table"
+    signature = get_dominion_cvr_table_signature(argsdict, cvr_path)
+
+    cached_signature = DB.load_data(dirname='bif', name=f"{table_name}.json", silent_error=True)
+    if cached_signature == signature:
+        cvr_df = DB.load_data(dirname='bif', name=f"{table_name}.csv", silent_error=True,
+                              dtype={'ballot_id': str, 'card_code': str, 'sheet0': str, 'style_num': str, 'cvr_name': str})
+        if cvr_df is not None:
+            utils.sts(f"Using cached CVR table {table_name}.csv, {len(cvr_df.index)} records.", 3)
+            return cvr_df
+
+    cvr_reg = r'CvrExport_\d+\.json'
+    archive = open_zip_archive(cvr_path)
+    cvrlist = [n for n in archive.namelist() if re.match(cvr_reg, n)]
+    archive.close()
+    total_num = len(cvrlist)
+
+    num_workers = argsdict.get('dominion_cvr_parse_workers') or os.cpu_count() or 1
+    if utils.on_lambda():
+        # lambdas do not support multiprocessing pools.
+        num_workers = 1
+    num_workers = max(1, min(num_workers, total_num))
+    
+    # batches are large enough to amortize opening the archive in each process.
+    batch_size = max(100, -(-total_num // (num_workers * 4))) if total_num else 1
+    batches = [cvrlist[i:i + batch_size] for i in range(0, total_num, batch_size)]
+    utils.sts(f"Parsing {total_num} CVR JSON files in {len(batches)} batches using {num_workers} processes")
+
+    records = []
+    if num_workers == 1:
+        for batch_idx, batch in enumerate(batches):
+            records.extend(parse_dominion_cvr_members(argsdict, cvr_path, batch))
+            utils.sts(f"Parsed CVR batch #{batch_idx} of {len(batches)}")
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+            # map preserves batch order so the table order matches the serial result.
+            for batch_idx, batch_records in enumerate(
+                    executor.map(parse_dominion_cvr_members, [argsdict] * len(batches), [cvr_path] * len(batches), batches)):
+                records.extend(batch_records)
+                utils.sts(f"Parsed CVR batch #{batch_idx} of {len(batches)}")
+
+    cvr_df = pd.DataFrame.from_records(records, columns=DOMINION_CVR_TABLE_COLUMNS)
+    
+    DB.save_data(data_item=cvr_df, dirname='bif', name=f"{table_name}.csv")
+    DB.save_data(data_item=signature, dirname='bif', name=f"{table_name}.json")
+    
+    return cvr_df
+
+
+def parse_dominion_cvr_chunks_to_dict(argsdict: dict, cvr_path: str) -> dict:
+    """
+        Using Lambdas for this operation was found not to be necessary once
+        we optimized the operation of creating the pandas tables.
+
+        read json CVR file in Dominion format.
+        create dict keyed by ballot_id with dict of attributes.
+        'ballot_type_id'    - 1-180 code BallotTypeId from CVR
+        'is_bmd'               - 1 if ballot is bmd
+        'card_code'         - style code found on the ballot
+        'cvr_name'          - name of the cvr chunk (filename without path)
+        'style_num'         - style indicator (str)
+        'sheet0'            - sheet value decoded from card_code
+        
+        This is not currently extracting the list of contests included in the CVR.
+        The table is produced, and cached, by parse_dominion_cvr_to_df()
+
+    """
+    cvr_df = parse_dominion_cvr_to_df(argsdict, cvr_path)
+    cvr_df['is_bmd'] = cvr_df['is_bmd'].astype(bool)
+    
+    # as before, if a ballot_id is repeated, the last record dominates.
+    cvr_df = cvr_df.drop_duplicates(subset='ballot_id', keep='last')
+    return cvr_df.set_index('ballot_id').to_dict(orient='index')
 
 
 global archive
@@ -886,20 +993,32 @@ def create_bif_report(argsdict):
     utils.sts(f"bmds\n{bmdsdf[['ballot_id','precinct','party','style_num','card_code']]}")
 
 
+TASKLISTS_PACKED_NAME = 'tasklists.bin'
+TASKLISTS_INDEX_NAME = 'tasklists_index.json'
+
+
 def build_dirname_tasks(argsdict, dirname, subdir=None, ballots_per_chunk=200):
     """ with all bif chunks created, scan them and create tasks in dirname.
         each task contains records from bif for ballots to be included
         in the processing chunk. These are written to extraction_tasklists folder.
         For lambdas processing mode, these tasklists could launch an extraction lambda
+        
+        If 'use_packed_tasklists' is set, the csv of all tasklists are packed into a single file,
+            {dirname}/{subdir}/tasklists.bin
+        with the offset and length of each tasklist in
+            {dirname}/{subdir}/tasklists_index.json
+        rather than writing one csv file per tasklist.
     """
 
     utils.sts(f"Building tasklists to {dirname}/{subdir}...", 3)
 
     bifpaths = get_biflist(argsdict)     # returns either s3path list or pathlist, depending on argsdict['use_s3_results']
     max_concurrency = argsdict.get('max_lambda_concurrency', 1000)
+    use_packed_tasklists = argsdict.get('use_packed_tasklists', True)
 
     tasks_queued = 0
     total_ballots_queued = 0
+    tasklists_dodf = {}
     
     DB.delete_dirname_files_filtered(dirname=dirname, subdir=subdir)
 
@@ -936,21 +1055,104 @@ def build_dirname_tasks(argsdict, dirname, subdir=None, ballots_per_chunk=200):
 
         for chunk_index, chunk_df in enumerate (chunks_lodf):
             chunk_name = f"{archive_name}_chunk_{'%4.4u' % (chunk_index)}.csv"
-            utils.sts(f"Creating {dirname} chunk: {chunk_name}...", 3)
             
-            DB.save_data(
-                data_item=chunk_df, 
-                dirname=dirname,
-                subdir=subdir,
-                name=chunk_name, 
-                )
+            if use_packed_tasklists:
+                tasklists_dodf[chunk_name] = chunk_df
+            else:
+                utils.sts(f"Creating {dirname} chunk: {chunk_name}...", 3)
+                DB.save_data(
+                    data_item=chunk_df, 
+                    dirname=dirname,
+                    subdir=subdir,
+                    name=chunk_name, 
+                    )
             tasks_queued += 1
             total_ballots_queued += len(chunk_df.index)
 
+    if use_packed_tasklists:
+        utils.sts(f"Writing {tasks_queued} {dirname} tasklists packed in {TASKLISTS_PACKED_NAME}...", 3)
+        save_packed_tasklists(tasklists_dodf, dirname=dirname, subdir=subdir)
 
     utils.sts(f"Total of {tasks_queued} {dirname} tasks queued with a total of {total_ballots_queued} ballots.", 3)
 
 
+def save_packed_tasklists(tasklists_dodf, dirname, subdir=None):
+    """ save the tasklists {tasklist_name: tasklist_df} as csv packed in one file,
+        with the offset and length of each in the index.
+    """
+    buffs = []
+    offset = 0
+    tasklists_index = {}
+    for tasklist_name, tasklist_df in tasklists_dodf.items():
+        buff = tasklist_df.to_csv(None, index=False).encode('utf-8')
+        tasklists_index[tasklist_name] = {
+            'offset':       offset,
+            'length':       len(buff),
+            'num_ballots':  len(tasklist_df.index),
+            }
+        buffs.append(buff)
+        offset += len(buff)
+
+    DB.save_data(data_item=b''.join(buffs), dirname=dirname, subdir=subdir, name=TASKLISTS_PACKED_NAME)
+    DB.save_data(data_item=tasklists_index, dirname=dirname, subdir=subdir, name=TASKLISTS_INDEX_NAME)
+    return tasklists_index
+
+
+def get_tasklist_names(dirname, subdir=None):
+    """ return the names of the tasklists in dirname/subdir, like {archive_root}_chunk_{chunk_idx}.csv
+        from the index of packed tasklists, if they are packed, to avoid listing the folder.
+    """
+    tasklists_index = DB.load_data(dirname=dirname, subdir=subdir, name=TASKLISTS_INDEX_NAME, silent_error=True)
+    if tasklists_index is None:
+        return DB.list_files_in_dirname_filtered(dirname=dirname, subdir=subdir, file_pat=r'^[^~].*\.csv$', fullpaths=False)
+    return list(tasklists_index)
+
+
+def get_tasklists(argsdict, dirname, subdir=None):
+    """ return list of tasklist descriptors [(tasklist_name, tasklist_spec)] in dirname/subdir,
+        where tasklist_name is like {archive_root}_chunk_{chunk_idx}.csv
+        
+        If the tasklists are packed, tasklist_spec provides the tasklist without another list or read:
+            {'csv': str}                    -- the csv of tasklists no longer than 'tasklist_payload_max_bytes',
+                                                which is passed in the task payload.
+            {'offset': int, 'length': int}  -- the location in the packed file, for a single ranged read.
+        Otherwise, tasklist_spec is None and the tasklist is read from its own file.
+    """
+    tasklists_index = DB.load_data(dirname=dirname, subdir=subdir, name=TASKLISTS_INDEX_NAME, silent_error=True)
+    if tasklists_index is None:
+        tasklist_names = DB.list_files_in_dirname_filtered(dirname=dirname, subdir=subdir, file_pat=r'^[^~].*\.csv$', fullpaths=False)
+        return [(tasklist_name, None) for tasklist_name in tasklist_names]
+
+    payload_max_bytes = argsdict.get('tasklist_payload_max_bytes', 65536)
+    packed_buff = None
+    if any(entry['length'] <= payload_max_bytes for entry in tasklists_index.values()):
+        # read the packed file once to embed the small tasklists in the task payloads.
+        packed_buff = DB.load_data_range(dirname=dirname, subdir=subdir, name=TASKLISTS_PACKED_NAME,
+                        offset=0, length=sum(entry['length'] for entry in tasklists_index.values()))
+
+    tasklists = []
+    for tasklist_name, entry in tasklists_index.items():
+        if entry['length'] <= payload_max_bytes:
+            tasklist_spec = {'csv': packed_buff[entry['offset']:entry['offset'] + entry['length']].decode('utf-8')}
+        else:
+            tasklist_spec = {'offset': entry['offset'], 'length': entry['length']}
+        tasklists.append((tasklist_name, tasklist_spec))
+    return tasklists
+
+
+def load_tasklist_df(dirname, tasklist_name, tasklist_spec=None, subdir=None):
+    """ return the tasklist as df, from tasklist_spec as provided by get_tasklists()
+        or from its own file if tasklist_spec is None.
+    """
+    if tasklist_spec is None:
+        return DB.load_data(dirname=dirname, subdir=subdir, name=tasklist_name)
+    if 'csv' in tasklist_spec:
+        return DB.buff_csv_to_df(tasklist_spec['csv'])
+    buff = DB.load_data_range(dirname=dirname, subdir=subdir, name=TASKLISTS_PACKED_NAME,
+                offset=tasklist_spec['offset'], length=tasklist_spec['length'])
+    return DB.buff_csv_to_df(buff.decode('utf-8'))
+
+
 def parse_tasklist_name(tasklist_name):
     """ pull out the group_name, chunk_idx from tasklist_name
         tasklist_name has the following format:
@@ -4,8 +4,8 @@ import os
 import sys
 import traceback
 
-from utilities import utils, args, logs
-from utilities.bif_utils import build_one_chunk #, parse_tasklist_name
+from utilities import utils, args, logs, timing
+from utilities.bif_utils import build_one_chunk, get_tasklist_names #, parse_tasklist_name
 from utilities.cvr_comparator import compare_chunk_with_cvr 
 #from utilities import launcher
 
@@ -27,7 +27,7 @@ def cmpcvr_by_tasklists(argsdict: dict):
 
     # get the list of all extraction tasks in marks/tasks/ subfolder, without .csv extension.
     # name is like {archive_root}_chunk_{chunk_idx}.csv 
-    tasklists = DB.list_files_in_dirname_filtered(dirname='marks', subdir='tasks', file_pat=r'.*\.csv$', fullpaths=False, no_ext=True)
+    tasklists = [os.path.splitext(name)[0] for name in get_tasklist_names(dirname='marks', subdir='tasks')]
     total_num = len(tasklists)
     utils.sts(f"Found {total_num} tasklists", 3)
 
@@ -36,6 +36,10 @@ def cmpcvr_by_tasklists(argsdict: dict):
     if use_lambdas:
         LambdaTracker.clear_requests()
 
+    if argsdict.get('use_cvr_shards'):
+        # split the CVR once here so each chunk loads only the shards its ballots are in.
+        CVR.build_cvr_shards(argsdict, ballots_per_shard=argsdict.get('cvr_ballots_per_shard', 5000))
+
     # The 'extraction_tasks' are ordered also according to archive_root.
 
     archive_rootnames = []                     
@@ -91,6 +95,8 @@ def cmpcvr_by_tasklists(argsdict: dict):
             
         logs.get_and_merge_s3_logs(dirname='cmpcvr', rootname='log', chunk_pat=fr'{archive_rootname}_chunk_\d+', subdir='chunks')
         logs.get_and_merge_s3_logs(dirname='cmpcvr', rootname='exc', chunk_pat=fr'{archive_rootname}_chunk_\d+', subdir='chunks')
+
+    timing.report_phase_timing(dirname='cmpcvr')
         
 
 def delegated_cmpcvr(dirname, task_args, s3flag=None): 
@@ -114,9 +120,7 @@ def cmpcvr_by_one_tasklist(argsdict, tasklist_name):
     # set s3 vs local mode -- this probably better done long before this point.
     DB.set_DB_mode()        
 
-    contests_dod = DB.load_data('styles', 'contests_dod.json')
-    if CVR.data_frame.empty:
-        CVR.load_cvrs_to_df(argsdict)
+    contests_dod = DB.load_data_cached('styles', 'contests_dod.json')
     
     #        marks/chunks/{archive_root}_chunk_{chunk_idx}.csv           # individual marks chunks. These are kept for cmpcvr
 
@@ -127,6 +131,12 @@ def cmpcvr_by_one_tasklist(argsdict, tasklist_name):
         sys.exit(1)
 
     audit_df = DB.load_data(dirname='marks', subdir="chunks", name=tasklist_name, format='.csv')
+
+    if argsdict.get('use_cvr_shards'):
+        # load only the CVR shards that include the ballots in this chunk.
+        CVR.load_cvr_shards_for_ballot_ids(audit_df['ballot_id'])
+    elif CVR.data_frame.empty or CVR.loaded_job_name != argsdict.get('job_name', ''):
+        CVR.load_cvrs_to_df(argsdict)
     
     #---------------------------------------
     # primary call of this function performs chunk comparison
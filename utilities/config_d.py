@@ -46,6 +46,8 @@ config_dict = {
 
     'CHECKBOX_BORDER_WIDTH': 2,
     'LAYERS_FOR_EMPTY_BALLOT': 50,
+    'TEMPLATE_TRIM_FRACTION': 0.2,
+    'TEMPLATE_REFERENCE_SAMPLE': 5,
     'INITIAL_SEARCH_VALUES': 10000,
     'CODE_MEAN_OFFSET': 40.0,
     'BALLOT_LEFT_PART_BORDER': 1700,
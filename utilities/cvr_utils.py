@@ -254,6 +254,46 @@ def required_fields_exist(required_field_list: list, actual_field_list: list):
         if not item in actual_field_list: return False
     return True
 
+def get_style_to_contests_matrix(data_frame, contests: list, style_col: str='Ballot Style') -> pd.DataFrame:
+    """ 
+    Returns boolean df indexed by style, with one column per contest in the order of the CVR,
+    True if any ballot of that style has a value in that contest.
+    This is computed in one pass over a non-empty mask of the contest columns, grouped by
+    style with an any-reduction, instead of slicing the CVR per style.
+    Duplicated column names, as produced by rename_unnamed, are each retained.
+    Styles are in the order of first appearance, same as data_frame[style_col].unique()
+    """
+    contest_set = set(contests)
+    col_positions = [idx for idx, col in enumerate(data_frame.columns) if col in contest_set and col != style_col]
+    non_empty = data_frame.iloc[:, col_positions].notna().to_numpy()
+    style_codes, styles = pd.factorize(data_frame[style_col])
+    
+    # rows with no style have code -1 and are not included.
+    has_style = style_codes >= 0
+    matrix_df = pd.DataFrame(non_empty[has_style]).groupby(style_codes[has_style], sort=True).any()
+    matrix_df = matrix_df.reindex(range(len(styles)), fill_value=False)
+    matrix_df.index = styles
+    matrix_df.columns = data_frame.columns[col_positions]
+    return matrix_df
+    
+
+def style_to_contests_dol_from_matrix(matrix_df: pd.DataFrame, ballot_styles=None) -> dict:
+    """ convert matrix_df from get_style_to_contests_matrix() to style_to_contests_dol
+        in the order of ballot_styles, if provided.
+        contest names that are duplicated in columns are listed once.
+        styles which are missing from matrix_df, such as NaN, have no contests.
+    """
+    contest_names = matrix_df.columns.to_numpy()
+    row_lookup = dict(zip(matrix_df.index, matrix_df.to_numpy()))
+    if ballot_styles is None:
+        ballot_styles = matrix_df.index
+    
+    style_to_contests_dol = collections.OrderedDict()
+    for ballot_style in ballot_styles:
+        style_to_contests_dol[ballot_style] = list(dict.fromkeys(contest_names[row_lookup.get(ballot_style, [])]))
+    return style_to_contests_dol
+
+
 def create_contests_dod(argsdict) -> dict:  # ordered dict of dict (dod)
     """
     create the contests_dod (ordered dict of dict) which provides information about all contests
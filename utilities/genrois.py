@@ -6,6 +6,7 @@ import numpy as np
 import cv2
 import json
 import sys
+import concurrent.futures
 #import statistics
 
 from utilities import utils, args, images_utils, logs
@@ -17,7 +18,9 @@ from utilities.images_utils import draw_boxes_on_image
 from utilities.alignment_utils import find_boxes, select_boxes, filter_boxes_by_region
 from utilities.analysis_utils import create_midgap_list
 from models.DB import DB
-from utilities.ocr import ocr_text, ocr_to_tsv, ocr_tsv_to_ocrdf, ocr_various_modes, ocr_word, log_misspelled_words
+from utilities.ocr import ocr_text_batch, ocr_to_tsv, ocr_tsv_to_ocrdf, ocr_various_modes, log_misspelled_words, \
+    configure_ocr_cache, load_ocr_cache, save_ocr_cache, pop_new_ocr_cache_entries, add_ocr_cache_entries, \
+    load_ocr_cache_once, save_ocr_cache_delta, merge_ocr_cache_deltas, set_pool_ocr_workers
 
 
 def clean_candidate_name(raw_name):
@@ -368,7 +371,8 @@ def find_and_draw_lines_in_regions(argsdict: dict, style_dict, style_num, page0,
                 if y_loc < last_line_drawn_y + reg['h_min']: continue
                 
                 reg_x, reg_w = reg['x'], reg['w']
-                utils.sts(f"Checking for line at x:{reg_x}, y:{y_loc}, w:{reg_w}", 3)
+                if utils.is_logged(3):
+                    utils.sts(f"Checking for line at x:{reg_x}, y:{y_loc}, w:{reg_w}", 3)
                 core_line = image[(y_loc-1):(y_loc+2), (reg_x + 10):(reg_x + reg_w - 10)].copy()
                 metric = sum(cv2.mean(core_line))
                 if metric < 20:
@@ -505,7 +509,8 @@ def page_rois_list_by_ocr(argsdict, image, page_rois_list, style_num, page0=0):
     utils.sts("Analyzing page_rois_list by ocr", 3)
     new_page_rois_list = []
     for index, blk_region in enumerate(page_rois_list):
-        utils.sts(f"Processing block_roi {index}: {blk_region}", 3)
+        if utils.is_logged(3):
+            utils.sts(f"Processing block_roi {index}: {blk_region}", 3)
         # use clear method to extract the region so coordinates are unaltered.
         working_image = utils.extract_region(image, blk_region, mode='clear')
         DB.save_one_image_area_dirname(
@@ -516,7 +521,7 @@ def page_rois_list_by_ocr(argsdict, image, page_rois_list, style_num, page0=0):
             image       = working_image)
         
         # ocr the region and return df of words and coordinates.
-        tsv_str = ocr_to_tsv(working_image)
+        tsv_str = ocr_to_tsv(working_image, cache=True)
         ocrdf = ocr_tsv_to_ocrdf(tsv_str)
         DB.save_data(tsv_str, dirname='styles', name=f"ocr_result region_{index}.tsv", format='.txt', subdir = f"{style_num}/rois_parts")
         
@@ -811,7 +816,8 @@ def insert_rois_in_gaps(argsdict, style_dict, style_num, sheet0, p, page_rois_li
         b = y + h
         column = x // column_width
         
-        utils.sts(f"roi {idx} at x:{x} y:{y} w:{w} h:{h}", 3)
+        if utils.is_logged(3):
+            utils.sts(f"roi {idx} at x:{x} y:{y} w:{w} h:{h}", 3)
             
         if not idx:
             # first time through. Set page_top.
@@ -847,7 +853,8 @@ def insert_rois_in_gaps(argsdict, style_dict, style_num, sheet0, p, page_rois_li
         added_rois_list.append(new_roi)
         
         b_prior_roi = b
-        utils.sts(f'ROI {idx}:Inserted Roi in the gap', 3)
+        if utils.is_logged(3):
+            utils.sts(f'ROI {idx}:Inserted Roi in the gap', 3)
         # skip the current roi which now has idx+1 index.
         # note this manipulation of idx requires a 'while' loop
         idx += 2
@@ -894,7 +901,8 @@ def split_roi_at_first_white_gap(image, roi, lft_mgn, min_gap, gap_split_offset,
     log_split_details = False   # if true, show the first part of each image line as text graphics
     
     cnt_x = roi["x"]; cnt_y = roi["y"]; cnt_w = roi["w"]; cnt_h = roi["h"]
-    utils.sts(f'p:{roi["p"]} x:{cnt_x} y:{cnt_y} w:{cnt_w} h:{cnt_h} min_gap:{min_gap} ', 3, end='')
+    if utils.is_logged(3):
+        utils.sts(f'p:{roi["p"]} x:{cnt_x} y:{cnt_y} w:{cnt_w} h:{cnt_h} min_gap:{min_gap} ', 3, end='')
 
 
     #min_line = 54
@@ -1028,7 +1036,8 @@ def split_roi_at_white_gaps(image, roi):
         if len(roi_list) > 1:
             # roi was split append the new child, parent modified by reference
             result_rois.append(roi_list[1])
-            utils.sts(f" roi {cur_roi} split at {roi_list[1]['y']}", 3)
+            if utils.is_logged(3):
+                utils.sts(f" roi {cur_roi} split at {roi_list[1]['y']}", 3)
             cur_roi += 1
         else:
             break
@@ -1166,7 +1175,8 @@ def ungray_area(area_of_interest, force:bool = False):
     roi_mean = cv2.mean(area_of_interest)[0]
     if force or roi_mean < gray_background_max_mean:
         # The following should be performed only when the roi has a gray background.
-        utils.sts(f"Darker roi detected: mean:({round(roi_mean, 2)} < {gray_background_max_mean} threshold. Ungraying the region.", 3)
+        if utils.is_logged(3):
+            utils.sts(f"Darker roi detected: mean:({round(roi_mean, 2)} < {gray_background_max_mean} threshold. Ungraying the region.", 3)
         
         # dilation followed by erosion removes black spots from white areas.
         wht_kernel = np.ones((3, 3), np.uint8)
@@ -1178,14 +1188,10 @@ def ungray_area(area_of_interest, force:bool = False):
     ret1, area_of_interest = cv2.threshold(area_of_interest, 0, 255, cv2.THRESH_BINARY+cv2.THRESH_OTSU)    
     return area_of_interest
 
-def analyze_one_roi(argsdict: dict, image, roi, style_dict):
-    """ analyze one roi and update it.
-        first crops the image to option area if appropriate.
-        updates:
-            ocr_option_word     if one-liner (cropped)
-            ocr_option_text     (cropped)
-            ocr_word            if one-liner (uncropped)
-            ocr_text            (uncropped)
+def crop_one_roi(argsdict: dict, image, roi, style_dict):
+    """ prepare the images of one roi for ocr.
+        returns option_area_of_interest, full_area_of_interest
+        option_area_of_interest is None if the roi is too tall to be an option.
     """
     layout_params = get_layout_params(argsdict)
     diagnose_ocr = bool(style_dict['style_num'] in argsdict['diagnose_ocr_styles'])
@@ -1201,34 +1207,20 @@ def analyze_one_roi(argsdict: dict, image, roi, style_dict):
         if diagnose_ocr:
             option_aoi_1 = option_area_of_interest.copy()
             utils.sts("diagnose_ocr enabled for this style", 3)
-            result_ocr_dict = ocr_various_modes(option_aoi_1)
+            result_ocr_dict = ocr_various_modes(option_aoi_1, cache=True)
             utils.sts(f"prep1: no additional image processing\n{pprint.pformat(result_ocr_dict)}", 3)
 
             option_aoi_2 = option_area_of_interest.copy()
             option_aoi_2 = ungray_area(option_aoi_2, force=True)
-            result_ocr_dict = ocr_various_modes(option_aoi_2)
+            result_ocr_dict = ocr_various_modes(option_aoi_2, cache=True)
             utils.sts(f"prep2: full ungray\n{pprint.pformat(result_ocr_dict)}", 3)
             
             option_aoi_3 = option_area_of_interest.copy()
             option_aoi_3 = ungray_area(option_aoi_3, force=False)
-            result_ocr_dict = ocr_various_modes(option_aoi_3)
+            result_ocr_dict = ocr_various_modes(option_aoi_3, cache=True)
             utils.sts(f"prep3: threshold only\n{pprint.pformat(result_ocr_dict)}", 3)
             
         #option_area_of_interest = ungray_area(option_area_of_interest, force=False)
-        text = ocr_text(option_area_of_interest, mode=3)
-        text = clean_candidate_name(text)
-        roi['ocr_option_text'] = text
-        utils.sts(f'OT: "{utils.sane_str(text[:40])}" ', 3, end='')
-            
-        if False:  # never generate this for now.  h < h_min_option:
-            # if the option is a one-liner, convert also as if it might be a single word.
-            word = ocr_word(option_area_of_interest)
-            roi['ocr_option_word'] = word
-            utils.sts(f'OW: "{utils.sane_str(word[:40])}" ', 3, end='')
-
-        # calc_roi_target(roi, style_dict, layout_params)
-        
-        utils.sts(f"\n{' '*19}", 3, end="")
         
     # second convert as if it is a contest header
     # contest headers can be of any size
@@ -1241,21 +1233,25 @@ def analyze_one_roi(argsdict: dict, image, roi, style_dict):
     # clear out gray area, if the roi seems too dark
     full_area_of_interest = ungray_area(full_area_of_interest)
     
+    return option_area_of_interest, full_area_of_interest
+    
+
+def update_roi_with_ocr_text(roi, option_text, text):
+    """ record the ocr results of crop_one_roi() images in the roi.
+        option_text is None if the roi was not cropped as an option.
+    """
+    if option_text is not None:
+        option_text = clean_candidate_name(option_text)
+        roi['ocr_option_text'] = option_text
+        if utils.is_logged(3):
+            utils.sts(f'OT: "{utils.sane_str(option_text[:40])}" ', 3, end='')
+            utils.sts(f"\n{' '*19}", 3, end="")
+        
     # OCRing text within and saving it
-    text = ocr_text(full_area_of_interest)
     roi['ocr_text'] = text
-    utils.sts(f'CT: "{utils.sane_str(text[:80])}"', 3, end='')
-
-    if False:  # never do this for now. h < h_min_option:
-        # if the option is a one-liner, convert also as if it might be a single word.
-        word = ocr_word(option_area_of_interest)
-        roi['ocr_word'] = word
-        utils.sts(f' CW: "{utils.sane_str(word[:40])}" ', 3, end='')
-    
+    if utils.is_logged(3):
+        utils.sts(f'CT: "{utils.sane_str(text[:80])}"', 3, end='')
     utils.sts("")
-    
-    # return roi image and roi.
-    return option_area_of_interest, full_area_of_interest, roi
 
 
 def genrois_one_p(argsdict: dict, style_dict, p, image):
@@ -1333,16 +1329,21 @@ def genrois_one_p(argsdict: dict, style_dict, p, image):
                 image       = checkpoint_image)
 
     # process rois based on likely use by size and ocr.
+    # all rois of the page are cropped first so the ocr can be submitted to the ocr pool as batches.
+    # this function accesses layout_params for cropping specs.
+    cropped_rois_lot = [crop_one_roi(argsdict, working_image, roi, style_dict) for roi in page_rois_list]
+    
+    option_images = [option_image for option_image, _ in cropped_rois_lot if option_image is not None]
+    option_texts = iter(ocr_text_batch(option_images, mode=3, cache=True))
+    contest_texts = ocr_text_batch([contest_image for _, contest_image in cropped_rois_lot], cache=True)
+    
     for index, roi in enumerate(page_rois_list):
 
         utils.sts(('Style:%4.1u ROI:%3.1u ' % (int(style_num), index)), 3, end='')
         
-        #if style_num == '2822076' and index == 57:
-
-        option_roi_image, contest_roi_image, roi = \
-            analyze_one_roi(argsdict, working_image, roi, style_dict)    
-            # style_dict contains the timing_marks information.
-            # this function accesses layout_params for cropping specs.
+        option_roi_image, contest_roi_image = cropped_rois_lot[index]
+        option_text = None if option_roi_image is None else next(option_texts)
+        update_roi_with_ocr_text(roi, option_text, contest_texts[index])
 
         if not option_roi_image is None:
             rois_images.append(option_roi_image)
@@ -1425,14 +1426,46 @@ def genrois_one_style(argsdict: dict, style_num):
 
 
 def genrois_lambda(argsdict: dict, style_num: str):
+    """ genrois of one style in a lambda. returns style_rois_list, or None if the style is excluded. """
+    style_rois_list = None
     if style_num in argsdict.get('exclude_style_num', []):
         utils.sts(f'Excluding Style {style_num} as specified in input file.', 3)
     else:
         utils.sts(f'Style {style_num}', 3)
-        genrois_one_style(argsdict, style_num)
+        # the persisted cache is loaded once per warm lambda, and only the new entries are saved,
+        # as a delta file per style, to be merged by the main process with merge_lambda_ocr_caches().
+        configure_ocr_cache(argsdict)
+        load_ocr_cache_once(argsdict.get('job_name', ''))
+        style_rois_list = genrois_one_style(argsdict, style_num)
+        save_ocr_cache_delta(delta_name=style_num)
     utils.sts('Rois generation complete.', 3)
+    return style_rois_list
 
 
+def merge_lambda_ocr_caches(argsdict: dict):
+    """ merge the ocr cache entries saved by genrois lambdas into the persisted cache. """
+    configure_ocr_cache(argsdict)
+    num_merged = merge_ocr_cache_deltas()
+    if num_merged:
+        utils.sts(f"Merged ocr cache entries of {num_merged} styles.", 3)
+
+
+def init_genrois_worker(argsdict, num_processes):
+    """ initializer of genrois process pool workers. """
+    utils.init_pool_worker(argsdict)
+    configure_ocr_cache(argsdict)
+    set_pool_ocr_workers(num_processes)
+    load_ocr_cache()
+    
+
+def genrois_style_worker(argsdict, style_num):
+    """ process one style in a pool worker and return the ocr cache entries it added
+        so the parent process can save the cache once.
+    """
+    genrois_one_style(argsdict, style_num)
+    return pop_new_ocr_cache_entries()
+    
+
 def genrois_local(argsdict):
     style_nums_list = DB.get_style_nums_with_templates(argsdict)
     layout = argsdict.get('layout', 'separated')
@@ -1440,15 +1473,35 @@ def genrois_local(argsdict):
     utils.sts(f"Found {len(style_nums_list)} styles of {vendor} with layout:'{layout}'.")
     included_style_nums = argsdict.get('include_style_num', [])
     excluded_style_nums = argsdict.get('exclude_style_num', [])
+    
+    selected_style_nums = [style_num for style_num in style_nums_list
+        if not (style_num in excluded_style_nums or included_style_nums and not style_num in included_style_nums)]
 
-    for style_num in style_nums_list:
-        if style_num in excluded_style_nums or \
-            included_style_nums and not style_num in included_style_nums:
-            #utils.sts(f'Excluding Style {style_num} as specified in input file.', 3)
-            continue
-        utils.sts(f'Style {style_num}', 3)
-        genrois_one_style(argsdict, style_num)
-
+    configure_ocr_cache(argsdict)
+    load_ocr_cache()
+    
+    num_workers = utils.get_num_pool_workers(argsdict, 'style_workers', len(selected_style_nums))
+    if num_workers == 1:
+        for style_idx, style_num in enumerate(selected_style_nums):
+            utils.sts(f'Style {style_num}', 3)
+            genrois_one_style(argsdict, style_num)
+            
+            if not (style_idx + 1) % 50:
+                # save periodically so an interrupted run does not lose the ocr already completed.
+                save_ocr_cache()
+    else:
+        utils.sts(f"Generating rois for {len(selected_style_nums)} styles using {num_workers} processes", 3)
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=num_workers, initializer=init_genrois_worker, initargs=(argsdict, num_workers)) as executor:
+            futures = {executor.submit(genrois_style_worker, argsdict, style_num): style_num 
+                        for style_num in selected_style_nums}
+            for style_idx, future in enumerate(concurrent.futures.as_completed(futures)):
+                add_ocr_cache_entries(future.result())
+                utils.sts(f'Style {futures[future]} completed', 3)
+                if not (style_idx + 1) % 50:
+                    save_ocr_cache()
+
+    save_ocr_cache()
     utils.sts('Rois generation complete.', 3)
     
     log_misspelled_words()
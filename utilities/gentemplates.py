@@ -6,9 +6,10 @@ import sys
 
 #import pandas as pd
 
-from utilities import utils, args, logs
+from utilities import utils, args, logs, timing
 from utilities.bif_utils import get_biflist, set_style_from_party_if_enabled, build_one_chunk
-from utilities.style_utils import generate_style_template, get_manual_styles_to_contests
+from utilities.style_utils import get_manual_styles_to_contests, new_style_template_builder, add_ballot_to_style_template, \
+    finish_style_template
 from utilities.zip_utils import open_archive
 from utilities.alignment_utils import are_timing_marks_consistent
 #from utilities import launcher
@@ -59,10 +60,18 @@ def build_template_tasklists(argsdict):
         reduced_df = BIF.df_without_corrupted_and_bmd()
         reduced_df = set_style_from_party_if_enabled(argsdict, reduced_df)
         
-        style_nums_in_this_bif = list(reduced_df['style_num'].unique())
-        utils.sts(f"  Found {len(style_nums_in_this_bif)} unique styles", 3)
+        # ballots without style_num can't contribute to any template.
+        # These are excluded explicitly, as groupby drops NaN keys.
+        num_without_style = int(reduced_df['style_num'].isna().sum())
+        if num_without_style:
+            utils.sts(f"  Skipping {num_without_style} ballots without style_num", 3)
+            reduced_df = reduced_df.loc[reduced_df['style_num'].notna()]
+        
+        # group the ballots by style once rather than scanning the bif for each style.
+        style_groups = reduced_df.groupby('style_num', sort=False, observed=True)
+        utils.sts(f"  Found {style_groups.ngroups} unique styles", 3)
 
-        for style_num in style_nums_in_this_bif:
+        for style_num, style_ballots_df in style_groups:
             utils.sts(f"Processing style:{style_num} ", 3, end='')
             previously_captured = 0
 
@@ -86,7 +95,7 @@ def build_template_tasklists(argsdict):
                 utils.sts(f"Previously captured {previously_captured} ", 3, end='')
             # find records with this eff_style
 
-            style_df = reduced_df[(reduced_df['style_num'] == style_num)][0:(num_ballots_to_combine-previously_captured)]
+            style_df = style_ballots_df[0:(num_ballots_to_combine-previously_captured)]
             utils.sts(f" Just Captured {len(style_df.index)}", 3, end='')
 
             if previously_captured:
@@ -165,20 +174,26 @@ def generate_template_for_style_by_tasklist_lod(argsdict: dict,
         2. aligns the images to alignment targets.
         3. reads the barcode style and checks it with the card_code (which may differ from the style_num)
         4. gets the timing marks.
-        5. calls generate_style_template(), which:
-            a. reviews the images and chooses the most average image in terms of stretch.
+        5. adds each ballot to a streaming template builder, which:
+            a. reviews the first few ballots and chooses the most average image in terms of stretch.
             b. discards any excessively stretched images.
             c. stretch-fixes the rest on timing-mark basis to "standard" timing marks.
-            d. combines into one image.
+            d. combines into one image per page as ballots are added, so ballots are not retained.
             e. saves style information as JSON.
+        Reading stops once LAYERS_FOR_EMPTY_BALLOT ballots are included.
     """
     global archive
     global current_archive_basename
     current_archive_basename = ''
 
-    ballot_queue = []
     ballots_unprocessed = []
     tot_failures = 0
+    
+    if not tasklist_lod:
+        utils.exception_report("generate_template_for_style_by_tasklist_lod: tasklist is empty")
+        return False
+    # style_num and sheet0 will be the same for all records.
+    template_builder = new_style_template_builder(argsdict, tasklist_lod[0]['style_num'], tasklist_lod[0]['sheet0'])
 
     #if not tasklist_lod:
     #    tasklist_lod = tasklist_df.to_dict(orient='records')
@@ -232,11 +247,13 @@ def generate_template_for_style_by_tasklist_lod(argsdict: dict,
             utils.exception_report(f"EXCEPTION: Timing mark recognition failed: ballot_id: {ballot_id} Precinct: {precinct}")
             tot_failures += 1
             continue
-        ballot_queue.append(ballot)
+        if add_ballot_to_style_template(argsdict, template_builder, ballot):
+            utils.sts(f"Enough ballots for style template after item:{task_idx} of {len(tasklist_lod)}", 3)
+            break
 
-    utils.sts(f"Generating Style Template from {len(ballot_queue)} ballots (omitted {tot_failures} failed ballots)...", 3)
-    if generate_style_template(argsdict, ballot_queue, style_num, sheet0):
-        utils.sts(f"Style templates generation completed successfully.\n Processed a total of {len(ballot_queue)} ballots", 3)
+    utils.sts(f"Generating Style Template (omitted {tot_failures} failed ballots)...", 3)
+    if finish_style_template(argsdict, template_builder):
+        utils.sts(f"Style templates generation completed successfully.\n Processed a total of {len(template_builder['build_from_ballots'])} ballots", 3)
         return True
     else:
         utils.sts("Style templates generation FAILED.", 3)
@@ -385,6 +402,9 @@ def post_gentemplate_cleanup(argsdict):
 
     logs.sts("gentemplates_by_tasklists completed.\n", 3)
     
+    if argsdict['include_genrois']:
+        genrois.merge_lambda_ocr_caches(argsdict)
+    
     #import pdb; pdb.set_trace()
 
     if argsdict['include_maprois']:
@@ -404,6 +424,7 @@ def post_gentemplate_cleanup(argsdict):
     # downloads file_pat=fr"{rootname}_{chunk_pat}\.txt"
     logs.get_and_merge_s3_logs(dirname='styles', rootname='log', chunk_pat=r'\d+_styles_chunk_\d+', subdir='logs')
     logs.get_and_merge_s3_logs(dirname='styles', rootname='exc', chunk_pat=r'\d+_styles_chunk_\d+', subdir='logs')
+    timing.report_phase_timing(dirname='styles')
 
 
 def delegated_gentemplate(dirname, task_args, s3flag=None):
@@ -426,7 +447,7 @@ def delegated_gentemplate(dirname, task_args, s3flag=None):
     style_rois_list = None
     if argsdict['include_genrois']:
         # generate rois information to dirname 'rois'
-        style_rois_list = genrois.genrois_one_style(argsdict, style_num)
+        style_rois_list = genrois.genrois_lambda(argsdict, style_num)
 
     if argsdict['include_maprois']:
         style_rois_map_df, error_flag = maprois.maprois_discover_style(
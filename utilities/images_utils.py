@@ -4,14 +4,12 @@ import math
 from tempfile import NamedTemporaryFile
 
 import cv2
-import fitz
 import numpy as np
 from pyzbar.pyzbar import decode as barcode_decode
 import Levenshtein as lev 
 
 from utilities.config_d import config_dict
 from utilities import utils, logs
-from utilities import ocr
 from utilities.vendor import get_layout_params
 from models.DB import DB
 from utilities.utils import list_from_csv_str
@@ -306,6 +304,7 @@ def dominion_expressvote_conversion(image):
     :return vertical_code: (str) string containing OCRed vertical code of the ballot
     :return qrcode[0]: qrcode of the ballot
     """
+    from utilities import ocr     # imported on use, so tasks that do not ocr do not import tesseract.
 
     # declaring image height and width
     height, width = image.shape
@@ -405,43 +404,18 @@ def dominion_expressvote_conversion(image):
         return None, None, None
 
 
-def expressvote_conversion(image, ballot_id, expressvote_header: str = ''):
+def segment_expressvote(image):
     """
-    This conversion is specific to ES&S BMD ballots from ExpressVote machines.
+    Align and crop an image of an ES&S ExpressVote ballot and decode its barcodes.
     :param image: (np.array) array of an image of Express Vote ballot
-    :param expressvote_header: First three lines of the expressvote ballot
-        template separated by commas.
-    :return ev_header_code -- str of digits providing precinct, logical style, etc.
-    :       bottom_strlist -- list of strings at the bottom, not categorized into contests or options.
-    :       ev_coord_str_list (list) of XXYYPS digits specifying ballot target
-                from barcodes.
+    :return rotated_image -- (np.array) aligned and cropped image, or None if not express vote type.
+    :       barcodes -- list of decoded barcodes sorted by row and column, or None.
     """
     # declaring initial height and width
     height, width = image.shape
 
-    # declaring auxiliary variables for manual noise reduction
-    noise_begun = False
-    noise_ended = False
-    noise_length = 0
-    noise_bottom_buffer = 0
-
-    # iterating throught upper 350 lines to detect if there is any noise to be deleted
-    for noise_h in range(350):
-        line = image[noise_h:noise_h + 1, 300:width - 300]
-        intensity = math.ceil(sum(cv2.mean(line)))
-        if intensity != 255 and not noise_begun and not noise_ended:
-            noise_begun = True
-        elif intensity != 255 and noise_begun and not noise_ended:
-            noise_length += 1
-        elif intensity == 255 and noise_begun and not noise_ended:
-            noise_ended = True
-        elif intensity == 255 and noise_ended:
-            noise_bottom_buffer += 1
-        elif intensity != 255 and noise_ended:
-            noise_bottom_buffer = 0
-        if noise_bottom_buffer == 20:
-            noise_bottom_buffer = noise_h
-            break
+    # detecting if there is any noise in the upper 350 lines to be deleted
+    noise_bottom_buffer = expressvote_noise_bottom(image)
 
     # if noise was found, paint it white from the upper edge to the 20px buffer
     if noise_bottom_buffer != 0:
@@ -456,9 +430,7 @@ def expressvote_conversion(image, ballot_id, expressvote_header: str = ''):
     # clearing fixed vertical margins and clearing bottom margin after detection
     cropping_shapes[:, :200] = 255
     cropping_shapes[:, width - 200:] = 255
-    for bottom_clearing_border in range(500, height):
-        if sum(cv2.mean(cropping_shapes[bottom_clearing_border:bottom_clearing_border + 100, 200:width - 200])) == 255.0:
-            break
+    bottom_clearing_border = expressvote_bottom_border(cropping_shapes)
     cropping_shapes[bottom_clearing_border + 50:, :] = 255
 
     # declaring kernel_line and creating basic shapes image
@@ -504,7 +476,7 @@ def expressvote_conversion(image, ballot_id, expressvote_header: str = ''):
     if not boxes:
         utils.sts("Ballot is not of express vote type", 3)
         utils.sts("     Blank page", 3)
-        return None, None, None
+        return None, None
 
     # detecting extreme edges to allow cropping
     boxes = np.asarray(boxes)
@@ -536,6 +508,34 @@ def expressvote_conversion(image, ballot_id, expressvote_header: str = ''):
     if not barcodes:
         utils.sts("Ballot is not of express vote type", 3)
         utils.sts("     No barcodes found", 3)
+        return None, None
+
+    return rotated_image, barcodes
+
+
+def decode_ev_barcodes(barcodes):
+    """ return ev_header_code, ev_coord_str_list from the sorted barcodes of segment_expressvote() """
+    ev_coord_str_list = [code.data.decode() for code in barcodes]
+    ev_header_code = ev_coord_str_list.pop(0)  # first barcode is header code.
+    return ev_header_code, ev_coord_str_list
+
+
+def expressvote_conversion(image, ballot_id, expressvote_header: str = '', segmented=None):
+    """
+    This conversion is specific to ES&S BMD ballots from ExpressVote machines.
+    :param image: (np.array) array of an image of Express Vote ballot
+    :param expressvote_header: First three lines of the expressvote ballot
+        template separated by commas.
+    :param segmented: (rotated_image, barcodes) from segment_expressvote(image), if already done.
+    :return ev_header_code -- str of digits providing precinct, logical style, etc.
+    :       bottom_strlist -- list of strings at the bottom, not categorized into contests or options.
+    :       ev_coord_str_list (list) of XXYYPS digits specifying ballot target
+                from barcodes.
+    """
+    from utilities import ocr     # imported on use, so tasks that do not ocr do not import tesseract.
+
+    rotated_image, barcodes = segmented or segment_expressvote(image)
+    if rotated_image is None:
         return None, None, None
 
     top_barcodes_edge = []
@@ -551,10 +551,21 @@ def expressvote_conversion(image, ballot_id, expressvote_header: str = ''):
     top = rotated_image[:top_barcodes_edge, :]
     bottom = rotated_image[bottom_barcodes_edge + 15:, :]
 
-    # OCR of the text from the top part
+    # prepare the top (title) part for OCR
     kernel_line = np.ones((1, 2), np.uint8)
     top = cv2.erode(top, kernel_line, iterations=1)
     rotated_image[:top_barcodes_edge, :] = top
+
+    # prepare the bottom (results) part for OCR
+    kernel_line = np.ones((4, 1), np.uint8)
+    bottom[-15:, :] = cv2.dilate(bottom[-15:, :], kernel_line, iterations=1)
+    kernel_line = np.ones((3, 1), np.uint8)
+    bottom[-15:, :] = cv2.erode(bottom[-15:, :], kernel_line, iterations=1)
+    kernel_line = np.ones((1, 2), np.uint8)
+    bottom = cv2.erode(bottom, kernel_line, iterations=1)
+    rotated_image[bottom_barcodes_edge + 15:, :] = bottom
+
+    # the bottom part is converted only if the top matches the expressvote header.
     top_text = ocr.ocr_core_expressvote(top)
 
     # Replace '8' with '0'. That's due to the OCR issue. If we don't
@@ -580,17 +591,9 @@ def expressvote_conversion(image, ballot_id, expressvote_header: str = ''):
         return None, None, None
 
     # extracting logical_style_number
-    ev_coord_str_list = [code.data.decode() for code in barcodes]
-    ev_header_code = ev_coord_str_list.pop(0)  # first barcode is header code.
+    ev_header_code, ev_coord_str_list = decode_ev_barcodes(barcodes)
 
-    # OCR of the text from the bottom part
-    kernel_line = np.ones((4, 1), np.uint8)
-    bottom[-15:, :] = cv2.dilate(bottom[-15:, :], kernel_line, iterations=1)
-    kernel_line = np.ones((3, 1), np.uint8)
-    bottom[-15:, :] = cv2.erode(bottom[-15:, :], kernel_line, iterations=1)
-    kernel_line = np.ones((1, 2), np.uint8)
-    bottom = cv2.erode(bottom, kernel_line, iterations=1)
-    rotated_image[bottom_barcodes_edge + 15:, :] = bottom
+    # parse the text from the bottom part
     bottom_text = ocr.ocr_core_expressvote(bottom)
     bottom_text = re.sub(r'\n[^A-Z]+(?=[A-Z])', '\n', bottom_text)
     bottom_text = re.sub(r'(?<=[A-Z])[^A-Z\-]+\n', '\n', bottom_text)
@@ -599,6 +602,59 @@ def expressvote_conversion(image, ballot_id, expressvote_header: str = ''):
     
     return ev_header_code, bottom_strlist, ev_coord_str_list
 
+def white_run_lengths(is_white):
+    """ given a bool array of rows which are entirely white,
+        return array with the number of consecutive white rows starting at each row.
+    """
+    num_rows = len(is_white)
+    row_idxs = np.arange(num_rows)
+    next_nonwhite = np.minimum.accumulate(np.where(is_white, num_rows, row_idxs)[::-1])[::-1]
+    return next_nonwhite - row_idxs
+
+
+def expressvote_noise_bottom(image, scan_rows=350, buffer_rows=20):
+    """ scan the upper scan_rows lines of an expressvote image for noise, which is a band of non-white lines
+        followed by white lines. Returns the row where buffer_rows white lines after the noise have been seen,
+        or the number of white lines seen after the noise if fewer, or 0 if no noise is found.
+        Each line is considered white if its mean intensity, ignoring 300 pixels on each side, rounds up to 255.
+    """
+    width = image.shape[1]
+    lines = image[:scan_rows, 300:width - 300]
+    # ceil(mean) == 255 exactly when the sum exceeds 254 per pixel.
+    is_white = lines.sum(axis=1, dtype=np.int64) > 254 * lines.shape[1]
+
+    nonwhite_rows = np.flatnonzero(~is_white)
+    if not len(nonwhite_rows):
+        return 0
+    white_after_noise = np.flatnonzero(is_white[nonwhite_rows[0]:])
+    if not len(white_after_noise):
+        return 0
+    first_counted_row = nonwhite_rows[0] + white_after_noise[0] + 1
+
+    run_lengths = white_run_lengths(is_white)[first_counted_row:]
+    full_buffer_starts = np.flatnonzero(run_lengths >= buffer_rows)
+    if len(full_buffer_starts):
+        return int(first_counted_row + full_buffer_starts[0] + buffer_rows - 1)
+
+    # the scan ended before the buffer was complete; return the count of white lines seen at the end.
+    nonwhite_after_noise = np.flatnonzero(~is_white[first_counted_row:])
+    last_nonwhite_row = first_counted_row + nonwhite_after_noise[-1] if len(nonwhite_after_noise) else first_counted_row - 1
+    return int(len(is_white) - 1 - last_nonwhite_row)
+
+
+def expressvote_bottom_border(cropping_shapes, start_row=500, window_rows=100, margin=200):
+    """ return the first row at or after start_row where the next window_rows rows (fewer at the bottom of the
+        image) are entirely white, ignoring margin pixels on each side, or the last row if there is none.
+    """
+    height, width = cropping_shapes.shape
+    is_white = (cropping_shapes[:, margin:width - margin] == 255).all(axis=1)
+    run_lengths = white_run_lengths(is_white)
+    rows_to_bottom = height - np.arange(height)
+    is_border = run_lengths >= np.minimum(window_rows, rows_to_bottom)
+    border_rows = np.flatnonzero(is_border[start_row:])
+    return int(start_row + border_rows[0]) if len(border_rows) else height - 1
+
+
 COLOR_DICT = {'red': (0, 0, 255), 'blue': (255, 0, 0), 'green': (0, 255, 0)}
 
 def create_redlined_images(argsdict, style_num, rois_map_df):
@@ -789,19 +845,51 @@ def outlines(image, mode,
     return image
 
 
-def ess_gen_timing_marks(image) -> dict:
+TIMING_MARK_PRIOR_MARGIN = 100     # pixels around the expected timing marks searched when a prior is given.
+
+
+def ess_gen_timing_marks(image, prior=None) -> dict:
     """
     :param image: np.array of an image, 
+    :param prior: optional timing marks of this page from the style, as stored in {style_num}_style.json.
+                    If provided, only narrow bands around the expected marks are searched. If the
+                    same number of marks is not found in each list, the entire page is searched.
     :return: one page of timing_marks list (dict)
     argsdict is global
     """
-
-    left_vertical_marks = []
-    right_vertical_marks = []
-    top_marks = []
     height, width = image.shape
-                
 
+    if prior and prior.get('left_vertical_marks') and prior.get('right_vertical_marks') and prior.get('top_marks'):
+        left_band = {'x': 0, 'y': 0, 'h': height,
+                     'w': max(m['x'] + m['w'] for m in prior['left_vertical_marks']) + TIMING_MARK_PRIOR_MARGIN}
+        right_x = max(min(m['x'] for m in prior['right_vertical_marks']) - TIMING_MARK_PRIOR_MARGIN, 0)
+        right_band = {'x': right_x, 'y': 0, 'w': width - right_x, 'h': height}
+        top_y = max(min(m['y'] for m in prior['top_marks']) - TIMING_MARK_PRIOR_MARGIN, 0)
+        top_band = {'x': 0, 'y': top_y, 'w': width,
+                    'h': max(m['y'] + m['h'] for m in prior['top_marks']) + TIMING_MARK_PRIOR_MARGIN - top_y}
+
+        mark_boxes = []
+        for band in [left_band, right_band, top_band]:
+            for x, y, w, h in ess_timing_mark_boxes(image[band['y']:band['y'] + band['h'], band['x']:band['x'] + band['w']]):
+                # shapes cut by an edge of the band that is not an edge of the page are found whole in another band, if at all.
+                if (x == 0 and band['x'] > 0) or (y == 0 and band['y'] > 0) \
+                        or (x + w == band['w'] and band['x'] + band['w'] < width) \
+                        or (y + h == band['h'] and band['y'] + band['h'] < height):
+                    continue
+                box = (x + band['x'], y + band['y'], w, h)
+                if box not in mark_boxes:
+                    mark_boxes.append(box)
+
+        timing_marks = ess_classify_timing_marks(mark_boxes, width)
+        if all(len(timing_marks[key]) == len(prior[key]) for key in timing_marks):
+            return timing_marks
+
+    return ess_classify_timing_marks(ess_timing_mark_boxes(image), width)
+
+
+def ess_timing_mark_boxes(image) -> list:
+    """ find bounding boxes (x, y, w, h) of the border bars in image, which may be a band of the page.
+    """
     # setting up copy of an image, its threshold and contours
     image_backup = image.copy()
     _, thresh = cv2.threshold(image_backup, 254, 255, 1)
@@ -825,8 +913,7 @@ def ess_gen_timing_marks(image) -> dict:
             chosen_contours.append(cnt)
 
     # selecting side border bars contours
-    final_contours = []
-    max_y = 0
+    final_boxes = []
     for cnt in chosen_contours:
         x, y, w, h = cv2.boundingRect(cnt)
         offset = 25 + h
@@ -835,16 +922,25 @@ def ess_gen_timing_marks(image) -> dict:
         if upper_mean > 250 and lower_mean > 250:
             cv2.drawContours(image_backup, [cnt], 0, (255, 255, 255), -1)
         else:
-            final_contours.append(cnt)
-            max_y = max(max_y, y)
+            final_boxes.append((x, y, w, h))
+
+    return final_boxes
+
+
+def ess_classify_timing_marks(mark_boxes, width) -> dict:
+    """ split border bar boxes into left, right and top_marks lists, each sorted
+    """
+    left_vertical_marks = []
+    right_vertical_marks = []
+    top_marks = []
+    max_y = max([box[1] for box in mark_boxes], default=0)
 
     # splitting side contours into left and right ones
     # for now we will use only the left timing marks.
     # they should be close enough
     
     #right_coord = []
-    for cnt in final_contours:
-        x, y, w, h = cv2.boundingRect(cnt)
+    for x, y, w, h in mark_boxes:
 
         if x < 50:
             left_vertical_marks.append({'x':x, 'y':y, 'w':w, 'h':h})
@@ -866,6 +962,7 @@ def get_images_from_pdf(filedict):
     """Returns a list of grayscale images parsed from PDF byte array.
         filedict['bytes_array'] has the file data.
     """
+    import fitz     # imported on use, because the import is slow and only PDF archives need it.
     images = []
     # TODO: Cannot find reference 'open' in '__init__.py | __init__.py'
     doc = fitz.open('pdf', filedict.get('bytes_array'))
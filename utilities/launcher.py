@@ -2,13 +2,23 @@
 
 import traceback
 import json
+import importlib
 
 
-from utilities import args, logs
+from utilities import args, logs, timing
 from models import LambdaTracker
 from models.DB import DB
         
 
+# dirname of the task: (module, function) performing one chunk of the task.
+TASK_MODULES = {
+    'bif':      ('utilities.bif_utils',         'delegated_build_bif_chunk'),
+    'marks':    ('utilities.votes_extractor',   'delegated_extractvote'),
+    'styles':   ('utilities.gentemplates',      'delegated_gentemplate'),
+    'cmpcvr':   ('utilities.cmpcvr',            'delegated_cmpcvr'),
+    }
+
+
 def accept_delegation_task_chunk(request_id, task_args):
     """ This is a locally callable function to allow debugging.
         right after args are unpacked.
@@ -35,6 +45,7 @@ def accept_delegation_task_chunk(request_id, task_args):
         # pylint: disable=broad-except
         # We need to catch broad exception.
     except Exception as err:
+        logs.flush_logfiles()
         error_info = {
             'error_type':       err.__class__.__name__,
             'error_message':    repr(err),
@@ -70,25 +81,18 @@ def launch_task(task_args, s3flag=None):
     for rootname in ['log', 'exc', 'map_report']:
         logs.rm_logfile(rootname=rootname)
 
-    if dirname == 'bif':
-        from utilities import bif_utils
-        bif_utils.delegated_build_bif_chunk(dirname=dirname, task_args=task_args, s3flag=s3flag)
-        
-    elif dirname == 'marks':
-        from utilities import votes_extractor
-        votes_extractor.delegated_extractvote(dirname=dirname, task_args=task_args, s3flag=s3flag)
-        
-    elif dirname == 'styles':
-        from utilities import gentemplates
-        gentemplates.delegated_gentemplate(dirname=dirname, task_args=task_args, s3flag=s3flag)    
-    
-    elif dirname == 'cmpcvr':
-        from utilities import cmpcvr
-        cmpcvr.delegated_cmpcvr(dirname=dirname, task_args=task_args, s3flag=s3flag)    
-    
-    else:
+    if dirname not in TASK_MODULES:
         raise NotImplementedError
+    module_name, function_name = TASK_MODULES[dirname]
+
+    timing.reset_spans()
+    with timing.span('chunk'):
+        # the task module is imported only when its task is launched, so each lambda imports
+        # only what its task needs.
+        task_module = importlib.import_module(module_name)
+        getattr(task_module, function_name)(dirname=dirname, task_args=task_args, s3flag=s3flag)
         
+    timing.save_chunk_timing(dirname, chunk_name)
     for rootname in ['log', 'exc', 'map_report']:
         logs.report_lambda_logfile(s3dirname=dirname, chunk_name=chunk_name, rootname=rootname, subdir=subdir)
 
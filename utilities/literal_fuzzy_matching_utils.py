@@ -2,13 +2,35 @@ import re
 import traceback
 import sys
 
+import numpy as np
 import Levenshtein as lev
 
+try:
+    from rapidfuzz import process as rf_process, fuzz as rf_fuzz
+except ImportError:
+    rf_process = None
+
 from utilities import utils, logs
 
 # NOTE in practice, we found that levenshtein distance was an adequate tool, 
 # combined with spelling corrections prior to comparisons.
 
+# each comparison logged is appended to the log file, which dominates the cost of mapping.
+# set with argsdict 'log_fuzzy_comparisons' using configure_fuzzy_matching()
+enable_fuzzy_logging = False
+
+# candidate sets prepared by prepare_fuzzy_candidates(), keyed by tuple of the correct strings.
+fuzzy_candidates = {}
+FUZZY_CANDIDATES_MAX = 10000
+
+# justifications tried in each fuzzy_compare_mode. The best metric is used.
+FUZZY_COMPARE_JUSTIFICATIONS = {
+    'full_only':    ('full',),
+    'left_only':    ('left',),
+    'right_only':   ('right',),
+    'best_of_all':  ('full', 'right', 'left'),
+    }
+
 
 def compare_letters(first, second):
     """
@@ -168,11 +190,12 @@ def fuzzy_compare_str(correct_str, ocr_str, thres=80, justify='full', method='le
     compare a known correct string with an ocrd string that may have mistakes.
     justify can be 'left', 'right' or 'full'
     """
-    p_correct_str = correct_str.replace("\n", " ")[:50]
-    p_ocr_str = ocr_str.replace("\n", " ") #[:50]
-    logs.sts(f"fuzzy_compare_str justify: {justify}:\n"
-             f"correct: '{p_correct_str}'\n" 
-             f"ocr:     '{p_ocr_str}'") 
+    if enable_fuzzy_logging:
+        p_correct_str = correct_str.replace("\n", " ")[:50]
+        p_ocr_str = ocr_str.replace("\n", " ") #[:50]
+        logs.sts(f"fuzzy_compare_str justify: {justify}:\n"
+                 f"correct: '{p_correct_str}'\n" 
+                 f"ocr:     '{p_ocr_str}'") 
 
     if method == 'regex':
         """ This algorithm assumes no special characters in the correct string.
@@ -198,8 +221,9 @@ def fuzzy_compare_str(correct_str, ocr_str, thres=80, justify='full', method='le
             #local_cor_str = correct_str
             
         match_val = lev.ratio(correct_str, local_ocr_str)
-        lv = "%1.5f" % match_val
-        logs.sts(f" levratio = {lv}", 3)       
+        if enable_fuzzy_logging:
+            lv = "%1.5f" % match_val
+            logs.sts(f" levratio = {lv}", 3)       
         return match_val >= thres, match_val
         
     print(f"Logic Error: Unrecognized method:{method}\n")
@@ -209,9 +233,10 @@ def fuzzy_compare_str(correct_str, ocr_str, thres=80, justify='full', method='le
 
 def fuzzy_compare_strlists(correct_strlist, ocr_strlist, thres, justify='full') -> tuple: # (match_bool, metric)
     """ return True if all strings match in the order given else False"""
-    utils.sts("fuzzy_compare_strlists Comparing:\n" 
-             f"correct: '{join_remove_nl(correct_strlist)}'\n"
-             f"ocrlist: '{join_remove_nl(ocr_strlist)}'", 3)
+    if enable_fuzzy_logging:
+        utils.sts("fuzzy_compare_strlists Comparing:\n" 
+                 f"correct: '{join_remove_nl(correct_strlist)}'\n"
+                 f"ocrlist: '{join_remove_nl(ocr_strlist)}'", 3)
     metric = 1.0
     
     if len(correct_strlist) != len(ocr_strlist):
@@ -227,38 +252,108 @@ def fuzzy_compare_strlists(correct_strlist, ocr_strlist, thres, justify='full')
     return True, metric
     
     
+def configure_fuzzy_matching(argsdict: dict):
+    """ apply fuzzy matching settings from argsdict. """
+    global enable_fuzzy_logging
+    
+    enable_fuzzy_logging = bool(argsdict.get('log_fuzzy_comparisons', False))
+    
+
+def prepare_fuzzy_candidates(correct_strlist: list) -> dict:
+    """ return the candidate set for correct_strlist, prepared once and then reused.
+        The candidates are grouped by length so left and right justified comparisons, 
+        which truncate the ocr string to the length of each candidate, can be scored a group at a time.
+    """
+    key = tuple(correct_strlist)
+    candidates = fuzzy_candidates.get(key)
+    if candidates is None:
+        len_groups = {}
+        for idx, correct_str in enumerate(key):
+            len_groups.setdefault(len(correct_str), []).append(idx)
+        candidates = {
+            'strs':         key,
+            'len_groups':   [(str_len, idxs, [key[idx] for idx in idxs]) for str_len, idxs in len_groups.items()],
+            }
+        if len(fuzzy_candidates) >= FUZZY_CANDIDATES_MAX:
+            fuzzy_candidates.clear()
+        fuzzy_candidates[key] = candidates
+    return candidates
+    
+    
+def precompute_contest_fuzzy_candidates(contests_dod: dict):
+    """ prepare candidate sets for the options of all contests in contests_dod prior to mapping. """
+    for contest_dict in contests_dod.values():
+        if contest_dict.get('ballot_options_list'):
+            prepare_fuzzy_candidates(contest_dict['ballot_options_list'])
+    
+
+def fuzzy_ratio_matrix(query_strlist: list, choice_strlist: list, score_cutoff: float = 0) -> np.ndarray:
+    """ return array of lev.ratio of each query (rows) with each choice (cols).
+        Uses rapidfuzz to score all pairs in one call, if available.
+        Metrics less than score_cutoff are returned as 0.
+    """
+    if rf_process is not None:
+        return rf_process.cdist(query_strlist, choice_strlist, scorer=rf_fuzz.ratio,
+                                score_cutoff=score_cutoff * 100, dtype=np.float64) / 100
+    
+    metrics = np.array([[lev.ratio(choice_str, query_str) for choice_str in choice_strlist] 
+                            for query_str in query_strlist], dtype=np.float64).reshape(len(query_strlist), len(choice_strlist))
+    metrics[metrics < score_cutoff] = 0
+    return metrics
+    
+
+def fuzzy_metrics_matrix(correct_strlist: list, ocr_strlist: list, fuzzy_compare_mode='best_of_all', score_cutoff: float = 0) -> np.ndarray:
+    """ return array of float metrics of each ocr_str (rows) fuzzy compared with each correct_str (cols).
+        The metric is the best of the justifications of fuzzy_compare_mode, 
+        which is either 'left_only', 'right_only', 'full_only', 'best_of_all', 
+        and is the same as provided by fuzzy_compare_str() for each justification.
+        if ocr_str is '', its metrics are always 0.
+    """
+    candidates = prepare_fuzzy_candidates(correct_strlist)
+    metrics = np.zeros((len(ocr_strlist), len(candidates['strs'])))
+    
+    ocr_rows = [row for row, ocr_str in enumerate(ocr_strlist) if ocr_str]
+    justifications = FUZZY_COMPARE_JUSTIFICATIONS.get(fuzzy_compare_mode, ())
+    if not ocr_rows or not candidates['strs'] or not justifications:
+        return metrics
+    ocr_strs = [ocr_strlist[row] for row in ocr_rows]
+    
+    best_metrics = np.zeros((len(ocr_strs), len(candidates['strs'])))
+    if 'full' in justifications:
+        best_metrics = fuzzy_ratio_matrix(ocr_strs, candidates['strs'], score_cutoff)
+        
+    for justify in ('left', 'right'):
+        if not justify in justifications:
+            continue
+        for str_len, idxs, strs in candidates['len_groups']:
+            # take only the first or last characters of the ocr_str to match correct_str, allowing slop
+            # note that ocr_str[-0:] is the full string, as in fuzzy_compare_str()
+            if justify == 'left':
+                query_strs = [ocr_str[:str_len] for ocr_str in ocr_strs]
+            else:
+                query_strs = [ocr_str[-str_len:] for ocr_str in ocr_strs]
+            best_metrics[:, idxs] = np.maximum(best_metrics[:, idxs], fuzzy_ratio_matrix(query_strs, strs, score_cutoff))
+            
+    metrics[ocr_rows] = best_metrics
+    return metrics
+    
+    
 def fuzzy_metrics_str_to_list(correct_strlist: list, ocr_str: str, fuzzy_compare_mode='best_of_all') -> list:
     """ return list of float metrics of ocr_str fuzzy compared with each correct_str in correct_strlist
         tries it both right and left justified and takes the highest value.
         if ocr_str is '', always returns 0 metric.
         fuzzy_compare_mode is set for given application as either 'left_only', 'right_only', 'full_only', 'best_of_all'
     """
-    metrics = []
-    for correct_str in correct_strlist:
-        # take only last characters of ocr_option to match correct_str, allowing slop
-        
-        right_metric, left_metric, full_metric = 0,0,0
-        if ocr_str:
-            if fuzzy_compare_mode in ['full_only', 'best_of_all']:
-                _, full_metric  = fuzzy_compare_str(correct_str, ocr_str, 0, justify='full',  method='levdist')
-            if fuzzy_compare_mode in ['right_only', 'best_of_all']:
-                _, right_metric = fuzzy_compare_str(correct_str, ocr_str, 0, justify='right', method='levdist')
-            if fuzzy_compare_mode in ['left_only', 'best_of_all']:
-                _, left_metric  = fuzzy_compare_str(correct_str, ocr_str, 0, justify='left',  method='levdist')
-                
-            metric = max(right_metric, left_metric, full_metric)
-        else:
-            metric = 0
-        metrics.append(metric)
-    return metrics
+    return fuzzy_metrics_matrix(correct_strlist, [ocr_str], fuzzy_compare_mode)[0].tolist()
     
         
 def fuzzy_compare_str_to_list(correct_strlist: list, ocr_str: str, thres: float, fuzzy_compare_mode='best_of_all') -> tuple:
     """ return True if ocr_str is found in correct_strlist
         with index offset where it is found, and metric.
     """
-    utils.sts(f"Comparing strlists\ncorrect '{join_remove_nl(correct_strlist)}'\n"
-                                  f"ocr_str '{ocr_str}'", 3)
+    if enable_fuzzy_logging:
+        utils.sts(f"Comparing strlists\ncorrect '{join_remove_nl(correct_strlist)}'\n"
+                                      f"ocr_str '{ocr_str}'", 3)
     metrics = fuzzy_metrics_str_to_list(correct_strlist, ocr_str, fuzzy_compare_mode)
 
     if not metrics:
@@ -282,25 +377,63 @@ def join_remove_nl(correct_strlist):
     """ Create a string suitable for log and console display """
     return re.sub("\n", ' ', ','.join(correct_strlist))#[:50]
 
-def invert_idx_list(idx_list: list) -> list:
-    """ given list of indexes, return the list "inverted", where
-        in the initial list, the nth position idx is 
-        returned as n in the idx'th position.
-        [4,1,0,3,2] will become [2,1,4,3,0]
-        if idxs are unique and in range, then two inversion return the original
-    """    
-    num_vals = len(idx_list)
-    result_list = [None for x in range(num_vals)]
-    for idx, val in enumerate(idx_list):
-        if val < num_vals:
-            result_list[int(val)] = idx
-    return result_list
-
-assert invert_idx_list([4,1,0,3,2]) == [2,1,4,3,0]
-assert invert_idx_list([2,1,4,3,0]) == [4,1,0,3,2]
+def hungarian_assignment(cost_table: np.ndarray) -> list:
+    """ return list of the column assigned to each row of the square cost_table 
+        such that the total cost is minimized. O(n**3)
+        This is the same as scipy.optimize.linear_sum_assignment(cost_table)[1], without depending on scipy.
+    """
+    num = cost_table.shape[0]
+    u = np.zeros(num + 1)                       # row potentials
+    v = np.zeros(num + 1)                       # column potentials
+    col_row = np.zeros(num + 1, dtype=int)      # row assigned to each column, 1-based, 0 is unassigned
+    way = np.zeros(num + 1, dtype=int)
+    
+    for row in range(1, num + 1):
+        col_row[0] = row
+        col0 = 0
+        min_vals = np.full(num + 1, np.inf)
+        used = np.zeros(num + 1, dtype=bool)
+        while True:
+            used[col0] = True
+            row0 = col_row[col0]
+            free = ~used[1:]
+            reduced = cost_table[row0 - 1] - u[row0] - v[1:]
+            improved = free & (reduced < min_vals[1:])
+            min_vals[1:][improved] = reduced[improved]
+            way[1:][improved] = col0
+            
+            free_min_vals = np.where(free, min_vals[1:], np.inf)
+            col1 = int(np.argmin(free_min_vals)) + 1
+            delta = free_min_vals[col1 - 1]
+            
+            used_cols = np.flatnonzero(used)
+            u[col_row[used_cols]] += delta
+            v[used_cols] -= delta
+            min_vals[1:][free] -= delta
+            col0 = col1
+            if not col_row[col0]:
+                break
+        # augment along the path found.
+        while col0:
+            col1 = way[col0]
+            col_row[col0] = col_row[col1]
+            col0 = col1
+            
+    row_cols = [0] * num
+    for col in range(1, num + 1):
+        row_cols[col_row[col] - 1] = col - 1
+    return row_cols
+    
+
+def fuzzy_assign_metrics_table(ocr_metrics_table: np.ndarray) -> list:
+    """ given square table of metrics of each ocr_str (rows) with each correct_str (cols),
+        return list of the correct_str index assigned to each ocr_str so the total metric is maximized.
+    """
+    return hungarian_assignment(-ocr_metrics_table)
+    
 
 def fuzzy_compare_permuted_strsets(correct_strlist, ocr_strlist, thres, fuzzy_compare_mode='best_of_all') -> tuple:
-    """ compare sets of strings in all possible permutations and return the first match of all components.
+    """ compare sets of strings in all possible permutations and return the best match of all components.
         returns tuple:
             bool    -- True if mapping meets threshold, and then map is provided.
             metric  -- minimum metric of the best mapping or first failing metric
@@ -348,10 +481,6 @@ def fuzzy_compare_permuted_strsets(correct_strlist, ocr_strlist, thres, fuzzy_co
         [0,0,0,1,0] 3
         [0,0,1,0,0] 2
         
-         2,1,4,3,0  <- max_col_idxs
-         
-        then invert_idx_list(max_col_idxs) == idx_list
-        
         THIS CAN BE FURTHER IMPROVED if necessary:
         This function is used in the mapping the ocr strings from rois to contests and options.
         The frame is slid down if a match is not found. If that occurs, then the existing metric matrix
@@ -396,36 +525,39 @@ def fuzzy_compare_permuted_strsets(correct_strlist, ocr_strlist, thres, fuzzy_co
     return True, max_metric, permutations_listoflist[best_permutation_idx]
     """
     
-    #import pdb; pdb.set_trace()
-    ocr_metrics_table = []
-    max_idxs = []
-    max_metrics = []
-    for ocr_str in ocr_strlist:
-        ocr_metrics_list = fuzzy_metrics_str_to_list(correct_strlist, ocr_str, fuzzy_compare_mode)
-        max_metric = max(ocr_metrics_list)
-        max_idx = ocr_metrics_list.index(max_metric)
-        if max_metric < thres:
-            return False, max_metric, []                # return early if ocr_str cannot be found in correct_strlist
-        max_idxs.append(max_idx)
-        max_metrics.append(max_metric)
-        ocr_metrics_table.append(ocr_metrics_list)      # create list of list.
+    """
+        The metrics table is now resolved with an optimal assignment (Hungarian algorithm) 
+        which is O(n**3) and maximizes the total metric. Thus, when the best match of a row 
+        is also the best match of another row, the conflict is resolved rather than rejected.
+    """
     
-    max_col_idxs = []
-    for idx in range(len(correct_strlist)):
-        metrics_by_col = [a[idx] for a in ocr_metrics_table]    # get the idx'th column
-        max_metric_by_col = max(metrics_by_col)
-        max_idx_by_col = metrics_by_col.index(max_metric_by_col)
-        max_col_idxs.append(max_idx_by_col)
+    #import pdb; pdb.set_trace()
+    ocr_metrics_table = fuzzy_metrics_matrix(correct_strlist, ocr_strlist, fuzzy_compare_mode)
+    if not ocr_metrics_table.size:
+        return False, 0, []
         
-    inverted_col_idxs = invert_idx_list(max_col_idxs)
-    
-    if not max_idxs == inverted_col_idxs:
+    max_metrics = ocr_metrics_table.max(axis=1)
+    failing_rows = np.flatnonzero(max_metrics < thres)
+    if failing_rows.size:
+        return False, float(max_metrics[failing_rows[0]]), []          # ocr_str cannot be found in correct_strlist
+        
+    if ocr_metrics_table.shape[0] != ocr_metrics_table.shape[1]:
         utils.exception_report(f"### EXCEPTION: fuzzy_compare_permuted_strsets: correct_strlist:{correct_strlist}\n"
             f"cannot be mapped to ocr_strlist {ocr_strlist}\n"
-            f"maxes of rows not maxes of cols.\n")
+            f"lists differ in length.\n")
         return False, 0, []
+    
+    assigned_idxs = fuzzy_assign_metrics_table(ocr_metrics_table)
+    assigned_metrics = ocr_metrics_table[np.arange(len(assigned_idxs)), assigned_idxs]
+    min_metric = float(assigned_metrics.min())
+    if min_metric < thres:
+        return False, min_metric, []
+    
+    if enable_fuzzy_logging and assigned_idxs != ocr_metrics_table.argmax(axis=1).tolist():
+        utils.sts(f"fuzzy_compare_permuted_strsets: best matches conflict, resolved by assignment {assigned_idxs}\n"
+            f"correct_strlist:{correct_strlist} ocr_strlist {ocr_strlist}", 3)
         
-    return True, min(max_metrics), max_idxs
+    return True, min_metric, assigned_idxs
     
 
 def test_fuzzy_compare_permuted_strsets():
@@ -3,8 +3,10 @@ import os
 import sys
 import glob
 import shutil
+import atexit
+import multiprocessing.util
 from models.DB import DB
-from utilities import utils
+from utilities import utils, args
 
 """ This module deals with log file from lambda processes.
 
@@ -28,9 +30,16 @@ from utilities import utils
     for cmpcvr:
         log_{archive_rootname}_cmpcvr_chunk_NNN.txt
         
-    
+    Log files are kept open with one buffered handle per rootname per process, 
+    and are flushed at the end of the chunk by report_lambda_logfile(), 
+    when an exception is reported, and when the process exits.
+    Messages above the 'log_verbose' level are not written to the log file.
 
 """
+LOGFILE_BUFFER_SIZE = 1 << 16
+
+logfile_handles = {}        # (rootname, job_folder_path): file handle
+logfile_finalizer_pid = None
 
 def get_logfile_pathname(rootname='log'):
     """ lambdas can only open files in /tmp
@@ -40,7 +49,7 @@ def get_logfile_pathname(rootname='log'):
         return f"/tmp/{rootname}.txt"
     else:
         dirpath = DB.dirpath_from_dirname('logs', s3flag=False)   # this also creates the dir
-        return f"{dirpath}{rootname}.txt"
+        return utils.path_sep_per_os(f"{dirpath}{rootname}.txt")
         
     
 def rm_logfile(rootname='log'):
@@ -48,28 +57,68 @@ def rm_logfile(rootname='log'):
         because state is not initialized by the system.
         This is also true when we simulate lambda operation locally.
     """
-
+    close_logfile(rootname)
     pathname = get_logfile_pathname(rootname=rootname)
     if os.path.isfile(pathname):
         os.remove(pathname)
 
 
-def append_report_by_pathname(pathname, string, end="\n"):
-    """ Create report name of string in reports 
+def get_logfile_handle(rootname='log'):
+    """ return the open handle of the logfile of rootname, opening it on first use.
         Used only within this module.
     """
+    key = (rootname, args.argsdict.get('job_folder_path'))
+    try:
+        return logfile_handles[key]
+    except KeyError:
+        pass
+    global logfile_finalizer_pid
+    if logfile_finalizer_pid != os.getpid():
+        # processes of multiprocessing pools do not run atexit handlers, but run these finalizers.
+        multiprocessing.util.Finalize(None, close_logfiles, exitpriority=0)
+        logfile_finalizer_pid = os.getpid()
+    pathname = get_logfile_pathname(rootname=rootname)
     try:
-        with open(pathname, mode='ta+', buffering=1024, encoding="utf8") as fh:
-            print(string, file=fh, end=end)
+        logfile_handles[key] = open(pathname, mode='ta+', buffering=LOGFILE_BUFFER_SIZE, encoding="utf8")
     except:
         print(f"Failed to append to file: {pathname}")
         sys.exit(1)
+    return logfile_handles[key]
+
+
+def flush_logfiles():
+    """ write out the buffered messages of all open logfiles. 
+    """
+    for fh in logfile_handles.values():
+        fh.flush()
+
+
+def close_logfile(rootname='log'):
+    for key in [key for key in logfile_handles if key[0] == rootname]:
+        logfile_handles.pop(key).close()
+
+
+def close_logfiles():
+    for key in list(logfile_handles):
+        logfile_handles.pop(key).close()
+
+
+atexit.register(close_logfiles)
+if hasattr(os, 'register_at_fork'):
+    # a forked process starts with empty buffers and opens its own handles.
+    os.register_at_fork(before=flush_logfiles, after_in_child=close_logfiles)
 
 
 def append_report(string, end='\n', rootname='log'):
     if not string: return
-    logfile_path = get_logfile_pathname(rootname=rootname)
-    append_report_by_pathname(logfile_path, string, end=end)
+    get_logfile_handle(rootname).write(string + end)
+
+
+def is_logged(verboselevel=0):
+    """ True if a message of verboselevel is written to the logfile or printed.
+        Use to avoid formatting messages that would be dropped.
+    """
+    return verboselevel <= args.argsdict.get('log_verbose', 3) or utils.is_verbose_level(verboselevel)
 
 
 def sts(string, verboselevel=0, end='\n'):
@@ -81,7 +130,8 @@ def sts(string, verboselevel=0, end='\n'):
     """
 
     if not string: return
-    append_report(string, end=end, rootname='log')    
+    if verboselevel <= args.argsdict.get('log_verbose', 3):
+        append_report(string, end=end, rootname='log')    
     if utils.is_verbose_level(verboselevel):
         print(string, end=end)
     return string+end
@@ -91,6 +141,7 @@ def exception_report(string):
     if not string: return
     append_report('----------------------------------------\n' + string, rootname='exc')
     sts(string, 3)
+    flush_logfiles()
 
 
 def print_disagreements(string, end='\n'):
@@ -120,6 +171,7 @@ def report_lambda_logfile(s3dirname, chunk_name, rootname="log", subdir=None):
     """
     logfile_pathname = get_logfile_pathname(rootname=rootname)  # this generates the path to the lambda or local folder for the logs.
     upload_name = f"{rootname}_{chunk_name}"
+    flush_logfiles()
     print(f"Reading logfile {logfile_pathname}")
     #import pdb; pdb.set_trace()
     buff = read_logfile(logfile_pathname)
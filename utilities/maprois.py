@@ -1,5 +1,6 @@
 import sys
 import re
+import concurrent.futures
 #import os
 #import math
 #import csv
@@ -13,8 +14,8 @@ import pprint
 
 from utilities.cvr_utils import create_contests_dod
 from utilities.literal_fuzzy_matching_utils import fuzzy_compare_str, fuzzy_compare_strlists, \
-    fuzzy_compare_permuted_strsets
-from utilities import utils, logs
+    fuzzy_compare_permuted_strsets, configure_fuzzy_matching, precompute_contest_fuzzy_candidates
+from utilities import utils, logs, timing, ocr
 #from aws_lambda import s3utils
 from utilities.style_utils import get_map_overrides, find_similar_styles, get_style_fail_to_map, get_manual_styles_to_contests
 from utilities.config_d import config_dict
@@ -289,7 +290,8 @@ def build_ocr_strlist(argsdict, rois_list, rois_idx, num_options):
         if rem_target:
             ocr_str = re.sub(r'^\S\s', '', ocr_str)
         ocr_strlist.append(ocr_str)
-        utils.sts(f"option_{option_idx}: '{ocr_str[:50]}'", 3)
+        if utils.is_logged(3):
+            utils.sts(f"option_{option_idx}: '{ocr_str[:50]}'", 3)
 
     return ocr_strlist
     
@@ -621,6 +623,9 @@ def maprois_one_style(
     
     rois_list   = DB.load_data(dirname='styles', subdir=style_num, name=f"{style_num}_rois.json", type='lod')
     
+    configure_fuzzy_matching(argsdict)
+    precompute_contest_fuzzy_candidates(contests_dod)
+    
     for roi in rois_list:
         roi['ocr_text'] = correct_ocr_mispellings_of_common_words_mixedcase(roi['ocr_text'])
         if 'ocr_option_text' in roi:
@@ -829,6 +834,7 @@ def maprois_one_style(
     return style_rois_map_df, (error_flag or contests_exhausted_error_flag)
     
 
+@timing.timed('fuzzy_match')
 def compare_rois_to_contest(argsdict, rois_list, rois_idx, contest_dict) -> dict:
     """ this function compares one contest with the rois_list (ocr result) at list_offset
         and returns map_info dict providing mapping result information
@@ -1169,6 +1175,9 @@ def maprois_discover_style(
         # this is the result of parsing the EIF
         contests_dod = DB.load_data(dirname='styles', name='contests_dod.json')
         
+    configure_fuzzy_matching(argsdict)
+    precompute_contest_fuzzy_candidates(contests_dod)
+        
     #logs.sts(f"contests_dod:\n{pprint.pformat(contests_dod)}", 3)
         
     style_to_contests_dol = DB.load_data(dirname='styles', name='CVR_STYLE_TO_CONTESTS_DICT.json', silent_error=True)
@@ -1453,6 +1462,57 @@ def calc_max_orphan_rois(contest_list, contests_dod):
     return max([0, min_rois_needed - 1])
         
 
+def init_maprois_worker(argsdict, num_processes):
+    """ initializer of maprois process pool workers. """
+    utils.init_pool_worker(argsdict)
+    ocr.configure_ocr_cache(argsdict)
+    ocr.set_pool_ocr_workers(num_processes)
+
+
+def maprois_style_worker(argsdict, style_num, contests_dod, style_to_contests_dol, style_overrides_dod):
+    """
+    Map one style, create its redlined images and save its fragment of the rois map
+    to styles/roismap/{style_num}_roismap.csv, as lambdas do. 
+    This is a module-level function so it can be executed in a process pool.
+    Returns style_rois_map_df, error_flag
+    """
+    if not argsdict.get('use_style_discovery', False):
+        # this is the conventional approach 
+        # requires that we know the correspondence of styles to contests for each style prior to mapping.
+        if argsdict['all_styles_have_all_contests']:
+            contest_list = list(contests_dod.keys())
+        else:
+            contest_list = style_to_contests_dol[style_num]
+        
+        style_rois_map_df, error_flag = maprois_one_style(
+            argsdict, 
+            style_num, 
+            contest_list, 
+            contests_dod, 
+            style_overrides_dod)
+    else:
+        # style_discovery means we don't know the contests assigned to a given style before it is is processed.
+        #   contests are assigned to the style as it is processed.
+        #   Style discovery is appropriate if the ballot will easily OCR and using 'use_ocr_based_genrois'
+        #   Can be used in two situations:
+        #       1. there is no cvr at all, and no style mapping.
+        #       2. we have a style_to_contests_dol either from CVR or manual mapping, but we don't know the card_code map.
+    
+        style_rois_map_df, error_flag =  maprois_discover_style(
+            argsdict,
+            style_num,
+            contests_dod=None,               # will read from file if this is None on first pass
+            style_to_contests_dol=style_to_contests_dol,
+            )
+
+    create_redlined_images(argsdict, style_num, style_rois_map_df)
+    
+    if style_rois_map_df is not None:
+        DB.save_data(data_item=style_rois_map_df, dirname='styles', subdir='roismap', name=f"{style_num}_roismap", format='.csv')
+    
+    return style_rois_map_df, error_flag
+    
+
 def maprois(argsdict, chunk_name: str = '', style_num: str = ''):
     """
     This function is the width-first version, which is not used
@@ -1466,6 +1526,8 @@ def maprois(argsdict, chunk_name: str = '', style_num: str = ''):
     if not style_num:
         # lists rois based on the files that exist.
         style_nums_list = DB.get_style_nums_with_templates(argsdict)
+    else:
+        style_nums_list = [style_num]
     # this loads and parses the EIF
     contests_dod = create_contests_dod(argsdict)
     #DB.save_style(name='contests_dod', style_data=contests_dod)
@@ -1493,61 +1555,35 @@ def maprois(argsdict, chunk_name: str = '', style_num: str = ''):
     included_style_nums = argsdict.get('include_style_num', [])
     excluded_style_nums = argsdict.get('exclude_style_num', [])
     
-    total_mapping_errors = 0
-    unmapped_styles = []
-    for style_num in style_nums_list:
-        if (style_num in excluded_style_nums or
-            included_style_nums and not style_num in included_style_nums):
-            #utils.sts(f'Excluding Style {style_num} as specified in input file.', 3)
-            continue
-
-        if not argsdict.get('use_style_discovery', False):
-            # this is the conventional approach 
-            # requires that we know the correspondence of styles to contests for each style prior to mapping.
-            if not argsdict['all_styles_have_all_contests']:
-                if False: #argsdict.get('election_name', '') == 'San Francisco Consolidated Presidential Primary 2020-03':
-                
-                    ballot_type_id = str(int(style_num[-3:]))                           # extract ballot_type_id, zap leading zeroes
-                    multi_sheet_contest_list = style_to_contests_dol[ballot_type_id]         # this a unified contest list including both sheets
-                    sheet0 = int(style_num[2:3]) - 1                                    # extract sheet0 number from style_num
-
-                    # the following function splits the contest list based on the sheet0 attribute for each contest in original list.
-                    grouped_dol = utils.group_list_by_dod_attrib(multi_sheet_contest_list, contests_dod, 'sheet0')
-                    contest_list = grouped_dol[sheet0]
-                else:
-                    contest_list = style_to_contests_dol[style_num]
-            
-            style_rois_map_df, error_flag = maprois_one_style(
-                argsdict, 
-                style_num, 
-                contest_list, 
-                #rois_map_df, 
-                contests_dod, 
-                style_overrides_dod)
-        else:
-            # style_discovery means we don't know the contests assigned to a given style before it is is processed.
-            #   contests are assigned to the style as it is processed.
-            #   Style discovery is appropriate if the ballot will easily OCR and using 'use_ocr_based_genrois'
-            #   Can be used in two situations:
-            #       1. there is no cvr at all, and no style mapping.
-            #       2. we have a style_to_contests_dol either from CVR or manual mapping, but we don't know the card_code map.
-        
-            style_rois_map_df, error_flag =  maprois_discover_style(
-                argsdict,
-                style_num,
-                contests_dod=None,               # will read from file if this is None on first pass
-                style_to_contests_dol=style_to_contests_dol,
-                #rois_map_df=rois_map_df,
-                )
-
-
-        if error_flag:
-            unmapped_styles.append(style_num)
-            total_mapping_errors += 1
-            
-        create_redlined_images(argsdict, style_num, style_rois_map_df)
-        
-        rois_map_df = rois_map_df.append(style_rois_map_df)
+    selected_style_nums = [style_num for style_num in style_nums_list
+        if not (style_num in excluded_style_nums or included_style_nums and not style_num in included_style_nums)]
+    
+    style_rois_map_dfs = {}
+    error_flags = {}
+    num_workers = utils.get_num_pool_workers(argsdict, 'style_workers', len(selected_style_nums))
+    if num_workers == 1:
+        for style_num in selected_style_nums:
+            style_rois_map_dfs[style_num], error_flags[style_num] = maprois_style_worker(
+                argsdict, style_num, contests_dod, style_to_contests_dol, style_overrides_dod)
+    else:
+        utils.sts(f"Mapping {len(selected_style_nums)} styles using {num_workers} processes", 3)
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=num_workers, initializer=init_maprois_worker, initargs=(argsdict, num_workers)) as executor:
+            futures = {executor.submit(maprois_style_worker, 
+                            argsdict, style_num, contests_dod, style_to_contests_dol, style_overrides_dod): style_num
+                        for style_num in selected_style_nums}
+            for future in concurrent.futures.as_completed(futures):
+                style_num = futures[future]
+                style_rois_map_dfs[style_num], error_flags[style_num] = future.result()
+                utils.sts(f"Style {style_num} mapped", 3)
+
+    # fragments are combined once, in style order, rather than appended per style.
+    unmapped_styles = [style_num for style_num in selected_style_nums if error_flags[style_num]]
+    total_mapping_errors = len(unmapped_styles)
+    style_dfs = [style_rois_map_dfs[style_num] for style_num in selected_style_nums 
+                    if style_rois_map_dfs[style_num] is not None and len(style_rois_map_dfs[style_num].index)]
+    if style_dfs:
+        rois_map_df = pd.concat([rois_map_df] + style_dfs, ignore_index=True, sort=False)
         
     merged_styles = {}                      # dict with key of merged style, value is mapped style that is similar.
     unmerged_styles = []                    # list of style that failed and could not be merged.
@@ -1569,7 +1605,7 @@ def maprois(argsdict, chunk_name: str = '', style_num: str = ''):
     #DB.save_df_csv(name=df_name, dirname=dirname, df=rois_map_df)
     DB.save_data(data_item=rois_map_df, dirname=dirname, name=df_name, format='.csv')
 
-    num_styles = len(style_nums_list)
+    num_styles = len(selected_style_nums)
     summary_str = f"Total of {total_mapping_errors} errors in {num_styles} styles attempted." \
               f"{ round(100 * (num_styles - total_mapping_errors)/num_styles, 2) }% success rate.\n" \
               f" Unmapped styles: {unmapped_styles}\n" \
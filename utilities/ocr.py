@@ -1,11 +1,26 @@
 import os
 import io
+import hashlib
+import threading
+import collections
+import concurrent.futures
 import numpy as np
 import pandas as pd
 from unidecode import unidecode
 
 import pytesseract
 #from utilities.config_d import config_dict
+from utilities import timing
+
+try:
+    # tesserocr binds the tesseract C API so the language models are loaded once per worker
+    # rather than once per image by a new tesseract process, as with pytesseract.
+    # The persistent workers are opt-in: tesserocr is not in requirements.txt, as it must be built
+    # against the tesseract library, and must be installed separately. Without it, the ocr pool
+    # only runs the per-image pytesseract processes concurrently.
+    import tesserocr
+except ImportError:
+    tesserocr = None
 
 
 
@@ -14,6 +29,25 @@ pytesseract.pytesseract.tesseract_cmd = os.environ.get('TESSERACT_PATH', 'HOME')
 enable_word_logging = False
 misspelled_words_set = set()
 
+EXPRESSVOTE_OCR_CONFIG = '--psm 6 --oem 3'
+
+ocr_workers = 0             # number of threads in the ocr pool. 0 uses one per cpu core.
+ocr_executor = None         # created on first batch.
+ocr_thread_local = threading.local()
+
+# ocr results are cached by hash of the image pixels and the tesseract config.
+# The cache is persisted in styles/ so identical rois in other styles and reruns are not converted again.
+# Only the template ocr of genrois uses the cache, by passing cache=True, because ballot images are unique.
+OCR_CACHE_NAME = 'ocr_cache.json'
+OCR_CACHE_DELTAS_SUBDIR = 'ocr_cache_deltas'    # entries added by each lambda, merged by the main process.
+use_ocr_cache = True
+ocr_cache_max_entries = 200000
+ocr_cache = collections.OrderedDict()       # key -> text, least recently used first.
+ocr_cache_lock = threading.Lock()
+ocr_cache_dirty = False
+ocr_cache_new_keys = set()                  # keys added since last pop_new_ocr_cache_entries()
+ocr_cache_loaded_job = None                 # job whose persisted cache is loaded, see load_ocr_cache_once()
+
 '''
 
 # comment out the following for lambdas or to disable misspelled word analysis
@@ -61,7 +95,284 @@ def ocr_core(img: np.array) -> str:
     return sanitize_string(text)
 '''
 
-def ocr_text(img: np.array, mode: int = 6, tsv: str = '') -> str:
+def get_ocr_executor():
+    """ return the thread pool used for batches of ocr.
+        Threads are sufficient because tesseract runs outside of the GIL,
+        either in the C API or in a separate process.
+    """
+    global ocr_executor
+    
+    if ocr_executor is None:
+        num_workers = ocr_workers or os.cpu_count() or 1
+        ocr_executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='ocr')
+    return ocr_executor
+
+
+def set_pool_ocr_workers(num_processes: int):
+    """ called in the initializer of process pool workers so that the ocr threads of all the
+        processes together do not exceed the cpu cores, instead of cpu_count threads per process.
+        An ocr_workers setting in argsdict, applied by configure_ocr_cache(), takes precedence.
+    """
+    global ocr_workers
+    
+    if not ocr_workers:
+        ocr_workers = max(1, (os.cpu_count() or 1) // max(1, num_processes))
+
+
+def parse_tesseract_config(config: str, lang: str = None):
+    """ parse tesseract cli config string to the settings used with the tesserocr API.
+        returns None if the config includes anything not supported, such as config files like 'tsv'.
+    """
+    settings = {'psm': 3, 'oem': 3, 'lang': lang or 'eng', 'variables': ()}
+    variables = []
+    tokens = config.split()
+    idx = 0
+    while idx < len(tokens):
+        token = tokens[idx]
+        if token in ['--psm', '--oem', '-l', '-c'] and idx + 1 < len(tokens):
+            value = tokens[idx + 1]
+            if token == '--psm':
+                settings['psm'] = int(value)
+            elif token == '--oem':
+                settings['oem'] = int(value)
+            elif token == '-l':
+                settings['lang'] = value
+            else:
+                if '=' not in value: return None
+                variables.append(tuple(value.split('=', 1)))
+            idx += 2
+            continue
+        return None
+    settings['variables'] = tuple(variables)
+    return settings
+
+
+def get_tesserocr_api(settings: dict):
+    """ return tesserocr API instance for this thread with lang, oem and variables initialized.
+        instances are kept for the life of the thread, one for each combination.
+        psm is set on each use.
+    """
+    apis = getattr(ocr_thread_local, 'apis', None)
+    if apis is None:
+        apis = ocr_thread_local.apis = {}
+        
+    key = (settings['lang'], settings['oem'], settings['variables'])
+    api = apis.get(key)
+    if api is None:
+        api = tesserocr.PyTessBaseAPI(lang=settings['lang'], oem=settings['oem'])
+        for name, value in settings['variables']:
+            api.SetVariable(name, value)
+        apis[key] = api
+    return api
+
+
+def configure_ocr_cache(argsdict: dict):
+    """ apply ocr cache and ocr pool settings from argsdict. """
+    global use_ocr_cache, ocr_cache_max_entries, ocr_workers
+    
+    use_ocr_cache = bool(argsdict.get('use_ocr_cache', True))
+    ocr_cache_max_entries = int(argsdict.get('ocr_cache_max_entries', 200000))
+    ocr_workers = int(argsdict.get('ocr_workers', 0) or 0)
+    
+
+def get_ocr_cache_key(img: np.array, config: str, kind: str = 'text') -> str:
+    """ exact hash of the image pixels, shape and the ocr config """
+    img = np.ascontiguousarray(img)
+    sha1 = hashlib.sha1(f"{kind}|{config}|{img.shape}|{img.dtype}|".encode('utf8'))
+    sha1.update(img.tobytes())
+    return sha1.hexdigest()
+
+
+@timing.timed('ocr')
+def cached_ocr(img: np.array, config: str, ocr_fn, kind: str = 'text'):
+    """ return ocr_fn(img) from the cache if the same image was converted with the same config.
+        otherwise call ocr_fn and add result to the cache, evicting the least recently used.
+    """
+    global ocr_cache_dirty
+    
+    if not use_ocr_cache:
+        return ocr_fn(img)
+        
+    key = get_ocr_cache_key(img, config, kind)
+    with ocr_cache_lock:
+        if key in ocr_cache:
+            ocr_cache.move_to_end(key)
+            return ocr_cache[key]
+            
+    result = ocr_fn(img)
+    if result is None:
+        return result
+        
+    with ocr_cache_lock:
+        ocr_cache[key] = result
+        ocr_cache.move_to_end(key)
+        ocr_cache_new_keys.add(key)
+        while len(ocr_cache) > ocr_cache_max_entries:
+            ocr_cache.popitem(last=False)
+        ocr_cache_dirty = True
+    return result
+    
+
+def load_ocr_cache():
+    """ load the persisted ocr cache from styles/ into memory, if it exists.
+        entries already in memory are retained as most recently used.
+    """
+    from models.DB import DB
+    
+    if not use_ocr_cache:
+        return
+    cache_lol = DB.load_data(dirname='styles', name=OCR_CACHE_NAME, silent_error=True)
+    if not cache_lol:
+        return
+        
+    with ocr_cache_lock:
+        prior_cache = collections.OrderedDict(cache_lol)
+        for key, text in ocr_cache.items():
+            prior_cache[key] = text
+            prior_cache.move_to_end(key)
+        while len(prior_cache) > ocr_cache_max_entries:
+            prior_cache.popitem(last=False)
+        ocr_cache.clear()
+        ocr_cache.update(prior_cache)
+    
+    
+def pop_new_ocr_cache_entries() -> list:
+    """ return [[key, text], ...] added to the cache since the last call.
+        Used by pool workers to return their results to the parent process, which saves the cache once.
+    """
+    with ocr_cache_lock:
+        entries = [[key, ocr_cache[key]] for key in ocr_cache_new_keys if key in ocr_cache]
+        ocr_cache_new_keys.clear()
+    return entries
+    
+    
+def add_ocr_cache_entries(entries: list):
+    """ add [[key, text], ...] as returned by pop_new_ocr_cache_entries() in another process. """
+    global ocr_cache_dirty
+    
+    if not use_ocr_cache or not entries:
+        return
+    with ocr_cache_lock:
+        for key, text in entries:
+            ocr_cache[key] = text
+            ocr_cache.move_to_end(key)
+        while len(ocr_cache) > ocr_cache_max_entries:
+            ocr_cache.popitem(last=False)
+        ocr_cache_dirty = True
+    
+    
+def load_ocr_cache_once(job_name: str):
+    """ load the persisted ocr cache if not already loaded for this job in this process,
+        as in a warm lambda which processes many styles.
+    """
+    global ocr_cache_loaded_job
+    
+    if ocr_cache_loaded_job != job_name:
+        load_ocr_cache()
+        ocr_cache_loaded_job = job_name
+    
+    
+def save_ocr_cache_delta(delta_name: str):
+    """ save the entries added since the last call to styles/ocr_cache_deltas/{delta_name}.json
+        Used by lambdas, which cannot update the persisted cache without overwriting each other.
+    """
+    from models.DB import DB
+    
+    entries = pop_new_ocr_cache_entries()
+    if use_ocr_cache and entries:
+        DB.save_data(data_item=entries, dirname='styles', subdir=OCR_CACHE_DELTAS_SUBDIR, name=f"{delta_name}.json")
+    
+    
+def merge_ocr_cache_deltas() -> int:
+    """ add the entries of all files in styles/ocr_cache_deltas/ to the persisted cache and remove the files.
+        returns the number of files merged.
+    """
+    from models.DB import DB
+    
+    if not use_ocr_cache:
+        return 0
+    delta_names = DB.list_files_in_dirname_filtered(dirname='styles', subdir=OCR_CACHE_DELTAS_SUBDIR, file_pat=r'.*\.json$')
+    if not delta_names:
+        return 0
+    for delta_name in delta_names:
+        add_ocr_cache_entries(DB.load_data(dirname='styles', subdir=OCR_CACHE_DELTAS_SUBDIR, name=delta_name, silent_error=True))
+    save_ocr_cache()
+    DB.delete_dirname_files_filtered(dirname='styles', subdir=OCR_CACHE_DELTAS_SUBDIR)
+    return len(delta_names)
+    
+    
+def save_ocr_cache():
+    """ persist the ocr cache to styles/ if any entries were added.
+        The persisted cache is reloaded first so entries saved by other processes are kept.
+    """
+    global ocr_cache_dirty
+    from models.DB import DB
+    
+    if not use_ocr_cache or not ocr_cache_dirty:
+        return
+    load_ocr_cache()
+    with ocr_cache_lock:
+        cache_lol = [[key, text] for key, text in ocr_cache.items()]
+        ocr_cache_dirty = False
+    DB.save_data(data_item=cache_lol, dirname='styles', name=OCR_CACHE_NAME)
+
+
+def image_to_string(img: np.array, config: str = '', lang: str = None, cache: bool = False) -> str:
+    """ ocr of one image. If cache, from the ocr cache if the same image was converted with the same config.
+    """
+    if cache:
+        return cached_ocr(img, f"{config} lang={lang}", lambda img: tesseract_image_to_string(img, config, lang))
+    with timing.span('ocr'):
+        return tesseract_image_to_string(img, config, lang)
+    
+
+def tesseract_image_to_string(img: np.array, config: str = '', lang: str = None) -> str:
+    """ ocr of one image using the persistent tesserocr API of this thread if available.
+        otherwise, or if the config is not supported, pytesseract is used.
+    """
+    settings = parse_tesseract_config(config, lang) if tesserocr is not None else None
+    if settings is None:
+        if lang:
+            return pytesseract.image_to_string(img, lang=lang, config=config)
+        return pytesseract.image_to_string(img, config=config)
+        
+    img = np.ascontiguousarray(img, dtype=np.uint8)
+    height, width = img.shape[:2]
+    bytes_per_pixel = 1 if img.ndim == 2 else img.shape[2]
+    
+    api = get_tesserocr_api(settings)
+    api.SetPageSegMode(settings['psm'])
+    api.SetImageBytes(img.tobytes(), width, height, bytes_per_pixel, width * bytes_per_pixel)
+    return api.GetUTF8Text()
+
+
+@timing.timed('ocr')
+def ocr_batch(img_list: list, config: str = '', lang: str = None, cache: bool = False) -> list:
+    """ ocr a list of images in the ocr pool, using the same config for each.
+        returns list of raw strings in the same order as img_list.
+    """
+    if len(img_list) <= 1:
+        return [image_to_string(img, config, lang, cache) for img in img_list]
+    return list(get_ocr_executor().map(lambda img: image_to_string(img, config, lang, cache), img_list))
+
+
+def ocr_text_config(mode: int = 6, tsv: str = '') -> str:
+    return f"--psm {mode} --oem 3 -l eng+spa {tsv}".strip()
+    
+
+def ocr_text_batch(img_list: list, mode: int = 6, tsv: str = '', cache: bool = False) -> list:
+    """ same as ocr_text() for each image in img_list, processed in the ocr pool.
+    """
+    text_list = [sanitize_string(text) for text in ocr_batch(img_list, config=ocr_text_config(mode, tsv), cache=cache)]
+    
+    if enable_word_logging:
+        for text in text_list:
+            log_unknown_words(text)
+            
+    return text_list
+    
+
+def ocr_text(img: np.array, mode: int = 6, tsv: str = '', cache: bool = False) -> str:
     """
     :param img: an array containing analyzed image
     :return: OCRed text
@@ -96,47 +407,31 @@ def ocr_text(img: np.array, mode: int = 6, tsv: str = '') -> str:
     -l LANG provides the list of languages to be used in the conversion.
                 
     """
-    text = pytesseract.image_to_string(
-        img,
-        config = f"--psm {mode} --oem 3 -l eng+spa {tsv}"
-    )
-    text = sanitize_string(text)
-    
-    if enable_word_logging:
-        log_unknown_words(text)
+    return ocr_text_batch([img], mode, tsv, cache)[0]
     
-    return text
-    
-def ocr_various_modes(img: np.array) -> dict:
+def ocr_various_modes(img: np.array, cache: bool = False) -> dict:
     """ apply various modes to the same image and return list of results
     """
     
     modes = [3, 4, 6]
 
-    result_dict = {}
-
-    for mode in modes:
-        text = ocr_text(img, mode)
-        result_dict[mode] = text
+    text_list = list(get_ocr_executor().map(lambda mode: ocr_text(img, mode, cache=cache), modes))
         
-    return result_dict
+    return dict(zip(modes, text_list))
 
 
-def ocr_word(img: np.array) -> str:
+def ocr_word(img: np.array, cache: bool = False) -> str:
     """
     :param img: an array containing analyzed image
     :return: OCRed text
     
     This mode works well with single words.
     """
-    text = pytesseract.image_to_string(
-        img,
-        config='--psm 8 --oem 3 -l eng+spa'
-    )
+    text = image_to_string(img, config='--psm 8 --oem 3 -l eng+spa', cache=cache)
     return sanitize_string(text)
 
 
-def ocr_to_tsv(img):    
+def ocr_to_tsv(img, cache: bool = False):    
     """ given image and region spec, isolate the region and ocr
         return tsv table
         all values are 1-based
@@ -210,7 +505,12 @@ def ocr_to_tsv(img):
 
     """
     try:
-        tsv_result = pytesseract.image_to_data(img, config='--psm 6 --oem 3 -l eng+spa tsv')
+        config = '--psm 6 --oem 3 -l eng+spa tsv'
+        if cache:
+            tsv_result = cached_ocr(img, config, lambda img: pytesseract.image_to_data(img, config=config), kind='tsv')
+        else:
+            with timing.span('ocr'):
+                tsv_result = pytesseract.image_to_data(img, config=config)
     except Exception as err:
         from utilities import logs
         logs.exception_report(f"Exception encountered in pytesseract.image_to_data() function: {err}")
@@ -235,6 +535,7 @@ def ocr_tsv_to_ocrdf(tsv_result):
     return None
 
 
+@timing.timed('ocr')
 def ocr_core(img):
     """
     Handles the default core OCR image processing by using Pillow's Image
@@ -243,6 +544,7 @@ def ocr_core(img):
     return pytesseract.image_to_string(img, lang='eng')
 
 
+@timing.timed('ocr')
 def ocr_core_single(img):
     """
     Handles the single line core OCR image processing consisting of numbers.
@@ -257,6 +559,7 @@ def ocr_core_single(img):
     return text
 
 
+@timing.timed('ocr')
 def ocr_core_names(img):
     """
     Handles the single line core OCR image processing consisting of strings.
@@ -271,6 +574,7 @@ def ocr_core_names(img):
     return text
 
 
+@timing.timed('ocr')
 def ocr_core_questions(img):
     """
     Handles the single line core OCR image processing consisting of strings.
@@ -290,11 +594,8 @@ def ocr_core_expressvote(img):
     Using Pillow's Image class to open the image and pytesseract to detect
     the string in the image.
     """
-    text = pytesseract.image_to_string(
-        img,
-        config='--psm 6 --oem 3'
-    )
-    return text
+    return image_to_string(img, config=EXPRESSVOTE_OCR_CONFIG)
+
 
 def sanitize_string(unclean_string: str) -> str:
     """
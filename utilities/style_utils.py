@@ -8,10 +8,10 @@ import cv2
 import numpy as np
 #import pandas as pd
 
-from utilities import utils, logs
+from utilities import utils, logs, args
 from utilities.utils import list_from_csv_str
 from utilities.config_d import config_dict
-from utilities.alignment_utils import choose_unstretched_ballot, stretch_fix_ballots
+from utilities.alignment_utils import choose_unstretched_ballot, stretch_fix_ballot, gen_distortion_metrics, DISTORTION_THRESHOLD
 #from utilities.cvr_utils import get_replacement_cvr_header
 from models.DB import DB
 from models.Style import Style
@@ -70,21 +70,60 @@ def get_ballot_number_area(image):
     return cropped_image
 
 
-def get_weighted_image(weighted, images):
-    """
-        Generate a weighted image based on one image passed as
-        'weighted' and a list of similar 'images', then normalize.
+TEMPLATE_COMBINE_MODES = ('mean', 'median', 'trimmed_mean')
+TEMPLATE_COMBINE_STRIP_ROWS = 256          # rows of the page stack sorted at a time by median and trimmed_mean modes.
+
+
+def new_image_accumulator(mode: str = 'mean', trim_fraction: float = None) -> dict:
+    """ Create an accumulator to combine images of one page as they become available.
+        mode 'mean' sums images into one float32 buffer in place and divides once.
+        mode 'median' and 'trimmed_mean' keep a uint8 stack of the layers and suppress 
+        voter marks better, as dark pixels found in only a few layers are discarded.
     """
-    for i, image in enumerate(images):
-        weighted = cv2.addWeighted(
-            weighted, 1.0 - (1.0/(2.0 + i)),
-            image,
-            1.0/(2.0 + i),
-            0.0
-        )
-    weighted = cv2.normalize(weighted, weighted, 0, 255, cv2.NORM_MINMAX)
-    return weighted
+    if not mode in TEMPLATE_COMBINE_MODES:
+        utils.exception_report(f"Unrecognized template combine mode '{mode}', using 'mean'")
+        mode = 'mean'
+    if trim_fraction is None:
+        trim_fraction = config_dict['TEMPLATE_TRIM_FRACTION']
+    return {'mode': mode, 'trim_fraction': trim_fraction, 'count': 0, 'sum': None, 'layers': []}
+    
 
+def add_image_to_accumulator(accumulator: dict, image: np.ndarray):
+    """ add one image to accumulator. All images must have the same shape. """
+    if accumulator['mode'] == 'mean':
+        if accumulator['sum'] is None:
+            accumulator['sum'] = image.astype(np.float32)
+        else:
+            np.add(accumulator['sum'], image, out=accumulator['sum'])
+    else:
+        accumulator['layers'].append(image.copy())
+    accumulator['count'] += 1
+    
+
+def get_accumulated_image(accumulator: dict) -> np.ndarray:
+    """ Return the combined image of all images added to accumulator, normalized to 0-255 """
+    count = accumulator['count']
+    if not count:
+        return None
+        
+    if accumulator['mode'] == 'mean':
+        combined = accumulator['sum'] / count
+    else:
+        layers = accumulator['layers']
+        combined = np.empty(layers[0].shape, dtype=np.float32)
+        trim_num = int(count * accumulator['trim_fraction']) if accumulator['mode'] == 'trimmed_mean' else 0
+        trim_num = min(trim_num, (count - 1) // 2)
+        # sort strips of rows across all layers to limit the size of the temporary arrays.
+        for row in range(0, combined.shape[0], TEMPLATE_COMBINE_STRIP_ROWS):
+            strip = np.stack([layer[row:row + TEMPLATE_COMBINE_STRIP_ROWS] for layer in layers])
+            if accumulator['mode'] == 'median':
+                combined[row:row + TEMPLATE_COMBINE_STRIP_ROWS] = np.median(strip, axis=0)
+            else:
+                strip.sort(axis=0)
+                combined[row:row + TEMPLATE_COMBINE_STRIP_ROWS] = strip[trim_num:count - trim_num].mean(axis=0)
+                
+    return cv2.normalize(combined, None, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U)
+    
 
 def get_number_from_string(_string: str) -> int:
     """
@@ -124,14 +163,8 @@ def link_dashed_lines(image):
     return cv2.bitwise_and(cv2.bitwise_not(new_image), clean_lines)
 
 
-def get_weighted_image_from_page(page: int, ballots: list) -> np.ndarray:
-    """Gets weighted image from the 'ballots' list of the specific 'page'.
-    :param page: Number of page of which we want weighted image from.
-    :param ballots: List of 'Ballot' instances from which pages are taken.
-    :return: Image saved as 'np.ndarray'.
-    """
-    images = list(map(lambda ballot, p=page: ballot.ballotimgdict['images'][p], ballots))
-    weighted_image = get_weighted_image(images.pop(), images)
+def sharpen_template_image(weighted_image: np.ndarray) -> np.ndarray:
+    """ combined images are slightly blurred by residual misalignment. Apply unsharp mask. """
     blurred_image = cv2.GaussianBlur(weighted_image, (0, 0), 3)
     weighted_image = cv2.addWeighted(weighted_image, 3.5, blurred_image, -2.5, 0.0)
     return weighted_image
@@ -247,86 +280,118 @@ def sum_determinants(ballot, first=True):
     return 0
 
 
-def generate_style_template(argsdict: dict, ballots: list, style_num, sheet0=0, omit_ballot_images=False):
+def new_style_template_builder(argsdict: dict, style_num, sheet0=0, omit_ballot_images=False) -> dict:
     """
-    ACTIVE 
-    Function which takes a list of Ballot instances and generate
-    a new style template with information like ballot code, number
-    and regions of interests (ROI). To achieve that, function creates
-    a weighted image of ballot based on a list of all passed 'ballots'
-    (they should be in similar alignment and shape). Then function looks
-    for ROIs and extract data contained within weighted image with OCR tool.
+    Create the state to build a style template as ballots are decoded, without keeping them in memory.
     
-    TO MOVE THIS TOWARD IMPLMENTATION COMPATIBLE WITH LAMBDAS
-    1. the caller this function should, instead of generating a list of Ballot instances
-        with the image already extracted from the file, into just a list of pathnames
-        to process. So the Queues.py class should be oriented to just keeping a single
-        dict of list structure, where the key of the dict is the style_num, and the
-        list containing the ballots pathnames that are of that style.
-    2. We must add an intermediate function to make this conversion, which will
-        take that list and for each ballot, open it and load the images for each file, 
-        and then call this function. Let's assume we call that function
-        'generate_style_template_from_paths(ballot_paths: list, style_num)'
-        It will be the appropriate operation type that can be ported to work on lambdas.
-    3. The result of this function will be only the combined template. It will be
-        reasonable to continue with the subsequent steps for this style, such as
-        genrois and maprois. Those functions take the combined template plus
-        EIF file information to finally generate at roismap_df for the style.
-        Each roismap_df is combined together after all lambdas are competed to 
-        produce the roismap_df which is later used in the extraction process.
-    4. Result of style generation lambda will be:
-        1. list of pathnames actually used in the style generation, in cause some were
-            inappropriate or unusable.
-        2. roismap_df for that style.
-        3. combined template with redlines of the rois that are mapped to it.
-        
-    sheet value is simply added to the style dict. The sheet is used for any later 
-    drawing of lines which may only be appropriate for one of the sheets.
+    The first TEMPLATE_REFERENCE_SAMPLE ballots are held until the reference (standard) ballot is chosen 
+    from them as the one with the most average timing marks. Each ballot after that is stretch-fixed to the
+    timing marks of the reference ballot, added to a running accumulator per page, and released.
+    Only the timing marks of the reference ballot and the ballot_ids used are kept.
+    """
+    max_layers = config_dict['LAYERS_FOR_EMPTY_BALLOT']
+    return {
+        'style_num':            style_num,
+        'sheet0':               sheet0,
+        'omit_ballot_images':   omit_ballot_images,
+        'combine_mode':         argsdict.get('template_combine_mode', 'mean'),
+        'max_layers':           max_layers,
+        'sample_num':           max(1, min(config_dict['TEMPLATE_REFERENCE_SAMPLE'], max_layers)),
+        'sample_ballots':       [],         # held until the reference ballot is chosen.
+        'std_timing_marks':     None,       # timing marks of the reference ballot.
+        'precinct':             None,
+        'page_accumulators':    None,       # dict of page: accumulator, for those pages included in the template.
+        'build_from_ballots':   [],
+        'num_distorted':        0,
+        }
         
+
+def add_ballot_to_style_template(argsdict: dict, template_builder: dict, ballot) -> bool:
+    """ add one decoded ballot with timing marks to the template.
+        returns True when enough ballots are included, so no more need be read.
     """
-    #use_sync_timing = True
-    
-    utils.sts(f"Generating ballot style templates for style {style_num} using {len(ballots)} ballots...", 3)
-    if not ballots:
-        utils.exception_report("generate_style_template: List of ballots is empty")
-        return False
+    if template_builder['std_timing_marks'] is None:
+        template_builder['sample_ballots'].append(ballot)
+        if len(template_builder['sample_ballots']) >= template_builder['sample_num']:
+            choose_template_reference(argsdict, template_builder)
+    else:
+        accumulate_template_ballot(argsdict, template_builder, ballot)
         
-    #ballots.sort(key=sum_determinants)
-    ballots = ballots[:config_dict['LAYERS_FOR_EMPTY_BALLOT']]  # consider first ballots. Maybe better to choose ballots with least stretch
-    style = Style(style_num=style_num)
-    style.sheet0 = sheet0
-    style.target_side = argsdict['target_side']
-    style.build_from_count = len(ballots)
-    style.precinct = ballots[0].ballotdict['precinct']
-    style.build_from_ballots = [ballot.ballotdict['ballot_id'] for ballot in ballots]
-    weighted_images = []
-    pages = range(len(ballots[0].ballotimgdict['images']))
+    return len(template_builder['build_from_ballots']) >= template_builder['max_layers']
     
-    utils.sts("Generating the average timing marks for minimal corrections", 3)
-    std_ballot_num = choose_unstretched_ballot(ballots)
     
-    utils.sts("stretch_fix all ballots to std_timing_marks", 3)
-    stretch_fix_ballots(argsdict, ballots, std_ballot_num)
+def choose_template_reference(argsdict: dict, template_builder: dict):
+    """ choose the reference ballot from the sample and accumulate the sample ballots """
+    sample_ballots = template_builder['sample_ballots']
+    template_builder['sample_ballots'] = []
+    
+    utils.sts(f"Choosing reference timing marks from sample of {len(sample_ballots)} ballots", 3)
+    std_ballot_num = choose_unstretched_ballot(sample_ballots)
+    template_builder['std_timing_marks'] = sample_ballots[std_ballot_num].ballotdict['timing_marks']
+    
+    for ballot_idx, ballot in enumerate(sample_ballots):
+        accumulate_template_ballot(argsdict, template_builder, ballot, is_reference=(ballot_idx == std_ballot_num))
+        
+        
+def accumulate_template_ballot(argsdict: dict, template_builder: dict, ballot, is_reference=False):
+    """ stretch_fix ballot to the reference timing marks and add its pages to the template. """
+    ballot_id = ballot.ballotdict['ballot_id']
+    if not is_reference:
+        # by definition, we need not unstretch the reference ballot
+        distortion_metric = gen_distortion_metrics([ballot], template_builder['std_timing_marks'])[0]
+        if distortion_metric > DISTORTION_THRESHOLD:
+            utils.sts(f">>> Omitting ballot {ballot_id} with distortion metric {distortion_metric} from template", 3)
+            template_builder['num_distorted'] += 1
+            return
+        stretch_fix_ballot(argsdict, ballot, template_builder['std_timing_marks'])
 
     # first save them so we can diagnose any problem.
-    if argsdict['save_checkpoint_images'] and not omit_ballot_images:
-        utils.sts("Saving checkpoint images...", 3)
+    if argsdict['save_checkpoint_images'] and not template_builder['omit_ballot_images']:
         #confirmed this is working to s3.
-        save_style_ballot_images(ballots, style_num)
+        save_style_ballot_images([ballot], template_builder['style_num'])
+        
+    images = ballot.ballotimgdict['images']
+    if template_builder['page_accumulators'] is None:
+        # pages included are determined by the first ballot.
+        template_builder['precinct'] = ballot.ballotdict['precinct']
+        template_builder['page_accumulators'] = {
+            page: new_image_accumulator(template_builder['combine_mode']) for page in range(len(images))
+            if not (page and (ballot.ballotdict.get('p1_blank', False) or not ballot.ballotdict.get('timing_marks', [])))
+            }
+    for page, accumulator in template_builder['page_accumulators'].items():
+        add_image_to_accumulator(accumulator, images[page])
+    template_builder['build_from_ballots'].append(ballot_id)
+    
 
-    utils.sts("Combining images to create template for each page...", 3)
-    for page in pages:
+def finish_style_template(argsdict: dict, template_builder: dict) -> bool:
+    """ combine the accumulated pages into the template images and save the style. """
+    style_num = template_builder['style_num']
+    if template_builder['sample_ballots']:
+        # fewer ballots than the sample were provided.
+        choose_template_reference(argsdict, template_builder)
+        
+    if not template_builder['build_from_ballots']:
+        utils.exception_report(f"finish_style_template: No ballots included in template of style {style_num}")
+        return False
+        
+    style = Style(style_num=style_num)
+    style.sheet0 = template_builder['sheet0']
+    style.target_side = argsdict['target_side']
+    style.build_from_count = len(template_builder['build_from_ballots'])
+    style.precinct = template_builder['precinct']
+    style.build_from_ballots = template_builder['build_from_ballots']
     
-        if not (page and (ballots[0].ballotdict.get('p1_blank', False) or
-                            not ballots[0].ballotdict.get('timing_marks', []))):
-            
-            weighted_images.append(get_weighted_image_from_page(page, ballots))
+    utils.sts(f"Combining images of {style.build_from_count} ballots to create template for each page "
+              f"(omitted {template_builder['num_distorted']} distorted ballots)...", 3)
+    weighted_images = [sharpen_template_image(get_accumulated_image(accumulator)) 
+                        for page, accumulator in sorted(template_builder['page_accumulators'].items())]
+    template_builder['page_accumulators'] = None
 
     # image templates must be saved outside style
     utils.sts("Saving style template images...", 3)
     style.filepaths = save_style_template_images(style_num, weighted_images)
    
-    style.timing_marks = ballots[std_ballot_num].ballotdict['timing_marks']
+    style.timing_marks = template_builder['std_timing_marks']
 
     utils.sts("Saving style object...", 3)
     #DB.save_style(name=style_num, style_data=vars(style))
@@ -388,14 +453,33 @@ def get_style_fail_to_map(style_num):
         
         #style_dict = DB.load_style(name=style_num, silent_error=True)
         style_dict = DB.load_data(dirname='styles', subdir=style_num, name=f'{style_num}_style', silent_error=True)
-        if style_dict is None:
-            style_failed_to_map_dict[style_num] = True
-        else:
-            style_failed_to_map_dict[style_num] = style_dict.get('style_failed_to_map', False)
+        style_failed_to_map_dict[style_num] = is_style_dict_failed_to_map(style_dict)
 
     return style_failed_to_map_dict[style_num]
     
 
+def is_style_dict_failed_to_map(style_dict) -> bool:
+    """ True if the style failed to map, or style_dict is None because the style does not exist. """
+    if style_dict is None:
+        return True
+    return style_dict.get('style_failed_to_map', False)
+
+
+extraction_style_dict_cache = {}  # {(job_name, style_num): style_dict}, loaded once per job and style.
+
+
+def get_extraction_style_dict(style_num):
+    """ return {style_num}_style.json as used by extraction, or None if not available.
+        Both the fail to map flag and the timing marks of the style are taken from this one read.
+        The job_name is part of the key because a warm lambda container may process more than one job.
+    """
+    key = (args.argsdict.get('job_name', ''), str(style_num))
+    if key not in extraction_style_dict_cache:
+        style_dict = DB.load_data(dirname='styles', subdir=str(style_num), name=f'{style_num}_style', silent_error=True)
+        extraction_style_dict_cache[key] = style_dict if isinstance(style_dict, dict) else None
+    return extraction_style_dict_cache[key]
+
+
 def get_manual_styles_to_contests(argsdict, save=True, silent_error=False) -> dict:
     """
     :manual_styles_to_contests_path str: Path to CSV file with contests and styles table.
@@ -9,7 +9,8 @@ import json
 import pandas as pd
 
 #from utilities.bif_utils import BIF, get_bif_dirpath
-from utilities.cvr_utils import get_replacement_cvr_header, create_contests_dod
+from utilities.cvr_utils import get_replacement_cvr_header, create_contests_dod, \
+    get_style_to_contests_matrix, style_to_contests_dol_from_matrix
 from utilities import utils, logs
 from models.DB import DB
 from utilities.zip_utils import open_archive
@@ -64,12 +65,8 @@ def get_contests_per_style(data_frame: pd.DataFrame, ballot_styles: list) -> dic
     :param data_frame: a pandas data frame with CVR
     :param ballot_styles: a pandas object with all ballot styles
     """
-    contests_per_style = collections.OrderedDict()
-    for ballot_style in ballot_styles:
-        df = data_frame[data_frame['Ballot Style'] == ballot_style].copy()
-        df.drop('Ballot Style', axis=1, inplace=True)
-        contests_per_style[ballot_style] = list(df.dropna(axis='columns', how='all'))
-    return contests_per_style
+    matrix_df = get_style_to_contests_matrix(data_frame, get_all_contests(data_frame))
+    return style_to_contests_dol_from_matrix(matrix_df, ballot_styles)
 
 
 def get_all_contests(data_frame) -> list:
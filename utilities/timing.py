@@ -0,0 +1,157 @@
+# timing.py
+import time
+import threading
+import functools
+
+from utilities import utils
+
+""" This module accumulates the time spent in the stages of processing a chunk.
+
+    Stages are timed with spans:
+
+        with timing.span('ocr'):
+            ...
+
+    or by decorating a function with @timing.timed('ocr').
+
+    For each span name, the count, total and max seconds are accumulated in this process.
+    If a span is entered again while it is already active in the same thread, as when timed
+    functions call each other, only the outer span is counted. Spans in other threads, such
+    as the ocr threads, are counted separately, so their total may exceed the elapsed time.
+
+    Each chunk saves its summary in {dirname}/chunks/timing_{chunk_name}.json
+    next to its logs, and the main process combines the summaries of a phase
+    into {dirname}/timing_{dirname}.json with report_phase_timing().
+
+    The 'chunk' span is the total time of the chunk, so the other spans can be
+    compared with it. Spans in processes of multiprocessing pools are not included.
+"""
+
+spans_dict = {}             # span name: [count, total_secs, max_secs]
+thread_state = threading.local()    # .active_spans: set of names of spans active in this thread.
+spans_lock = threading.Lock()
+
+
+def get_active_spans() -> set:
+    active_spans = getattr(thread_state, 'active_spans', None)
+    if active_spans is None:
+        active_spans = thread_state.active_spans = set()
+    return active_spans
+
+
+class span:
+    """ context manager that adds the time of its block to span 'name'.
+    """
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        active_spans = get_active_spans()
+        if self.name not in active_spans:
+            active_spans.add(self.name)
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.start is None:
+            return False
+        secs = time.perf_counter() - self.start
+        self.start = None
+        get_active_spans().discard(self.name)
+        with spans_lock:
+            stats = spans_dict.get(self.name)
+            if stats is None:
+                spans_dict[self.name] = [1, secs, secs]
+            else:
+                stats[0] += 1
+                stats[1] += secs
+                if secs > stats[2]:
+                    stats[2] = secs
+        return False
+
+
+def timed(name):
+    """ decorator to time each call of the function in span 'name'.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def reset_spans():
+    """ clear the spans, at the start of each chunk. """
+    with spans_lock:
+        spans_dict.clear()
+    get_active_spans().clear()
+
+
+def get_spans_summary() -> dict:
+    """ return dict of span name: {'count', 'total_secs', 'max_secs'} """
+    with spans_lock:
+        return {name: {'count': stats[0], 'total_secs': round(stats[1], 6), 'max_secs': round(stats[2], 6)}
+                for name, stats in spans_dict.items()}
+
+
+def save_chunk_timing(dirname, chunk_name):
+    """ save the summary of the spans of this chunk at {dirname}/chunks/timing_{chunk_name}.json
+    """
+    from models.DB import DB
+
+    timing_dict = {'chunk_name': chunk_name, 'spans': get_spans_summary()}
+    return DB.save_data(data_item=timing_dict, dirname=dirname, subdir='chunks', name=f"timing_{chunk_name}")
+
+
+def combine_timing_dicts(timing_dicts: list) -> dict:
+    """ combine the summaries of chunks into totals per span, and the chunk time of each chunk.
+    """
+    spans = {}
+    chunk_secs = {}
+    for timing_dict in timing_dicts:
+        for name, stats in timing_dict['spans'].items():
+            total = spans.setdefault(name, {'count': 0, 'total_secs': 0.0, 'max_secs': 0.0})
+            total['count'] += stats['count']
+            total['total_secs'] += stats['total_secs']
+            total['max_secs'] = max(total['max_secs'], stats['max_secs'])
+        if 'chunk' in timing_dict['spans']:
+            chunk_secs[timing_dict['chunk_name']] = timing_dict['spans']['chunk']['total_secs']
+
+    for stats in spans.values():
+        stats['total_secs'] = round(stats['total_secs'], 6)
+    return {'num_chunks': len(timing_dicts), 'spans': spans, 'chunk_secs': chunk_secs}
+
+
+def format_timing_report(phase_timing: dict) -> str:
+    """ table of the spans in order of total time, with share of the chunk time. """
+    chunk_total = phase_timing['spans'].get('chunk', {}).get('total_secs', 0)
+    lines = [f"{'span':<16}{'count':>10}{'total_secs':>14}{'max_secs':>12}{'% of chunks':>13}"]
+    for name, stats in sorted(phase_timing['spans'].items(), key=lambda item: -item[1]['total_secs']):
+        share = f"{100 * stats['total_secs'] / chunk_total:12.1f}%" if chunk_total else ''
+        lines.append(f"{name:<16}{stats['count']:>10}{stats['total_secs']:>14.3f}{stats['max_secs']:>12.3f}{share:>13}")
+    if phase_timing['chunk_secs']:
+        slowest_chunk = max(phase_timing['chunk_secs'], key=phase_timing['chunk_secs'].get)
+        lines.append(f"{phase_timing['num_chunks']} chunks, slowest: {slowest_chunk} "
+                     f"{phase_timing['chunk_secs'][slowest_chunk]:.3f} secs")
+    return '\n'.join(lines)
+
+
+def report_phase_timing(dirname):
+    """ combine the timing summaries of all chunks in {dirname}/chunks
+        and save the result as {dirname}/timing_{dirname}.json
+    """
+    from models.DB import DB
+
+    timing_names = DB.list_files_in_dirname_filtered(dirname=dirname, subdir='chunks', file_pat=r'^timing_.*\.json$')
+    if not timing_names:
+        return None
+    timing_dicts = [DB.load_data(dirname=dirname, subdir='chunks', name=name) for name in timing_names]
+    phase_timing = combine_timing_dicts([timing_dict for timing_dict in timing_dicts if timing_dict])
+    DB.save_data(data_item=phase_timing, dirname=dirname, name=f"timing_{dirname}")
+    utils.sts(f"Timing of {dirname} phase:\n{format_timing_report(phase_timing)}", 3)
+    return phase_timing
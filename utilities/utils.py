@@ -31,6 +31,24 @@ def on_lambda():
     return True
 
 
+def get_num_pool_workers(argsdict: dict, setting_name: str, num_tasks: int) -> int:
+    """ number of processes to use for num_tasks, per the setting. 0 or missing uses one per cpu core.
+        lambdas do not support multiprocessing pools, so returns 1 there.
+    """
+    num_workers = argsdict.get(setting_name) or os.cpu_count() or 1
+    if on_lambda():
+        num_workers = 1
+    return max(1, min(num_workers, num_tasks))
+
+
+def init_pool_worker(argsdict: dict):
+    """ initializer for process pool workers. Globals of the parent are not inherited
+        when processes are spawned, so the argsdict and DB mode are established here.
+    """
+    args.argsdict = argsdict
+    DB.set_DB_mode()
+
+
 def list_from_csv_str(csvstr):
     """ this function can be used to intelligently split fields in the input file.
         commas can be embedded in fields if they are surrounded by double quotes.
@@ -110,6 +128,10 @@ def sts(string, verboselevel=0, end='\n'):
     return logs.sts(string, verboselevel, end)
 
 
+def is_logged(verboselevel=0):
+    return logs.is_logged(verboselevel)
+
+
 def print_disagreements(string):
     logs.print_disagreements(string)
 
@@ -494,8 +516,8 @@ def merge_csv_dirname_local(dirname, subdir, dest_name, dest_dirname=None, file_
 
     sts(f"Merging csv from {dirname} to {dest_dirname}/{dest_name}", 3)
 
-    src_dirpath = DB.dirpath_from_dirname(dirname, subdir=subdir, s3flag=False)
-    dest_dirpath = DB.dirpath_from_dirname(dest_dirname, s3flag=False)
+    src_dirpath = path_sep_per_os(DB.dirpath_from_dirname(dirname, subdir=subdir, s3flag=False))
+    dest_dirpath = path_sep_per_os(DB.dirpath_from_dirname(dest_dirname, s3flag=False))
     destpath = os.path.join(dest_dirpath, dest_name)
 
     first_pass = True
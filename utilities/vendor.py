@@ -11,10 +11,12 @@ def get_layout_params(argsdict: dict):
         returns list of box sizes. First size will have narrowist columns
         sheet0 and page0 only needed for box_sizes to be correct.
     """
-    global LAYOUT_PARAMS_DICT
+    global LAYOUT_PARAMS_DICT, LAYOUT_PARAMS_KEY
     
+    # the job is part of the key because a warm lambda container may process more than one job.
+    layout_params_key = (argsdict.get('job_name', ''), argsdict['vendor'], argsdict.get('target_side'), argsdict.get('h_max_option'))
     try:
-        if LAYOUT_PARAMS_DICT:
+        if LAYOUT_PARAMS_DICT and LAYOUT_PARAMS_KEY == layout_params_key:
             return LAYOUT_PARAMS_DICT
     except NameError:
         pass
@@ -143,6 +145,7 @@ def get_layout_params(argsdict: dict):
         layout_params['h_max_option'] = argsdict['h_max_option']
         
     LAYOUT_PARAMS_DICT = layout_params
+    LAYOUT_PARAMS_KEY = layout_params_key
     return layout_params
 
 def get_box_sizes_list(argsdict, sheet0: int=0, page0:int=0):
@@ -7,12 +7,12 @@ import pandas as pd
 #import boto3
 #from boto3.s3.transfer import TransferConfig
 
-from utilities import utils, args, logs
-from utilities.analysis_utils import analyze_images_by_style_rois_map_df, analyze_bmd_ess, analyze_bmd_dominion
+from utilities import utils, args, logs, timing
+from utilities.analysis_utils import analyze_images_by_style_rois_map_df, analyze_bmd_ess, analyze_bmd_dominion, build_ev_coord_index
 from utilities.zip_utils import open_archive
-from utilities.style_utils import get_style_fail_to_map
+from utilities.style_utils import get_extraction_style_dict, is_style_dict_failed_to_map
 #from aws_lambda import s3utils
-from utilities.bif_utils import get_biflist, one_style_from_party_if_enabled, build_one_chunk, build_dirname_tasks
+from utilities.bif_utils import get_biflist, one_style_from_party_if_enabled, build_one_chunk, build_dirname_tasks, get_tasklists, load_tasklist_df
 #from utilities import launcher
 
 #from models.BIF import BIF
@@ -35,6 +35,7 @@ def extract_vote_from_ballot(
         contests_dod,
         ballot_style_overrides_dict,
         #cvr_ballotid_to_style_dict, -- no longer uses this because BIF table has the information, accessed through Ballot.
+        ev_coord_index=None,
         ):
     """ ACTIVE
     
@@ -43,6 +44,7 @@ def extract_vote_from_ballot(
     :param ballot: Ballot from which votes should be extracted.
         ballot.ballotdict['is_bmd'] should be initialized
     :param rois_map_df: DataFrame objec with map of targets on all styles.
+    :param ev_coord_index: barcode lookup tables of all styles, from build_ev_coord_index(rois_map_df).
     :return: DataFrame with ballot marks info.
     """
     ballot_id = ballot.ballotdict['ballot_id']
@@ -53,7 +55,7 @@ def extract_vote_from_ballot(
             # this is ES&S Specific
             # the following function analyzes the EV ballot using OCR and
             #   ballot_marks_df also contains the barcode strings for each selection (if successful).
-            ballot_marks_df = analyze_bmd_ess(argsdict, ballot, rois_map_df, contests_dod)
+            ballot_marks_df = analyze_bmd_ess(argsdict, ballot, rois_map_df, contests_dod, ev_coord_index)
 
         elif argsdict['vendor'] == 'Dominion':
             ballot_marks_df = analyze_bmd_dominion(argsdict, ballot, rois_map_df, contests_dod)
@@ -77,11 +79,17 @@ def extract_vote_from_ballot(
     style_num = one_style_from_party_if_enabled(argsdict, style_num, ballot.ballotdict['party'])
     ballot.ballotdict['style_num'] = style_num
 
-    ballot.get_timing_marks()       # for each image, capture the timing marks to ballot instance.
+    # the style file is read once per style and provides both the timing marks and whether the style mapped.
+    style_dict = get_extraction_style_dict(style_num)
 
-    if get_style_fail_to_map(style_num):
-        # note that this reads the style file keeps a list of styles so it does not have to
-        # read the style file each time.
+    # the timing marks of the style restrict the search to narrow bands where the marks are expected.
+    # Only the ES&S timing mark search uses them.
+    style_timing_marks = None
+    if style_dict and argsdict['vendor'] == 'ES&S' and argsdict.get('use_timing_mark_prior', True):
+        style_timing_marks = style_dict.get('timing_marks')
+    ballot.get_timing_marks(style_timing_marks)       # for each image, capture the timing marks to ballot instance.
+
+    if is_style_dict_failed_to_map(style_dict):
         # we can't process this ballot because we were unable to map the style.
         # this will also return true if the style is out of range.
 
@@ -116,14 +124,30 @@ def extract_vote_from_ballot(
         regarding overvotes, undervotes.
     """
 
-    utils.sts(f"Style {style_num} read from ballot. Analyzing Ballot and extracting the marks...", 3)
+    if utils.is_logged(3):
+        utils.sts(f"Style {style_num} read from ballot. Analyzing Ballot and extracting the marks...", 3)
     ballot_marks_df = analyze_images_by_style_rois_map_df(argsdict, ballot, style_rois_map_df)
     return ballot_marks_df
 
 
+ev_coord_index_cache = {}     # {id(rois_map_df): (rois_map_df, ev_coord_index)}
+
+
+def get_ev_coord_index(rois_map_df):
+    """ barcode lookup tables of rois_map_df, built once while the cached rois_map_df is unchanged.
+        rois_map_df is kept in the cache entry so its id is not reused.
+    """
+    key = id(rois_map_df)
+    if key not in ev_coord_index_cache:
+        ev_coord_index_cache.clear()
+        ev_coord_index_cache[key] = (rois_map_df, build_ev_coord_index(rois_map_df))
+    return ev_coord_index_cache[key][1]
+
+
 def extractvote_by_one_tasklist(
         argsdict: dict,
         tasklist_name: str,
+        tasklist_spec=None,
         ):
     """ ACTIVE
     
@@ -133,6 +157,7 @@ def extractvote_by_one_tasklist(
     :param argsdict: provides arguments from input file or CLI such as filter specs.
     :param tasklist_name: created by f"{BIF.name}_chunk_{'%4.4u' % (chunk_index)}.csv"
             tasklist is found in extaction_tasks folder.
+    :param tasklist_spec: the tasklist itself or its location in the packed tasklists, from get_tasklists().
 
     produces results/marks_{tasklist_name}
 
@@ -151,15 +176,20 @@ def extractvote_by_one_tasklist(
 
     # set s3 vs local mode
     DB.set_DB_mode()        
+    
+    from utilities import ocr       # imported on use, so tasks that do not ocr do not import tesseract at startup.
+    ocr.configure_ocr_cache(argsdict)
 
     # initialize results.
     DB.BALLOT_MARKS_DF = pd.DataFrame()
     
-    rois_map_df      = DB.load_data('styles', 'roismap.csv')
-    contests_dod     = DB.load_data('styles', 'contests_dod.json')
+    # these are kept across chunks run in the same warm lambda container.
+    rois_map_df      = DB.load_data_cached('styles', 'roismap.csv')
+    contests_dod     = DB.load_data_cached('styles', 'contests_dod.json')
+    ev_coord_index   = get_ev_coord_index(rois_map_df)
 
     #extraction_tasks_df = DB.load_df_csv(name=tasklist_name, dirname='extraction_tasks', s3flag=argsdict['use_s3_results'])
-    extraction_tasks_df = DB.load_data(dirname='marks', subdir='tasks', name=tasklist_name)
+    extraction_tasks_df = load_tasklist_df(dirname='marks', subdir='tasks', tasklist_name=tasklist_name, tasklist_spec=tasklist_spec)
 
     #archives_folder_path = argsdict['archives_folder_path']
 
@@ -217,7 +247,8 @@ def extractvote_by_one_tasklist(
             utils.exception_report(string)
             continue
 
-        utils.sts(f"\n{'-'*50}\nProcessing tasklist:{tasklist_name} offset: {task_idx} ballot_id:{ballot_id}", 3)
+        if utils.is_logged(3):
+            utils.sts(f"\n{'-'*50}\nProcessing tasklist:{tasklist_name} offset: {task_idx} ballot_id:{ballot_id}", 3)
 
         ballot.get_ballot_images()      # this reads images from PDFs
 
@@ -229,6 +260,7 @@ def extractvote_by_one_tasklist(
         ballot_marks_df = extract_vote_from_ballot(
             argsdict, ballot, rois_map_df, contests_dod,
             ballot_style_overrides_dict,
+            ev_coord_index=ev_coord_index,
             )
             
         # the above function makes exception reports if:
@@ -258,7 +290,7 @@ def extractvote_by_tasklists(argsdict: dict):
     """
     logs.sts('Extracting marks from extraction tasklists', 3)
 
-    tasklists = DB.list_files_in_dirname_filtered(dirname='marks', subdir='tasks', file_pat=r'^[^~].*\.csv$', fullpaths=False)
+    tasklists = get_tasklists(argsdict, dirname='marks', subdir='tasks')     # [(tasklist_name, tasklist_spec)]
     total_num = len(tasklists)
     utils.sts(f"Found {total_num} taskslists", 3)
 
@@ -272,9 +304,9 @@ def extractvote_by_tasklists(argsdict: dict):
 
     for bif_idx, bifname in enumerate(biflist):
         archive_name = re.sub(r'_bif', '', bifname)
-        genmarks_tasks = [t for t in tasklists if t.startswith(archive_name)]
+        genmarks_tasks = [t for t in tasklists if t[0].startswith(archive_name)]
     
-        for chunk_idx, tasklist_name in enumerate(genmarks_tasks):
+        for chunk_idx, (tasklist_name, tasklist_spec) in enumerate(genmarks_tasks):
         
             #----------------------------------
             # this call may delegate to lambdas and return immediately
@@ -284,7 +316,7 @@ def extractvote_by_tasklists(argsdict: dict):
             build_one_chunk(argsdict, 
                 dirname='marks', 
                 chunk_idx=chunk_idx, 
-                filelist=[tasklist_name], 
+                filelist=[tasklist_name, tasklist_spec], 
                 group_name=bifname,
                 task_name='extractvote', 
                 incremental=False)
@@ -301,6 +333,7 @@ def extractvote_by_tasklists(argsdict: dict):
     utils.combine_dirname_chunks_each_archive(argsdict, dirname='marks')
     logs.get_and_merge_s3_logs(dirname='marks', rootname='log', chunk_pat=r"_chunk_\d+", subdir="chunks")
     logs.get_and_merge_s3_logs(dirname='marks', rootname='exc', chunk_pat=r"_chunk_\d+", subdir="chunks")
+    timing.report_phase_timing(dirname='marks')
         
 
 def delegated_extractvote(dirname, task_args, s3flag=None): 
@@ -308,11 +341,12 @@ def delegated_extractvote(dirname, task_args, s3flag=None):
     args.argsdict = argsdict = task_args['argsdict']
     
     #chunk_idx   = task_args['chunk_idx']
-    filelist    = task_args['filelist']         # bif segment defining ballots included 
+    filelist    = task_args['filelist']         # [tasklist_name, tasklist_spec] defining ballots included 
     
     extractvote_by_one_tasklist(
             argsdict,
             tasklist_name=filelist[0],
+            tasklist_spec=filelist[1] if len(filelist) > 1 else None,
             )
 
 